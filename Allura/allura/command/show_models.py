@@ -23,7 +23,7 @@
 from contextlib import contextmanager
 from itertools import groupby
 
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 from tg import tmpl_context as c, app_globals as g
 from pymongo.errors import DuplicateKeyError, InvalidDocument, OperationFailure
 
@@ -113,6 +113,7 @@ def command(self):
                 # Clear index for this project
                 if self.options.solr and not self.options.skip_solr_delete:
                     g.solr.delete(q='project_id_s:%s' % p._id)
+                    M.ArtifactReference.clear_solr_hashes({'artifact_reference.project_id': p._id})
                 if self.options.refs:
                     M.ArtifactReference.query.remove(
                         {'artifact_reference.project_id': p._id})
@@ -247,8 +248,37 @@ def command(self):
         base.log.info('... DB: %s', db)
         for name, indexes in six.iteritems(project_indexes):
             self._update_indexes(db[name], indexes)
+        base.log.info('Updating TTL index for repo diff cache')
+        diff_cache = M.repository.DiffCacheDoc.m
+        self._update_ttl_index(diff_cache.session.db[diff_cache.collection_name], 'created',
+                               asint(self.config.get('scm.diff_cache.ttl', 30 * 86400)))
         base.log.info('Done updating indexes')
 
+    def _update_ttl_index(self, collection, field, ttl):
+        '''Create, update or (if ttl is 0) drop a TTL index on the given field,
+        which expires documents ttl seconds after its value'''
+        try:
+            existing_indexes = six.iteritems(collection.index_information())
+        except OperationFailure:
+            existing_indexes = {}
+        for iname, fields in existing_indexes:
+            if list(fields['key']) != [(field, 1)]:
+                continue
+            expire = fields.get('expireAfterSeconds')
+            if expire is None or not ttl:
+                base.log.info('...... drop index %s:%s', collection.name, iname)
+                collection.drop_index(iname)
+            elif expire != ttl:
+                base.log.info('...... update TTL of index %s:%s to %s', collection.name, iname, ttl)
+                collection.database.command('collMod', collection.name,
+                                            index={'keyPattern': {field: 1}, 'expireAfterSeconds': ttl})
+                return
+            else:
+                return
+        if ttl:
+            base.log.info('...... ensure %s:%s TTL %s', collection.name, field, ttl)
+            collection.ensure_index([(field, 1)], background=True, expireAfterSeconds=ttl)
+
     def _update_indexes(self, collection, indexes):
         uindexes = dict(
             # convert list to tuple so it's hashable for 'set'
@@ -26,12 +26,13 @@
 from datetime import datetime, timedelta
 import signal
 import sys
+import logging.config
 
 import faulthandler
 from setproctitle import setproctitle, getproctitle
 import tg
-from paste.deploy import loadapp
-from paste.deploy.converters import asint
+from paste.deploy import loadapp, appconfig
+from paste.deploy.converters import asbool, asint, aslist
 from webob import Request
 
 from . import base
@@ -61,10 +62,20 @@ class TaskdCommand(base.Command):
     parser = base.Command.standard_parser(verbose=True)
     parser.add_option('--only', dest='only', type='string', default=None,
                       help='only handle tasks of the given name(s) (can be comma-separated list)')
+    parser.add_option('--batch-size', dest='batch_size', type='int', default=1,
+                      help='claim up to this many ready tasks at once, if they are listed in --batch-only')
+    parser.add_option('--batch-only', dest='batch_only', type='string', default=None,
+                      help='task name(s) which may be claimed in batches (can be comma-separated list)')
     parser.add_option('--nocapture', dest='nocapture', action="store_true", default=False,
                       help='Do not capture stdout and redirect it to logging.  Useful for development with pdb.set_trace()')
+    parser.add_option('--supervise', dest='supervise', action='store_true', default=False,
+                      help='Run as a supervisor of the worker pools configured by taskd.pools in the ini file')
+
+    supervised = False
 
     def command(self):
+        if self.options.supervise:
+            return TaskdSupervisor(self).run()
         setproctitle('taskd')
         self.basic_setup()
         self.keep_running = True
@@ -102,6 +113,8 @@ def log_current_task(self, signum, frame):
 
     def worker(self):
         from allura import model as M
+        from allura.model.monq_model import task_notifier
+        from allura.lib.solr import make_buffered_solr_from_config
         name = '%s pid %s' % (os.uname()[1], os.getpid())
         wsgi_app = loadapp('config:%s#task' %
                            self.args[0], relative_to=os.getcwd())
@@ -109,6 +122,9 @@ def worker(self):
         only = self.options.only
         if only:
             only = only.split(',')
+        batch_size = self.options.batch_size
+        batch_only = self.options.batch_only
+        batch_only = [n for n in batch_only.split(',') if not only or n in only] if batch_only else []
 
         def start_response(status, headers, exc_info=None):
             if status != '200 OK':
@@ -116,9 +132,37 @@ def start_response(status, headers, exc_info=None):
                     'Unexpected http response from taskd request: %s.  Headers: %s',
                     status, headers)
 
+        notifier = task_notifier()
+
+        # collect solr adds across tasks, see BufferedSolr
+        solr_buffer = None
+        if asbool(tg.config.get('solr.buffer', False)):
+            solr_buffer = make_buffered_solr_from_config(tg.app_globals.solr)
+            tg.app_globals.solr = solr_buffer
+
+        def flush_solr(force=False):
+            if solr_buffer is None:
+                return
+            try:
+                if force:
+                    solr_buffer.flush()
+                else:
+                    solr_buffer.flush_if_due()
+            except Exception:
+                log.exception('Error flushing buffered solr docs')
+
         def waitfunc_noq():
+            flush_solr(force=True)
             time.sleep(poll_interval)
 
+        def waitfunc_notify():
+            flush_solr(force=True)
+            try:
+                notifier.wait(poll_interval, only=only)
+            except Exception:
+                log.warning('Error waiting for task notification; falling back to polling', exc_info=True)
+                time.sleep(poll_interval)
+
         def check_running(func):
             def waitfunc_checks_running():
                 if self.keep_running:
@@ -127,7 +171,7 @@ def waitfunc_checks_running():
                     raise StopIteration
             return waitfunc_checks_running
 
-        waitfunc = waitfunc_noq
+        waitfunc = waitfunc_notify if notifier else waitfunc_noq
         waitfunc = check_running(waitfunc)
         while self.keep_running:
             try:
@@ -137,19 +181,24 @@ def waitfunc_checks_running():
                         waitfunc=waitfunc,
                         only=only)
                     if self.task:
-                        with(proctitle("taskd:{0}:{1}".format(
-                                self.task.task_name, self.task._id))):
-                            # Build the (fake) request
-                            request_path = '/--%s--/%s/' % (self.task.task_name,
-                                                            self.task._id)
-                            r = Request.blank(request_path,
-                                              base_url=tg.config['base_url'].rstrip(
-                                                  '/') + request_path,
-                                              environ={'task': self.task,
-                                                       'nocapture': self.options.nocapture,
-                                                       })
-                            list(wsgi_app(r.environ, start_response))
-                            self.task = None
+                        batch = [self.task]
+                        if batch_size > 1 and self.task.task_name in batch_only:
+                            batch += M.MonQTask.get_batch(
+                                process=name,
+                                size=batch_size - 1,
+                                only=batch_only)
+                        for i, self.task in enumerate(batch):
+                            if i > 0 and not self.keep_running:
+                                # hand back leased tasks we won't get to
+                                M.MonQTask.release(batch[i:])
+                                break
+                            try:
+                                self._run_task(wsgi_app, start_response)
+                            except Exception:
+                                M.MonQTask.release(batch[i + 1:])
+                                raise
+                            flush_solr()
+                        self.task = None
             except Exception as e:
                 if self.keep_running:
                     base.log.exception(
@@ -157,12 +206,166 @@ def waitfunc_checks_running():
                     time.sleep(10)
                 else:
                     base.log.exception('taskd error %s' % e)
+        flush_solr(force=True)
         base.log.info('taskd pid %s stopping gracefully.' % os.getpid())
 
-        if self.restart_when_done:
+        if self.restart_when_done and not self.supervised:
             base.log.info('taskd pid %s restarting itself' % os.getpid())
             os.execv(sys.argv[0], sys.argv)
 
+    def _run_task(self, wsgi_app, start_response):
+        with(proctitle("taskd:{0}:{1}".format(
+                self.task.task_name, self.task._id))):
+            # Build the (fake) request
+            request_path = '/--%s--/%s/' % (self.task.task_name,
+                                            self.task._id)
+            r = Request.blank(request_path,
+                              base_url=tg.config['base_url'].rstrip(
+                                  '/') + request_path,
+                              environ={'task': self.task,
+                                       'nocapture': self.options.nocapture,
+                                       })
+            list(wsgi_app(r.environ, start_response))
+
+
+class TaskdSupervisor(object):
+
+    """Fork and monitor pools of taskd worker processes.
+
+    Pools are configured in the ini file::
+
+        taskd.pools = mail, repo, default
+        taskd.pool.mail.size = 4
+        taskd.pool.mail.only = allura.tasks.mail_tasks.sendmail,allura.tasks.notification_tasks.notify
+        taskd.pool.repo.size = 2
+        taskd.pool.repo.only = allura.tasks.repo_tasks.refresh
+        taskd.pool.default.size = 4
+
+    A pool without ``only`` handles any task.  ``batch_size`` and
+    ``batch_only`` may be set per pool too, like the taskd options.
+
+    Workers which exit are restarted.  SIGTERM stops all workers gracefully,
+    SIGHUP stops them gracefully and then restarts the supervisor (and so the
+    workers) with fresh code, and SIGUSR1 is passed on to the workers.
+    """
+
+    min_lifetime = 10  # seconds; workers dying faster than this are restarted with a delay
+
+    def __init__(self, command):
+        self.command = command
+        self.keep_running = True
+        self.restart_when_done = False
+        self.children = {}  # pid -> (pool name, start time)
+        self.respawn = []  # [(time, pool name)]
+
+    def pools(self, conf):
+        pools = []
+        for name in aslist(conf.get('taskd.pools', 'default'), ','):
+            prefix = 'taskd.pool.%s.' % name
+            pools.append(dict(
+                name=name,
+                size=asint(conf.get(prefix + 'size', 1)),
+                only=conf.get(prefix + 'only') or None,
+                batch_size=asint(conf.get(prefix + 'batch_size', 1)),
+                batch_only=conf.get(prefix + 'batch_only') or None,
+            ))
+        return pools
+
+    def run(self):
+        setproctitle('taskd:supervisor')
+        config_file = self.command.args[0]
+        conf = appconfig('config:%s' % config_file, relative_to=os.getcwd())
+        logging.config.fileConfig(config_file.split('#')[0], disable_existing_loggers=False)
+        log.info('Starting taskd supervisor, pid %s', os.getpid())
+        self.pools_by_name = {}
+        for pool in self.pools(conf):
+            self.pools_by_name[pool['name']] = pool
+            for i in range(pool['size']):
+                self.spawn(pool['name'])
+        signal.signal(signal.SIGHUP, self.graceful_restart)
+        signal.signal(signal.SIGTERM, self.graceful_stop)
+        signal.signal(signal.SIGUSR1, self.forward_signal)
+        signal.siginterrupt(signal.SIGHUP, False)
+        signal.siginterrupt(signal.SIGTERM, False)
+        signal.siginterrupt(signal.SIGUSR1, False)
+        self.monitor()
+        log.info('taskd supervisor pid %s stopping gracefully.', os.getpid())
+        if self.restart_when_done:
+            log.info('taskd supervisor pid %s restarting itself', os.getpid())
+            os.execv(sys.argv[0], sys.argv)
+
+    def spawn(self, pool_name):
+        pool = self.pools_by_name[pool_name]
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (pool_name, time.time())
+            log.info('Started taskd worker pid %s for pool %s', pid, pool_name)
+            return pid
+        # child: run a regular taskd worker with the pool's settings
+        exit_code = 0
+        try:
+            for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGUSR1):
+                signal.signal(sig, signal.SIG_DFL)
+            cmd = self.command
+            cmd.supervised = True
+            cmd.options.only = pool['only']
+            cmd.options.batch_size = pool['batch_size']
+            cmd.options.batch_only = pool['batch_only']
+            setproctitle('taskd:%s' % pool_name)
+            cmd.basic_setup()
+            cmd.keep_running = True
+            cmd.restart_when_done = False
+            signal.signal(signal.SIGHUP, cmd.graceful_stop)
+            signal.signal(signal.SIGTERM, cmd.graceful_stop)
+            signal.signal(signal.SIGUSR1, cmd.log_current_task)
+            cmd.worker()
+        except Exception:
+            log.exception('taskd worker for pool %s failed', pool_name)
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def monitor(self):
+        while self.children or (self.keep_running and self.respawn):
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:  # no children left
+                pid = 0
+            if pid and pid in self.children:
+                pool_name, started = self.children.pop(pid)
+                if self.keep_running:
+                    log.warning('taskd worker pid %s for pool %s exited with status %s',
+                                pid, pool_name, status)
+                    delay = self.min_lifetime if time.time() - started < self.min_lifetime else 0
+                    self.respawn.append((time.time() + delay, pool_name))
+                continue
+            if self.keep_running:
+                now = time.time()
+                for when, pool_name in [r for r in self.respawn if r[0] <= now]:
+                    self.respawn.remove((when, pool_name))
+                    self.spawn(pool_name)
+            time.sleep(0.5)
+
+    def forward_signal(self, signum, frame):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def graceful_restart(self, signum, frame):
+        log.info('taskd supervisor pid %s recieved signal %s preparing to do a graceful restart',
+                 os.getpid(), signum)
+        self.keep_running = False
+        self.restart_when_done = True
+        self.forward_signal(signal.SIGTERM, frame)
+
+    def graceful_stop(self, signum, frame):
+        log.info('taskd supervisor pid %s recieved signal %s preparing to do a graceful stop',
+                 os.getpid(), signum)
+        self.keep_running = False
+        self.forward_signal(signal.SIGTERM, frame)
+
 
 class TaskCommand(base.Command):
     summary = 'Task command'
@@ -171,9 +374,11 @@ class TaskCommand(base.Command):
                       help='state of processes to examine')
     parser.add_option('-t', '--timeout', dest='timeout', type=int, default=60,
                       help='timeout (in seconds) for busy tasks')
+    parser.add_option('--hours', dest='hours', type=int, default=24,
+                      help='period (in hours) to show stats for')
     min_args = 2
     max_args = None
-    usage = '<ini file> [list|retry|purge|timeout|commit]'
+    usage = '<ini file> [list|retry|purge|timeout|commit|stats]'
 
     def command(self):
         self.basic_setup()
@@ -183,7 +388,8 @@ def command(self):
             retry=self._retry,
             purge=self._purge,
             timeout=self._timeout,
-            commit=self._commit)
+            commit=self._commit,
+            stats=self._stats)
         tab[cmd]()
 
     def _list(self):
@@ -212,6 +418,9 @@ def _purge(self):
         base.log.info('Purge complete/forget tasks')
         M.MonQTask.query.remove(
             dict(state='complete', result_type='forget'))
+        keep_days = asint(tg.config.get('monq.stats_days', 7))
+        base.log.info('Purge task stats older than %s days', keep_days)
+        M.MonQTaskStats.purge(datetime.utcnow() - timedelta(days=keep_days))
 
     def _timeout(self):
         '''Reset tasks that have been busy too long to 'ready' state'''
@@ -226,3 +435,15 @@ def _commit(self):
         from allura.tasks import index_tasks
         base.log.info('Commit to solr')
         index_tasks.commit.post()
+
+    def _stats(self):
+        '''Show wait/run times and failure rates per task name'''
+        from allura import model as M
+        since = datetime.utcnow() - timedelta(hours=self.options.hours)
+        fmt = '%-60s %8s %8s %9s %9s %9s %9s'
+        print(fmt % ('task', 'count', 'errors', 'wait avg', 'wait p95', 'run avg', 'run p95'))
+        for s in M.MonQTaskStats.summary(since):
+            print(fmt % (
+                s['task_name'], s['count'], s['errors'],
+                '%.2f' % s['wait_avg'], s['wait_p95'] if s['wait_p95'] is not None else '-',
+                '%.2f' % s['run_avg'], s['run_p95'] if s['run_p95'] is not None else '-'))
@@ -596,7 +596,6 @@ def reply(self, **kw):
         require_access(self.thread, 'post')
         kw = self.W.edit_post.to_python(kw, None)  # could raise Invalid, but doesn't seem like it ever does
         post = self.thread.post(parent_id=self.post._id, **kw)
-        self.thread.num_replies += 1
         redirect(post.slug.split('/')[-1] + '/')
 
 
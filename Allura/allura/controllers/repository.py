@@ -718,7 +718,7 @@ def tarball(self, **kw):
         rev = self._commit.url().split('/')[-2]
         status = c.app.repo.get_tarball_status(rev, path)
         if not status and request.method == 'POST':
-            allura.tasks.repo_tasks.tarball.post(rev, path)
+            c.app.repo.request_tarball(rev, path)
             redirect('tarball?path={0}'.format(h.urlquote(path) if path else ''))
         return dict(commit=self._commit, revision=rev, status=status)
 
@@ -849,11 +849,13 @@ def index(self, **kw):
         elif 'diff' in kw:
             tg.decorators.override_template(
                 self.index, 'jinja:allura:templates/repo/diff.html')
-            return self.diff(kw['diff'], kw.pop('diformat', None), kw.pop('prev_file', None))
+            return self.diff(kw['diff'], kw.pop('diformat', None), kw.pop('prev_file', None),
+                             full='full' in kw)
         elif 'barediff' in kw:
             tg.decorators.override_template(
                 self.index, 'jinja:allura:templates/repo/barediff.html')
-            return self.diff(kw['barediff'], kw.pop('diformat', None), kw.pop('prev_file', None))
+            return self.diff(kw['barediff'], kw.pop('diformat', None), kw.pop('prev_file', None),
+                             full='full' in kw)
         else:
             force_display = 'force' in kw
             stats = utils.generate_code_stats(self._blob)
@@ -877,11 +879,12 @@ def raw(self, **kw):
             str('attachment;filename="%s"') % h.urlquote(filename))
         return iter(self._blob)
 
-    def diff(self, prev_commit, fmt=None, prev_file=None, **kw):
+    def diff(self, prev_commit, fmt=None, prev_file=None, full=False, **kw):
         '''
         :param prev_commit: previous commit to compare against
         :param fmt: "sidebyside", or anything else for "unified"
         :param prev_file: previous filename, if different
+        :param full: render the diff even if it's over scm.view.diff.max_lines
         :return:
         '''
         try:
@@ -899,27 +902,43 @@ def diff(self, prev_commit, fmt=None, prev_file=None, **kw):
             diff = "Cannot display: file marked as a binary type."
             return dict(a=a, b=b, diff=diff)
 
-        la = list(a)
-        lb = list(b)
-        adesc = ('a' + h.really_unicode(apath)).encode('utf-8')
-        bdesc = ('b' + h.really_unicode(b.path())).encode('utf-8')
-
         if not fmt:
             fmt = web_session.get('diformat', '')
         else:
             web_session['diformat'] = fmt
             web_session.save()
+
+        max_lines = 0 if full else asint(tg.config.get('scm.view.diff.max_lines', 10000))
+        diff = M.repository.cached_diff(
+            ('file_diff', getattr(a, '_id', None), b._id, apath, b.path(), fmt == 'sidebyside', max_lines),
+            lambda: self._make_diff(a, b, apath, fmt, max_lines),
+            max_size=asint(tg.config.get('scm.view.diff_cache.max_bytes', 1000000)),
+            size=lambda diff: len(diff or ''))
+        if diff is None:
+            params = dict(diff=prev_commit, full=1)
+            if prev_file:
+                params['prev_file'] = prev_file
+            return dict(a=a, b=b, diff='', too_large=True,
+                        full_diff_url=b.url() + '?' + utils.urlencode(params))
+        return dict(a=a, b=b, diff=diff)
+
+    def _make_diff(self, a, b, apath, fmt, max_lines=0):
+        '''Returns None if the files have more than max_lines lines in total'''
+        la = list(a)
+        lb = list(b)
+        if max_lines and len(la) + len(lb) > max_lines:
+            return None
+        adesc = ('a' + h.really_unicode(apath)).encode('utf-8')
+        bdesc = ('b' + h.really_unicode(b.path())).encode('utf-8')
+
         if fmt == 'sidebyside':
             if max(a.size, b.size) > asint(tg.config.get('scm.view.max_syntax_highlight_bytes', 500000)):
                 # have to check the original file size, not diff size, because difflib._mdiff inside HtmlSideBySideDiff
                 # can take an extremely long time on large files (and its even a generator)
-                diff = '<em>File too large for side-by-side view</em>'
-            else:
-                hd = HtmlSideBySideDiff()
-                diff = hd.make_table(la, lb, adesc, bdesc)
-        else:
-            diff = str('').join(difflib.unified_diff(la, lb, adesc, bdesc))
-        return dict(a=a, b=b, diff=diff)
+                return '<em>File too large for side-by-side view</em>'
+            hd = HtmlSideBySideDiff()
+            return hd.make_table(la, lb, adesc, bdesc)
+        return str('').join(difflib.unified_diff(la, lb, adesc, bdesc))
 
 
 def topo_sort(children, parents, dates, head_ids):
@@ -614,6 +614,26 @@ def resubmit(self, task_id):
         task.state = 'ready'
         redirect('../view/%s' % task._id)
 
+    def _stats(self, hours):
+        try:
+            hours = int(hours)
+        except ValueError:
+            hours = 24
+        since = datetime.utcnow() - timedelta(hours=hours)
+        return hours, M.MonQTaskStats.summary(since)
+
+    @expose('jinja:allura:templates/site_admin_task_stats.html')
+    @without_trailing_slash
+    def stats(self, hours=24, **kw):
+        """Show queue wait times, run times and failure rates per task name"""
+        hours, stats = self._stats(hours)
+        return dict(hours=hours, stats=stats, buckets=M.MonQTaskStats.buckets)
+
+    @expose('json:')
+    def stats_json(self, hours=24, **kw):
+        hours, stats = self._stats(hours)
+        return dict(hours=hours, buckets=M.MonQTaskStats.buckets, stats=stats)
+
     @expose('json:')
     def task_doc(self, task_name, **kw):
         """Return a task's docstring"""
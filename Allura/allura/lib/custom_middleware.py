@@ -373,6 +373,9 @@ def timers(self):
     def before_logging(self, stat_record):
         if hasattr(c, "app") and hasattr(c.app, "config"):
             stat_record.add('request_category', c.app.config.tool_name.lower())
+        model_cache = allura.model.repository.SharedModelCache.get_instance()
+        if model_cache is not None:
+            stat_record.add('model_cache', model_cache.pop_thread_stats())
         return stat_record
 
     @classmethod
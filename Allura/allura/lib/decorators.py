@@ -67,6 +67,20 @@ def myotherfunc():
             # No email notifications will be sent for c.project during this task
             pass
 
+        @task(coalesce='union')
+        def mylistfunc(ids):
+            # Posting this while an identical task is still pending adds ``ids``
+            # to the pending task instead of queueing another one.
+            # Use coalesce='drop' to just skip duplicate posts.
+            pass
+
+        @task(coalesce='union', ordered_with=['mymodule.mylistfunc'])
+        def myundofunc(ids):
+            # Like above, but ``ids`` aren't added to a pending task which was
+            # posted before a pending ``mylistfunc`` task (and vice versa, if
+            # ``mylistfunc`` lists this one), so they still run in order.
+            pass
+
     """
     def task_(func):
         def post(*args, **kwargs):
@@ -77,7 +91,8 @@ def post(*args, **kwargs):
                   kw.get('notifications_disabled') else h.null_contextmanager)
             with cm(project):
                 from allura import model as M
-                return M.MonQTask.post(func, args, kwargs, delay=delay, flush_immediately=flush_immediately)
+                return M.MonQTask.post(func, args, kwargs, delay=delay, flush_immediately=flush_immediately,
+                                       coalesce=kw.get('coalesce'), ordered_with=kw.get('ordered_with'))
         # if decorating a class, have to make it a staticmethod
         # or it gets a spurious cls argument
         func.post = staticmethod(post) if inspect.isclass(func) else post
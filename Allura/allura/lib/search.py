@@ -18,7 +18,9 @@
 from __future__ import unicode_literals
 from __future__ import absolute_import
 import re
+import json
 import socket
+import hashlib
 from logging import getLogger
 
 
@@ -90,8 +92,25 @@ def should_update_index(self, old_doc, new_doc):
         """
         return old_doc != new_doc
 
-    def solarize(self):
-        doc = self.index()
+    @staticmethod
+    def index_hash(doc):
+        """
+        Return a hash of an :meth:`index` doc, to tell whether it has changed
+        since it was last sent to solr.
+        """
+        data = json.dumps(doc, sort_keys=True, default=six.text_type)
+        return hashlib.sha1(six.ensure_binary(data)).hexdigest()
+
+    def solarize(self, doc=None):
+        """
+        Return the :meth:`index` doc, with text converted from markdown to
+        plain text, for sending to Solr.
+
+        Pass ``doc`` if you already have the result of :meth:`index` to avoid
+        computing it again.  It is modified in place.
+        """
+        if doc is None:
+            doc = self.index()
         if doc is None:
             return None
         # if index() returned doc without text, assume empty text
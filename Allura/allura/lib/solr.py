@@ -17,10 +17,15 @@
 
 from __future__ import unicode_literals
 from __future__ import absolute_import
+import os
 import logging
+import threading
+import time
+from glob import glob
 
 from tg import config
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
+from six.moves.cPickle import dumps, loads
 import pysolr
 import six
 
@@ -95,34 +100,236 @@ def __init__(self, push_servers, query_server=None,
         self._commit = commit
         self.commitWithin = commitWithin
 
+    def _push(self, method, *args, **kw):
+        '''Call ``method`` on every push server, concurrently if there are
+        several.  Raises the first error, after all servers have answered.'''
+        if len(self.push_pool) == 1:
+            return [getattr(self.push_pool[0], method)(*args, **kw)]
+        responses = [None] * len(self.push_pool)
+        errors = []
+
+        def push(i, solr):
+            try:
+                responses[i] = getattr(solr, method)(*args, **kw)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=push, args=(i, solr)) for i, solr in enumerate(self.push_pool)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return responses
+
     def add(self, *args, **kw):
         if 'commit' not in kw:
             kw['commit'] = self._commit
         if self.commitWithin and 'commitWithin' not in kw:
             kw['commitWithin'] = self.commitWithin
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.add(*args, **kw))
-        return responses
+        return self._push('add', *args, **kw)
 
     def delete(self, *args, **kw):
         if 'commit' not in kw:
             kw['commit'] = self._commit
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.delete(*args, **kw))
-        return responses
+        return self._push('delete', *args, **kw)
 
     def commit(self, *args, **kw):
-        responses = []
-        for solr in self.push_pool:
-            responses.append(solr.commit(*args, **kw))
-        return responses
+        return self._push('commit', *args, **kw)
 
     def search(self, *args, **kw):
         return self.query_server.search(*args, **kw)
 
 
+def make_buffered_solr_from_config(solr):
+    """
+    Wrap a :class:`Solr <Solr>` (or :class:`MockSOLR`) instance in a
+    :class:`BufferedSolr` configured by ``solr.buffer.*`` settings.
+    """
+    return BufferedSolr(
+        solr,
+        max_docs=asint(config.get('solr.buffer.max_docs', 500)),
+        max_age=asint(config.get('solr.buffer.max_age', 10)),
+        retries=asint(config.get('solr.buffer.retries', 3)),
+        spool_dir=config.get('solr.buffer.spool_dir') or None,
+        spool_attempts=asint(config.get('solr.buffer.spool_attempts', 10)),
+    )
+
+
+class BufferedSolr(object):
+
+    """Collect docs passed to :meth:`add` and send them to Solr together.
+
+    Docs are sent when ``max_docs`` are buffered, or when :meth:`flush_if_due`
+    is called and the oldest buffered doc is older than ``max_age`` seconds.
+    Deletes and commits flush the buffer first, so they apply after earlier
+    adds.  Sending is retried ``retries`` times; if it still fails the docs
+    stay buffered (and the error is raised), or if ``spool_dir`` is set, the
+    docs are saved there instead.
+
+    Spooled docs are resent, oldest first, before any newer docs are sent, so
+    they never overwrite newer versions of the same docs.  A spool file which
+    fails to send ``spool_attempts`` times in a row (e.g. due to a bad doc) is
+    moved to the ``failed`` subdirectory of ``spool_dir``, from where it can
+    be moved back once fixed.
+
+    ``on_sent`` callbacks passed to :meth:`add` are called once its docs have
+    been sent (and not if they are spooled).
+
+    The owner (e.g. taskd) must call :meth:`flush` before exiting.
+    """
+
+    def __init__(self, solr, max_docs=500, max_age=10, retries=3, spool_dir=None, spool_attempts=10):
+        self.solr = solr
+        self.max_docs = max_docs
+        self.max_age = max_age
+        self.retries = retries
+        self.spool_dir = spool_dir
+        self.spool_attempts = spool_attempts
+        self.buffer = []
+        self.callbacks = []
+        self.buffered_since = None
+        self._spool_failures = {}
+        self._lock = threading.RLock()
+
+    def add(self, docs, on_sent=None, **kw):
+        if kw:
+            # unusual options (e.g. explicit commit), don't mix with buffered docs
+            self.flush()
+            result = self.solr.add(docs, **kw)
+            if on_sent:
+                on_sent()
+            return result
+        with self._lock:
+            if not self.buffer:
+                self.buffered_since = time.time()
+            self.buffer.extend(docs)
+            if on_sent:
+                self.callbacks.append(on_sent)
+            if len(self.buffer) >= self.max_docs:
+                self.flush()
+        return []
+
+    def flush_if_due(self):
+        with self._lock:
+            if self.buffer and time.time() - self.buffered_since >= self.max_age:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self.spool_dir and not self._send_spooled():
+                # older docs are still waiting to be resent, so queue these
+                # up behind them instead of sending them first
+                if self.buffer:
+                    self._spool(self.buffer)
+                    self._clear()
+                return
+            if not self.buffer:
+                return
+            try:
+                self._send(self.buffer)
+            except Exception:
+                if not self.spool_dir:
+                    raise  # keep them buffered, for the next flush
+                log.exception('Error sending %d docs to solr, spooling to %s', len(self.buffer), self.spool_dir)
+                self._spool(self.buffer)
+                self._clear()
+                return
+            callbacks = self.callbacks
+            self._clear()
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    log.exception('Error in callback after sending docs to solr')
+
+    def _clear(self):
+        self.buffer = []
+        self.callbacks = []
+        self.buffered_since = None
+
+    def _send(self, docs):
+        for attempt in range(self.retries + 1):
+            try:
+                return self.solr.add(docs)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                log.warning('Error sending %d docs to solr, retrying', len(docs), exc_info=True)
+                time.sleep(2 ** attempt)
+
+    def _spool(self, docs):
+        if not os.path.isdir(self.spool_dir):
+            os.makedirs(self.spool_dir)
+        name = '%f-%d.pickle' % (time.time(), os.getpid())
+        tmp = os.path.join(self.spool_dir, name + '.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(dumps(docs, 2))
+        os.rename(tmp, os.path.join(self.spool_dir, name))
+
+    def _send_spooled(self):
+        """
+        Resend the spooled docs, oldest first, trying each file once.
+        Returns whether they've all been sent (or moved aside).
+        """
+        for filename in sorted(glob(os.path.join(self.spool_dir, '*.pickle'))):
+            try:
+                with open(filename, 'rb') as f:
+                    data = f.read()
+            except (IOError, OSError):
+                continue  # sent by another process in the meantime
+            try:
+                docs = loads(data)
+            except Exception:
+                log.exception('Unreadable solr spool file %s', filename)
+                self._move_aside(filename)
+                continue
+            try:
+                self.solr.add(docs)
+            except Exception:
+                failures = self._spool_failures.get(filename, 0) + 1
+                if failures < self.spool_attempts:
+                    self._spool_failures[filename] = failures
+                    log.warning('Error resending %d spooled docs from %s to solr',
+                                len(docs), filename, exc_info=True)
+                    return False
+                log.exception('Error resending %d spooled docs from %s to solr %d times, giving up',
+                              len(docs), filename, failures)
+                self._move_aside(filename)
+                continue
+            self._spool_failures.pop(filename, None)
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        return True
+
+    def _move_aside(self, filename):
+        self._spool_failures.pop(filename, None)
+        failed_dir = os.path.join(self.spool_dir, 'failed')
+        if not os.path.isdir(failed_dir):
+            os.makedirs(failed_dir)
+        try:
+            os.rename(filename, os.path.join(failed_dir, os.path.basename(filename)))
+        except OSError:
+            pass  # moved by another process
+
+    def delete(self, *args, **kw):
+        self.flush()
+        return self.solr.delete(*args, **kw)
+
+    def commit(self, *args, **kw):
+        self.flush()
+        return self.solr.commit(*args, **kw)
+
+    def search(self, *args, **kw):
+        return self.solr.search(*args, **kw)
+
+    def __getattr__(self, name):
+        return getattr(self.solr, name)
+
+
 class MockSOLR(object):
 
     class MockHits(list):
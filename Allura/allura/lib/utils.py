@@ -28,6 +28,7 @@
 import codecs
 import os.path
 import datetime
+import difflib
 import random
 import mimetypes
 import re
@@ -173,6 +174,80 @@ def chunked_find(cls, query=None, pagesize=1024, sort_key='_id', sort_dir=1):
         page += 1
 
 
+class BulkWriter(object):
+    '''
+    Collect writes against a ming collection (e.g. ``CommitDoc``) and send
+    them to mongo as (unordered) bulk operations, ``chunk_size`` ops at a time.
+
+    Pass ``ordered=True`` when later ops depend on earlier ones having been
+    applied.  Falls back to one write per op when the underlying collection
+    doesn't support bulk operations (e.g. mim, in tests).
+    '''
+
+    def __init__(self, doc_cls, chunk_size=1000, ordered=False):
+        self.collection = doc_cls.m.session.db[doc_cls.m.collection_name]
+        self.chunk_size = chunk_size
+        self.ordered = ordered
+        self.ops = []
+
+    def insert(self, doc):
+        self._add(('insert', dict(doc)))
+
+    def replace(self, spec, doc, upsert=True):
+        self._add(('replace', spec, dict(doc), upsert))
+
+    def update(self, spec, update, multi=False, upsert=False):
+        self._add(('update', spec, update, multi, upsert))
+
+    def _add(self, write):
+        self.ops.append(write)
+        if len(self.ops) >= self.chunk_size:
+            self.execute()
+
+    def execute(self):
+        writes, self.ops = self.ops, []
+        if not writes:
+            return
+        if hasattr(self.collection, 'initialize_unordered_bulk_op'):
+            self._execute_bulk(writes)
+        else:
+            self._execute_each(writes)
+
+    def _execute_bulk(self, writes):
+        if self.ordered:
+            bulk = self.collection.initialize_ordered_bulk_op()
+        else:
+            bulk = self.collection.initialize_unordered_bulk_op()
+        for write in writes:
+            if write[0] == 'insert':
+                bulk.insert(write[1])
+            elif write[0] == 'replace':
+                _, spec, doc, upsert = write
+                view = bulk.find(spec)
+                (view.upsert() if upsert else view).replace_one(doc)
+            else:
+                _, spec, update, multi, upsert = write
+                view = bulk.find(spec)
+                if upsert:
+                    view = view.upsert()
+                if multi:
+                    view.update(update)
+                else:
+                    view.update_one(update)
+        bulk.execute()
+
+    def _execute_each(self, writes):
+        for write in writes:
+            if write[0] == 'insert':
+                self.collection.insert(write[1])
+            elif write[0] == 'replace':
+                _, spec, doc, upsert = write
+                self.collection.update(spec, doc, upsert=upsert)
+            else:
+                _, spec, update, multi, upsert = write
+                self.collection.update(spec, update, multi=multi, upsert=upsert)
+
+
 def lsub_utf8(s, n):
     '''Useful for returning n bytes of a UTF-8 string, rather than characters'''
     byte2int = ord if six.PY2 else int
@@ -199,6 +274,32 @@ def chunked_iter(iterable, max_size):
         yield (x for i, x in chunk)
 
 
+def text_delta(old, new):
+    '''
+    Return a line-based delta from text `old` to text `new`, as a list of
+    [start, end, text] ops, each replacing lines start:end of `old` with text.
+    '''
+    a = old.splitlines(True)
+    b = new.splitlines(True)
+    matcher = difflib.SequenceMatcher(None, a, b)
+    return [[i1, i2, ''.join(b[j1:j2])]
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+            if tag != 'equal']
+
+
+def apply_text_delta(old, ops):
+    '''Rebuild the new text from text `old` and the ops from text_delta'''
+    a = old.splitlines(True)
+    result = []
+    pos = 0
+    for start, end, text in ops:
+        result.extend(a[pos:start])
+        result.append(text)
+        pos = end
+    result.extend(a[pos:])
+    return ''.join(result)
+
+
 class AntiSpam(object):
 
     '''Helper class for bot-protecting forms'''
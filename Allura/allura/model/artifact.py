@@ -22,13 +22,15 @@
 from datetime import datetime
 
 import pymongo
+import tg
 from tg import tmpl_context as c, app_globals as g
 from tg import request
 from ming import schema as S
-from ming.orm import state, session
+from ming.orm import state, session, mapper
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty
 from ming.orm.declarative import MappedClass
 from ming.utils import LazyProperty
+from paste.deploy.converters import asint
 import feedgenerator as FG
 
 from allura.lib import helpers as h
@@ -487,10 +489,27 @@ def count_in_app():
         return False
 
 
+class SnapshotDataProperty(FieldProperty):
+    """
+    The `data` of a :class:`Snapshot`, with any delta-encoded text fields
+    rebuilt on first access.
+    """
+
+    def __get__(self, instance, cls=None):
+        if instance is not None:
+            instance._expand_delta()
+        return super(SnapshotDataProperty, self).__get__(instance, cls)
+
+
 class Snapshot(Artifact):
     """
     A snapshot of an :class:`Artifact <allura.model.artifact.Artifact>`,
     used in :class:`VersionedArtifact <allura.model.artifact.VersionedArtifact>`
+
+    When artifact.snapshot.keyframe_interval is set, text fields of a snapshot
+    may be stored as a delta against the previous version instead of in `data`:
+    `delta` is then {'keyframe': version, 'fields': {name: text_delta ops}},
+    keyframe being the last earlier version stored without a delta.
     """
     class __mongometa__:
         session = artifact_orm_session
@@ -510,7 +529,69 @@ class __mongometa__:
         display_name=str,
         logged_ip=str))
     timestamp = FieldProperty(datetime)
-    data = FieldProperty(None)
+    data = SnapshotDataProperty(None)
+    delta = FieldProperty(None, if_missing=None)
+
+    @staticmethod
+    def encode_delta(data, prev_data, keyframe):
+        """
+        Return the (data, delta) to store for a snapshot of `data`, with text
+        fields stored as deltas against the (full) `prev_data` of the previous
+        version where that saves at least half their size.  delta is None if
+        no field was worth it.
+        """
+        data = dict(data)
+        fields = {}
+        for name, value in six.iteritems(data):
+            old = prev_data.get(name)
+            if not (value and isinstance(value, six.string_types) and isinstance(old, six.string_types)):
+                continue
+            ops = utils.text_delta(old, value)
+            if sum(len(text) + 16 for start, end, text in ops) < len(value) // 2:
+                fields[name] = ops
+        if not fields:
+            return data, None
+        for name in fields:
+            del data[name]
+        return data, dict(keyframe=keyframe, fields=fields)
+
+    @staticmethod
+    def full_text_fields(docs):
+        """
+        Return the full text fields of the last of `docs`, raw snapshot docs
+        in version order starting with a keyframe.
+        """
+        texts = {}
+        for doc in docs:
+            data = doc.get('data') or {}
+            fields = (doc.get('delta') or {}).get('fields') or {}
+            for name, ops in six.iteritems(fields):
+                if name not in data:
+                    texts[name] = utils.apply_text_delta(texts.get(name, ''), ops)
+            for name, value in six.iteritems(data):
+                if isinstance(value, six.string_types):
+                    texts[name] = value
+        return texts
+
+    def _expand_delta(self):
+        doc = state(self).document
+        delta = doc.get('delta')
+        data = doc.get('data')
+        if not delta or data is None:
+            return
+        missing = [name for name in delta['fields'] if name not in data]
+        if not missing:
+            return
+        collection = session(self).impl.db[mapper(self.__class__).collection.m.collection_name]
+        chain = collection.find({
+            'artifact_id': doc['artifact_id'],
+            'artifact_class': doc['artifact_class'],
+            'version': {'$gte': delta['keyframe'], '$lt': doc['version']},
+        }).sort('version', pymongo.ASCENDING)
+        texts = self.full_text_fields(list(chain) + [doc])
+        # fill in the raw document, so this doesn't count as a change to flush
+        for name in missing:
+            data[name] = texts[name]
 
     def index(self):
         result = Artifact.index(self)
@@ -592,10 +673,14 @@ def commit(self, update_stats=True):
                 display_name=c.user.get_pref('display_name'),
                 logged_ip=ip_address),
             data=state(self).clone())
+        full_data = data['data']
+        keyframe_interval = asint(tg.config.get('artifact.snapshot.keyframe_interval', 0))
         while True:
             self.version += 1
             data['version'] = self.version
             data['timestamp'] = datetime.utcnow()
+            if keyframe_interval:
+                data['data'], data['delta'] = self._encode_snapshot(full_data, keyframe_interval)
             ss = self.__mongometa__.history_class(**data)
             try:
                 session(ss).insert_now(ss, state(ss))
@@ -617,6 +702,21 @@ def commit(self, update_stats=True):
                     self.type_s, self.mod_date, self.project, c.user)
         return ss
 
+    def _encode_snapshot(self, full_data, keyframe_interval):
+        """
+        Return the (data, delta) to store for the snapshot of `full_data` as
+        the current version, making it a keyframe every `keyframe_interval`
+        versions.
+        """
+        try:
+            prev = self.get_version(self.version - 1)
+        except IndexError:
+            return full_data, None
+        keyframe = prev.delta.keyframe if prev.delta else prev.version
+        if self.version - keyframe >= keyframe_interval:
+            return full_data, None
+        return prev.encode_delta(full_data, prev.data, keyframe)
+
     def get_version(self, n):
         if n < 0:
             n = self.version + n + 1
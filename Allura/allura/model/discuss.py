@@ -49,6 +49,51 @@
 log = logging.getLogger(__name__)
 
 
+def _update_stats(obj, inc):
+    '''
+    Atomically $inc the given counters of a Discussion or Thread `obj`.
+    Returns `obj` refreshed from the database.
+    '''
+    session(obj).flush(obj)  # the refresh would drop unflushed changes
+    return obj.query.find_and_modify(
+        query={'_id': obj._id}, update={'$inc': inc}, new=True)
+
+
+def _set_last_post(obj, post):
+    '''
+    Make `post` the last post of `obj`, unless a later one already is.
+    Posts are ordered by timestamp, as in _find_last_post.
+    '''
+    session(obj).flush(obj)
+    obj.query.find_and_modify(
+        query={'_id': obj._id,
+               '$or': [{'last_post_date': None}, {'last_post_date': {'$lte': post.timestamp}}]},
+        update={'$set': {'last_post_id': post._id, 'last_post_date': post.timestamp}},
+        new=True)
+
+
+def _unset_last_post(obj, post):
+    '''If `post` is the last post of `obj`, find the one before it'''
+    if obj.last_post_id != post._id:
+        return
+    prev = obj._find_last_post()
+    session(obj).flush(obj)
+    obj.query.find_and_modify(
+        query={'_id': obj._id, 'last_post_id': post._id},
+        update={'$set': {'last_post_id': prev._id if prev else None}},
+        new=True)
+
+
+def _prefetch_last_posts(objs, post_class):
+    ids = [obj.last_post_id for obj in objs if obj.last_post_id]
+    if not ids:
+        return
+    posts = {p._id: p for p in post_class.query.find({'_id': {'$in': ids}})}
+    for obj in objs:
+        if obj.last_post_id:
+            obj.last_post = posts.get(obj.last_post_id)
+
+
 class Discussion(Artifact, ActivityObject):
 
     class __mongometa__:
@@ -62,6 +107,8 @@ class __mongometa__:
     description_cache = FieldProperty(MarkdownCache)
     num_topics = FieldProperty(int, if_missing=0)
     num_posts = FieldProperty(int, if_missing=0)
+    last_post_id = FieldProperty(str, if_missing=None)
+    last_post_date = FieldProperty(datetime, if_missing=None)
     subscriptions = FieldProperty({str: bool})
 
     threads = RelationProperty('Thread', via='discussion_id')
@@ -94,13 +141,19 @@ def attachment_class(cls):
         return DiscussionAttachment
 
     def update_stats(self):
+        """
+        Recount the stats that Thread.count_post maintains as posts come and go.
+        """
         self.num_topics = self.thread_class().query.find(
-            dict(discussion_id=self._id)).count()
+            dict(discussion_id=self._id, num_replies={'$gt': 0})).count()
         self.num_posts = self.post_class().query.find(
             dict(discussion_id=self._id, status='ok', deleted=False)).count()
+        last_post = self._find_last_post()
+        self.last_post_id = last_post._id if last_post else None
+        if last_post:
+            self.last_post_date = last_post.timestamp
 
-    @LazyProperty
-    def last_post(self):
+    def _find_last_post(self):
         q = self.post_class().query.find(dict(
             discussion_id=self._id,
             status='ok',
@@ -108,6 +161,17 @@ def last_post(self):
         )).sort('timestamp', pymongo.DESCENDING).limit(1)
         return q.first()
 
+    @LazyProperty
+    def last_post(self):
+        if self.last_post_id:
+            return self.post_class().query.get(_id=self.last_post_id)
+        return self._find_last_post()  # stats not reconciled yet
+
+    @classmethod
+    def prefetch_last_posts(cls, discussions):
+        """Load `last_post` of all `discussions` (e.g. on a listing page) in one query"""
+        _prefetch_last_posts(discussions, cls.post_class())
+
     def url(self):
         return self.app.url + '_discuss/'
 
@@ -156,6 +220,7 @@ class __mongometa__:
     num_views = FieldProperty(int, if_missing=0)
     subscriptions = FieldProperty({str: bool})
     first_post_id = ForeignIdProperty('Post')
+    last_post_id = FieldProperty(str, if_missing=None)
     last_post_date = FieldProperty(datetime, if_missing=datetime(1970, 1, 1))
     artifact_reference = FieldProperty(schema.Deprecated)
     artifact_id = FieldProperty(schema.Deprecated)
@@ -282,7 +347,6 @@ def add_post(self, **kw):
         p = self.post(**kw)
         p.commit(update_stats=False)
         session(self).flush(self)
-        self.update_stats()
         if not self.first_post:
             self.first_post_id = p._id
         self.post_to_feed(p)
@@ -377,18 +441,58 @@ def notify_moderators(self, post):
                                        app_config_id=post.app_config_id)):
                     n.send_direct(str(u._id))
 
+    def count_post(self, post, inc):
+        """
+        Count an approved `post` in (inc=1) or out (inc=-1) of the stats of
+        this thread and its discussion, with atomic updates.
+        """
+        thread = _update_stats(self, {'num_replies': inc})
+        discussion = self.discussion
+        if discussion:
+            topics = 0
+            if inc > 0 and thread.num_replies == 1:
+                topics = 1
+            elif inc < 0 and thread.num_replies == 0:
+                topics = -1
+            _update_stats(discussion, {'num_posts': inc, 'num_topics': topics})
+        for obj in (self, discussion):
+            if obj is None:
+                continue
+            if inc > 0:
+                _set_last_post(obj, post)
+            else:
+                _unset_last_post(obj, post)
+
     def update_stats(self):
+        """
+        Recount the stats that count_post maintains as posts come and go.
+        """
         self.num_replies = self.post_class().query.find(
             dict(thread_id=self._id, status='ok', deleted=False)).count()
+        last_post = self._find_last_post()
+        self.last_post_id = last_post._id if last_post else None
+        if last_post:
+            self.last_post_date = last_post.timestamp
 
-    @LazyProperty
-    def last_post(self):
+    def _find_last_post(self):
         q = self.post_class().query.find(dict(
             thread_id=self._id,
+            status='ok',
             deleted=False,
         )).sort('timestamp', pymongo.DESCENDING)
         return q.first()
 
+    @LazyProperty
+    def last_post(self):
+        if self.last_post_id:
+            return self.post_class().query.get(_id=self.last_post_id)
+        return self._find_last_post()  # stats not reconciled yet
+
+    @classmethod
+    def prefetch_last_posts(cls, threads):
+        """Load `last_post` of all `threads` (e.g. on a listing page) in one query"""
+        _prefetch_last_posts(threads, cls.post_class())
+
     def create_post_threads(self, posts):
         result = []
         post_index = {}
@@ -402,7 +506,11 @@ def create_post_threads(self, posts):
         return result
 
     def query_posts(self, page=None, limit=None,
-                    timestamp=None, style='threaded', status=None):
+                    timestamp=None, style='threaded', status=None, before=None):
+        """
+        Query the posts of this thread in display order.  If `before` is a
+        post, only those displayed before it.
+        """
         if timestamp:
             terms = dict(discussion_id=self.discussion_id, thread_id=self._id,
                          status={'$in': ['ok', 'pending']}, timestamp=timestamp)
@@ -412,6 +520,9 @@ def query_posts(self, page=None, limit=None,
         if status:
             terms['status'] = status
         terms['deleted'] = False
+        if before is not None:
+            sort_key = 'full_slug' if style == 'threaded' else 'timestamp'
+            terms[sort_key] = {'$lt': getattr(before, sort_key)}
         q = self.post_class().query.find(terms)
         if style == 'threaded':
             q = q.sort('full_slug')
@@ -501,7 +612,9 @@ class __mongometa__:
         indexes = [
             # used in general lookups, last_post, etc
             ('discussion_id', 'status', 'timestamp'),
-            'thread_id'
+            'thread_id',
+            # thread display order, and post positions in it for url_paginated
+            ('thread_id', 'full_slug'),
         ]
     type_s = 'Post'
 
@@ -687,24 +800,9 @@ def url_paginated(self):
             # all posts in a single page
             page = 0
         else:
-            posts = self.thread.find_posts()
-            posts = self.thread.create_post_threads(posts)
-
-            def find_i(posts):
-                '''Find the index number of this post in the display order'''
-                q = []
-
-                def traverse(posts):
-                    for p in posts:
-                        if p['post']._id == self._id:
-                            return True  # found
-                        q.append(p)
-                        if traverse(p['children']):
-                            return True
-                traverse(posts)
-                return len(q)
-
-            page = find_i(posts) // limit
+            # replies' full_slugs extend their parent's, so sorting by
+            # full_slug gives the threaded display order
+            page = self.thread.query_posts(before=self).count() // limit
 
         slug = h.urlquote(self.slug)
         url = self.main_url()
@@ -728,9 +826,11 @@ def reply_subject(self):
             return 'Re: ' + (self.subject or '(no subject)')
 
     def delete(self):
+        counted = self.status == 'ok' and not self.deleted
         self.deleted = True
         session(self).flush(self)
-        self.thread.update_stats()
+        if counted:
+            self.thread.count_post(self, -1)
 
     def approve(self, file_info=None, notify=True, notification_text=None):
         if self.status == 'ok':
@@ -751,12 +851,8 @@ def approve(self, file_info=None, notify=True, notification_text=None):
             self.notify(file_info=file_info, notification_text=notification_text)
         artifact = self.thread.artifact or self.thread
         session(self).flush()
-        self.thread.last_post_date = max(
-            self.thread.last_post_date,
-            self.mod_date)
-        self.thread.update_stats()
-        if hasattr(artifact, 'update_stats'):
-            artifact.update_stats()
+        if not self.deleted:
+            self.thread.count_post(self, 1)
         if self.text and not self.is_meta:
             g.director.create_activity(author, 'posted', self, target=artifact,
                                        related_nodes=[self.app_config.project],
@@ -800,17 +896,22 @@ def notify(self, file_info=None, notification_text=None):
                 n.send_simple(artifact.monitoring_email)
 
     def spam(self, submit_spam_feedback=True):
+        counted = self.status == 'ok' and not self.deleted
         self.status = 'spam'
         if submit_spam_feedback:
             g.spam_checker.submit_spam(self.text, artifact=self, user=self.author())
         session(self).flush(self)
-        self.thread.update_stats()
+        if counted:
+            self.thread.count_post(self, -1)
 
     def undo(self, prev_status):
         if prev_status in ('ok', 'pending'):
+            counted = self.status == 'ok' and not self.deleted
             self.status = prev_status
             session(self).flush(self)
-            self.thread.update_stats()
+            now_counted = self.status == 'ok' and not self.deleted
+            if now_counted != counted:
+                self.thread.count_post(self, 1 if now_counted else -1)
 
 
 class DiscussionAttachment(BaseAttachment):
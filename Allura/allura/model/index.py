@@ -19,6 +19,7 @@
 from __future__ import absolute_import
 import re
 import logging
+from datetime import datetime
 from itertools import groupby
 from six.moves.cPickle import dumps, loads
 from collections import defaultdict
@@ -35,6 +36,7 @@
 from ming.orm import ForeignIdProperty, RelationProperty
 
 from allura.lib import helpers as h
+from allura.lib import utils
 
 from .session import main_doc_session, main_orm_session
 from .project import Project
@@ -52,6 +54,8 @@
         app_config_id=S.ObjectId(),
         artifact_id=S.Anything(if_missing=None))),
     Field('references', [str], index=True),
+    # hash of the artifact's index() doc last sent to solr, to skip unchanged docs
+    Field('solr_hash', str, if_missing=None),
     Index('artifact_reference.project_id'),  # used in ReindexCommand
 )
 
@@ -69,6 +73,21 @@
     Index('project_id', 'link'),
 )
 
+# Progress of a (possibly sharded) reindex run, so it can be resumed
+ReindexCheckpointDoc = collection(
+    str('reindex_checkpoint'), main_doc_session,
+    Field('_id', str),  # run name, shard and number of shards
+    Field('run', str),
+    Field('shard', int, if_missing=None),
+    Field('shards', int),
+    # reference ids at which shards 1..n start, on the run's doc (no shard)
+    Field('bounds', [str], if_missing=None),
+    Field('last_ref_id', str, if_missing=None),
+    Field('count', int, if_missing=0),
+    Field('done', bool, if_missing=False),
+    Field('mod_date', datetime, if_missing=datetime.utcnow),
+)
+
 # Class definitions
 
 
@@ -94,6 +113,59 @@ def from_artifact(cls, artifact):
             session(obj).expunge(obj)
             return cls.query.get(_id=artifact.index_id())
 
+    @classmethod
+    def artifacts_by_ref(cls, refs):
+        '''Look up the artifacts for many references at once, with one query
+        per artifact class and project.  Returns a dict of reference _id to
+        artifact (or None if it could not be loaded).'''
+        groups = defaultdict(list)
+        for ref in refs:
+            aref = ref.artifact_reference
+            groups[(aref.project_id, six.binary_type(aref.cls))].append(ref)
+        result = {}
+        for (project_id, cls_pickle), group in six.iteritems(groups):
+            artifact_ids = [ref.artifact_reference.artifact_id for ref in group]
+            by_id = {}
+            try:
+                artifact_cls = loads(cls_pickle)
+                with h.push_context(project_id):
+                    by_id = dict((a._id, a) for a in artifact_cls.query.find(dict(_id={'$in': artifact_ids})))
+            except:
+                log.exception('Error loading artifacts for %s', [ref._id for ref in group])
+            for ref in group:
+                result[ref._id] = by_id.get(ref.artifact_reference.artifact_id)
+        return result
+
+    @classmethod
+    def set_references(cls, references_by_ref):
+        '''Save the ``references`` of many ArtifactReferences, given a dict of
+        reference _id to list of referenced _ids.  References with the same
+        list (most commonly, none) are updated together.'''
+        ref_ids_by_refs = defaultdict(list)
+        for ref_id, references in six.iteritems(references_by_ref):
+            ref_ids_by_refs[tuple(references)].append(ref_id)
+        for references, ref_ids in six.iteritems(ref_ids_by_refs):
+            ArtifactReferenceDoc.m.update_partial(
+                {'_id': {'$in': ref_ids}},
+                {'$set': {'references': list(references)}},
+                multi=True)
+
+    @classmethod
+    def set_solr_hashes(cls, hashes_by_ref):
+        '''Save the hashes of docs sent to solr, given a dict of reference _id
+        to hash.'''
+        writer = utils.BulkWriter(ArtifactReferenceDoc)
+        for ref_id, solr_hash in six.iteritems(hashes_by_ref):
+            writer.update({'_id': ref_id}, {'$set': {'solr_hash': solr_hash}})
+        writer.execute()
+
+    @classmethod
+    def clear_solr_hashes(cls, query):
+        '''Forget the hashes of docs sent to solr (e.g. because they have been
+        deleted from solr), so they are sent again on the next index.'''
+        query = dict(query, solr_hash={'$ne': None})
+        ArtifactReferenceDoc.m.update_partial(query, {'$set': {'solr_hash': None}}, multi=True)
+
     @LazyProperty
     def artifact(self):
         '''Look up the artifact referenced'''
@@ -17,8 +17,11 @@
 
 from __future__ import unicode_literals
 from __future__ import absolute_import
+import os
 import sys
 import time
+import hashlib
+import threading
 import traceback
 import logging
 from datetime import datetime, timedelta
@@ -26,7 +29,8 @@
 import pymongo
 from tg import tmpl_context as c, app_globals as g
 from tg import config
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
+import six
 
 import ming
 from ming.utils import LazyProperty
@@ -35,11 +39,135 @@
 from ming.orm.declarative import MappedClass
 
 from allura.lib.helpers import log_output, null_contextmanager
-from .session import task_orm_session
+from .session import task_orm_session, task_doc_session
 
 log = logging.getLogger(__name__)
 
 
+class LocalTaskNotifier(object):
+
+    '''Wake up waiting workers in the same process when a task is posted.
+
+    Only useful when the poster and the workers share a process (tests, or
+    running tasks in threads during development).
+    '''
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._posted = 0
+
+    def notify(self, task):
+        with self._cond:
+            self._posted += 1
+            self._cond.notify_all()
+
+    def wait(self, timeout, only=None):
+        '''Block until a task is posted or timeout seconds have elapsed.
+        Returns True if woken by a new task.'''
+        with self._cond:
+            seen = self._posted
+            self._cond.wait(timeout)
+            return self._posted != seen
+
+
+class CappedCollectionTaskNotifier(object):
+
+    '''Wake up waiting workers across processes and hosts by tailing a small
+    capped collection in the task database.
+
+    :meth:`MonQTask.post` inserts a tiny document here for each new task, and
+    idle workers block on a tailable, await_data cursor instead of repeatedly
+    querying the ``monq_task`` collection.
+    '''
+
+    collection_name = str('monq_notify')
+
+    stale_after = 1.0
+
+    def __init__(self, size=1024 * 1024):
+        self.size = size
+        self._collection = None
+        self._cursor = None
+        self._cursor_only = None
+        self._last_id = None
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            db = task_doc_session.db
+            if self.collection_name not in db.collection_names():
+                try:
+                    db.create_collection(self.collection_name, capped=True, size=self.size)
+                    # tailable cursors on an empty capped collection die immediately
+                    db[self.collection_name].insert(dict(task_name=None))
+                except pymongo.errors.CollectionInvalid:
+                    pass  # created concurrently by another process
+            self._collection = db[self.collection_name]
+        return self._collection
+
+    def notify(self, task):
+        self.collection.insert(dict(task_name=task.task_name, ts=time.time()), w=0)
+
+    def _open_cursor(self, only):
+        if self._last_id is None:
+            last = self.collection.find().sort('$natural', pymongo.DESCENDING).limit(1)
+            for doc in last:
+                self._last_id = doc['_id']
+        query = {}
+        if self._last_id is not None:
+            query['_id'] = {'$gt': self._last_id}
+        if only:
+            query['task_name'] = {'$in': only}
+        self._cursor = self.collection.find(query, tailable=True, await_data=True)
+        self._cursor_only = only
+
+    def wait(self, timeout, only=None):
+        '''Block until a task is posted or timeout seconds have elapsed.
+        Returns True if woken by a new task.
+
+        Notifications sent more than ``stale_after`` seconds before this call
+        are skipped, since the caller has just looked for ready tasks and
+        would have seen those.  (This assumes host clocks are reasonably in
+        sync; a skewed host only makes workers fall back to polling.)
+        '''
+        start = time.time()
+        deadline = start + timeout
+        while time.time() < deadline:
+            if self._cursor is None or not self._cursor.alive or self._cursor_only != only:
+                self._open_cursor(only)
+            try:
+                doc = next(self._cursor)
+            except StopIteration:
+                if not self._cursor.alive:
+                    # cursor was invalidated (e.g. capped collection wrapped around)
+                    self._cursor = None
+                    time.sleep(min(1, max(0, deadline - time.time())))
+                continue
+            self._last_id = doc['_id']
+            if doc.get('ts', 0) >= start - self.stale_after:
+                return True
+        return False
+
+
+TASK_NOTIFIERS = {
+    'local': LocalTaskNotifier,
+    'capped': CappedCollectionTaskNotifier,
+}
+_notifiers = {}
+
+
+def task_notifier():
+    '''Return the notifier configured by ``monq.notify`` (or None for plain
+    polling).  One instance is kept per process.'''
+    kind = config.get('monq.notify')
+    if not kind:
+        return None
+    key = (kind, os.getpid())
+    if key not in _notifiers:
+        _notifiers[key] = TASK_NOTIFIERS[kind]()
+    return _notifiers[key]
+
+
 class MonQTask(MappedClass):
 
     '''Task to be executed by the taskd daemon.
@@ -60,9 +188,12 @@ class MonQTask(MappedClass):
         - args - ``*args`` to be sent to the task function
         - kwargs - ``**kwargs`` to be sent to the task function
         - result - if the task is complete, the return value. If in error, the traceback.
+        - coalesce_key - set on tasks posted with ``coalesce``, identifies pending
+          tasks which later posts can be merged into
     '''
     states = ('ready', 'busy', 'error', 'complete', 'skipped')
     result_types = ('keep', 'forget')
+    coalesce_modes = ('drop', 'union')
 
     class __mongometa__:
         session = task_orm_session
@@ -79,6 +210,10 @@ class __mongometa__:
                 # used by repo tarball status check, etc
                 'state', 'task_name', 'time_queue'
             ],
+            [
+                # used by MonQTask.post() to find tasks to coalesce with
+                'coalesce_key', 'state'
+            ],
         ]
 
     _id = FieldProperty(S.ObjectId)
@@ -99,6 +234,7 @@ class __mongometa__:
     args = FieldProperty([])
     kwargs = FieldProperty({None: None})
     result = FieldProperty(None, if_missing=None)
+    coalesce_key = FieldProperty(str, if_missing=None)
 
     sort = [
         ('priority', ming.DESCENDING),
@@ -144,8 +280,27 @@ def post(cls,
              priority=10,
              delay=0,
              flush_immediately=True,
+             coalesce=None,
+             ordered_with=None,
              ):
-        '''Create a new task object based on the current context.'''
+        '''Create a new task object based on the current context.
+
+        If ``coalesce`` is set, a new task may be merged into an identical
+        pending ('ready') one instead of being inserted:
+
+            - 'drop' - if a task with the same function, context and arguments
+              is already pending, return it and don't post a new one
+            - 'union' - the first argument must be a list; if a task with the
+              same function, context and other arguments is pending, add the
+              list items to its first argument (up to ``monq.coalesce_limit``
+              items) and return it
+
+        ``ordered_with`` lists the names of tasks which must run in the order
+        they were posted relative to this one (e.g. deletes of what this task
+        adds).  A pending task isn't coalesced into if one of those has been
+        posted for the same project and app after it, as that would move the
+        new work ahead of it.
+        '''
         if args is None:
             args = ()
         if kwargs is None:
@@ -166,6 +321,12 @@ def post(cls,
             context['app_config_id'] = c.app.config._id
         if getattr(c, 'user', None):
             context['user_id'] = c.user._id
+        coalesce_key = None
+        if coalesce:
+            coalesce_key = cls._coalesce_key(coalesce, task_name, context, args, kwargs, priority)
+            existing = cls._coalesce(coalesce, coalesce_key, args, context, ordered_with)
+            if existing is not None:
+                return existing
         obj = cls(
             state='ready',
             priority=priority,
@@ -176,11 +337,68 @@ def post(cls,
             process=None,
             result=None,
             context=context,
+            coalesce_key=coalesce_key,
             time_queue=datetime.utcnow() + timedelta(seconds=delay))
         if flush_immediately:
             session(obj).flush(obj)
+            if not delay:
+                cls._notify_posted(obj)
         return obj
 
+    @classmethod
+    def _coalesce_key(cls, coalesce, task_name, context, args, kwargs, priority):
+        if coalesce not in cls.coalesce_modes:
+            raise ValueError('Unknown coalesce mode: %r' % coalesce)
+        if coalesce == 'union':
+            if not args or not isinstance(args[0], (list, tuple)):
+                raise ValueError('coalesce="union" requires a list as first argument')
+            args = args[1:]
+        key = repr((coalesce, task_name, sorted(context.items()), list(args), sorted(kwargs.items()), priority))
+        return hashlib.sha1(six.ensure_binary(key)).hexdigest()
+
+    @classmethod
+    def _coalesce(cls, coalesce, coalesce_key, args, context, ordered_with=None):
+        '''Merge into a pending task with the same key, if there is one.
+        Returns the pending task, or None if a new task should be posted.'''
+        query = dict(state='ready', coalesce_key=coalesce_key)
+        if ordered_with:
+            # only merge into tasks queued after the last pending ordered_with task
+            barrier = cls.query.find({
+                'state': 'ready',
+                'task_name': {'$in': list(ordered_with)},
+                'context.project_id': context['project_id'],
+                'context.app_config_id': context['app_config_id'],
+            }).sort('time_queue', -1).first()
+            if barrier is not None:
+                query['time_queue'] = {'$gt': barrier.time_queue}
+        if coalesce == 'drop':
+            return cls.query.get(**query)
+        # 'union': don't grow a task's argument list past the limit
+        limit = asint(config.get('monq.coalesce_limit', 1000))
+        if len(args[0]) >= limit:
+            return None
+        query['args.0.%d' % (limit - len(args[0]))] = {'$exists': False}
+        try:
+            return cls.query.find_and_modify(
+                query=query,
+                update={'$addToSet': {'args.0': {'$each': list(args[0])}}},
+                new=True)
+        except pymongo.errors.OperationFailure as exc:
+            if 'No matching object found' not in exc.args[0]:
+                raise
+        return None
+
+    @classmethod
+    def _notify_posted(cls, obj):
+        '''Wake up idle workers, if a notifier is configured.  Failures are
+        not fatal since workers still fall back to polling.'''
+        try:
+            notifier = task_notifier()
+            if notifier:
+                notifier.notify(obj)
+        except Exception:
+            log.warning('Could not send notification for new task %s', obj._id, exc_info=True)
+
     @classmethod
     def get(cls, process='worker', state='ready', waitfunc=None, only=None):
         '''Get the highest-priority, oldest, ready task and lock it to the
@@ -216,6 +434,52 @@ def get(cls, process='worker', state='ready', waitfunc=None, only=None):
             except StopIteration:
                 return None
 
+    @classmethod
+    def get_batch(cls, process='worker', size=10, only=None):
+        '''Claim up to ``size`` ready tasks at once and lock them to the current
+        process, in the same order :meth:`get` would return them.  Only tasks
+        whose names are in ``only`` (required) are claimed.
+
+        ``time_start`` is set when the tasks are leased (and reset when each
+        one actually starts), so :meth:`timeout_tasks` recovers tasks leased
+        by a worker which died before running them.
+        '''
+        if not only or size < 1:
+            return []
+        query = dict(state='ready')
+        query['time_queue'] = {'$lte': datetime.utcnow()}
+        query['task_name'] = {'$in': only}
+        # direct pymongo query to fetch just the _ids (args can be large)
+        collection = task_doc_session.db[cls.__mongometa__.name]
+        candidates = collection.find(query, {'_id': 1}).sort(cls.sort).limit(size)
+        ids = [doc['_id'] for doc in candidates]
+        if not ids:
+            return []
+        # another worker may claim some of these between the find and the
+        # update; the state='ready' condition makes sure each task is only
+        # leased once
+        cls.query.update(
+            {'_id': {'$in': ids}, 'state': 'ready'},
+            {'$set': dict(state='busy', process=process, time_start=datetime.utcnow())},
+            multi=True)
+        claimed = cls.query.find({
+            '_id': {'$in': ids},
+            'state': 'busy',
+            'process': process,
+        }).all()
+        by_id = dict((t._id, t) for t in claimed)
+        return [by_id[_id] for _id in ids if _id in by_id]
+
+    @classmethod
+    def release(cls, tasks):
+        '''Put tasks leased (but not started) by this process back in the queue.'''
+        ids = [t._id for t in tasks]
+        if ids:
+            cls.query.update(
+                {'_id': {'$in': ids}, 'state': 'busy'},
+                {'$set': dict(state='ready', process=None)},
+                multi=True)
+
     @classmethod
     def timeout_tasks(cls, older_than):
         '''Mark all busy tasks older than a certain datetime as 'ready' again.
@@ -281,6 +545,7 @@ def __call__(self, restore_context=True, nocapture=False):
         finally:
             self.time_stop = datetime.utcnow()
             session(self).flush(self)
+            MonQTaskStats.record(self)
             if restore_context:
                 c.project = old_cproject
                 c.app = old_capp
@@ -298,3 +563,120 @@ def list(cls, state='ready'):
         '''Print all tasks of a certain status to sys.stdout.  Used for debugging.'''
         for t in cls.query.find(dict(state=state)):
             sys.stdout.write('%r\n' % t)
+
+
+class MonQTaskStats(MappedClass):
+
+    '''Hourly counters and latency histograms per task name, recorded by
+    :meth:`MonQTask.__call__` as each task finishes.
+
+    Properties
+
+        - task_name - full dotted name of the task function
+        - hour - start of the hour (UTC) in which the tasks finished
+        - count - number of tasks finished
+        - states - number of tasks finished per state ('complete', 'error')
+        - wait, run - histograms of enqueue->start and start->complete times,
+          keyed by index into :attr:`buckets`
+        - wait_total, run_total - sums of those times, in seconds
+    '''
+
+    # upper bounds in seconds; anything slower goes in a final open-ended bucket
+    buckets = [0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600]
+
+    class __mongometa__:
+        session = task_orm_session
+        name = str('monq_task_stats')
+        indexes = [
+            ('task_name', 'hour'),
+            'hour',
+        ]
+
+    _id = FieldProperty(S.ObjectId)
+    task_name = FieldProperty(str)
+    hour = FieldProperty(datetime)
+    count = FieldProperty(int, if_missing=0)
+    states = FieldProperty({str: int})
+    wait = FieldProperty({str: int})
+    run = FieldProperty({str: int})
+    wait_total = FieldProperty(float, if_missing=0.0)
+    run_total = FieldProperty(float, if_missing=0.0)
+
+    @classmethod
+    def bucket(cls, seconds):
+        for i, bound in enumerate(cls.buckets):
+            if seconds <= bound:
+                return i
+        return len(cls.buckets)
+
+    @classmethod
+    def record(cls, task):
+        '''Add a finished task's timings to the current hour's stats.  Never
+        raises, since stats must not make a task fail.'''
+        if not asbool(config.get('monq.stats', True)):
+            return
+        try:
+            if not (task.time_start and task.time_stop):
+                return
+            wait = max((task.time_start - task.time_queue).total_seconds(), 0)
+            run = max((task.time_stop - task.time_start).total_seconds(), 0)
+            hour = task.time_stop.replace(minute=0, second=0, microsecond=0)
+            cls.query.update(
+                dict(task_name=task.task_name, hour=hour),
+                {'$inc': {
+                    'count': 1,
+                    'states.%s' % task.state: 1,
+                    'wait.%d' % cls.bucket(wait): 1,
+                    'run.%d' % cls.bucket(run): 1,
+                    'wait_total': wait,
+                    'run_total': run,
+                }},
+                upsert=True)
+        except Exception:
+            log.warning('Could not record stats for task %s', task._id, exc_info=True)
+
+    @classmethod
+    def percentile(cls, histogram, count, pct):
+        '''Approximate a percentile from a histogram, as the upper bound of
+        the bucket it falls in (None for the open-ended bucket).'''
+        if not count:
+            return None
+        seen = 0
+        for i in range(len(cls.buckets) + 1):
+            seen += histogram.get(str(i), 0)
+            if seen >= count * pct / 100.0:
+                return cls.buckets[i] if i < len(cls.buckets) else None
+        return None
+
+    @classmethod
+    def summary(cls, since):
+        '''Combine stats for tasks finished since the given datetime into one
+        entry per task name, sorted by total run time.'''
+        totals = {}
+        for doc in cls.query.find(dict(hour={'$gte': since.replace(minute=0, second=0, microsecond=0)})):
+            t = totals.setdefault(doc.task_name, dict(
+                task_name=doc.task_name, count=0, states={}, wait={}, run={},
+                wait_total=0.0, run_total=0.0))
+            t['count'] += doc.count
+            t['wait_total'] += doc.wait_total
+            t['run_total'] += doc.run_total
+            for field in ('states', 'wait', 'run'):
+                for k, v in six.iteritems(getattr(doc, field) or {}):
+                    t[field][k] = t[field].get(k, 0) + v
+        result = []
+        for t in totals.values():
+            count = t['count']
+            t['errors'] = t['states'].get('error', 0)
+            t['error_rate'] = float(t['errors']) / count if count else 0
+            t['wait_avg'] = t['wait_total'] / count if count else 0
+            t['run_avg'] = t['run_total'] / count if count else 0
+            for field in ('wait', 'run'):
+                t[field + '_p50'] = cls.percentile(t[field], count, 50)
+                t[field + '_p95'] = cls.percentile(t[field], count, 95)
+            result.append(t)
+        result.sort(key=lambda t: t['run_total'], reverse=True)
+        return result
+
+    @classmethod
+    def purge(cls, older_than):
+        cls.query.remove(dict(hour={'$lt': older_than}))
@@ -17,6 +17,7 @@
 
 from __future__ import unicode_literals
 from __future__ import absolute_import
+import os
 import logging
 from itertools import chain
 from six.moves.cPickle import dumps
@@ -26,7 +27,7 @@
 
 import tg
 import jinja2
-from paste.deploy.converters import asint
+from paste.deploy.converters import asbool, asint
 from tg import tmpl_context as c, app_globals as g
 
 from ming.base import Object
@@ -35,7 +36,7 @@
 from allura.lib import utils
 from allura.lib import helpers as h
 from allura.model.repository import CommitDoc
-from allura.model.repository import Commit, Tree, LastCommit, ModelCache
+from allura.model.repository import Commit, Tree, LastCommit, LastCommitDoc, ModelCache
 from allura.model.index import ArtifactReferenceDoc, ShortlinkDoc
 from allura.model.auth import User
 from allura.model.timeline import TransientActor
@@ -50,10 +51,19 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False, commits_
     if commits_are_new is None:
         commits_are_new = not all_commits and not new_clone
 
-    all_commit_ids = commit_ids = list(repo.all_commit_ids())
-    if not commit_ids:
-        # the repo is empty, no need to continue
-        return
+    heads = repo.head_commit_ids()
+    commit_ids = None
+    if not all_commits and not new_clone:
+        # only walk the commits pushed since the last refresh, if we can
+        commit_ids = repo.new_commit_ids(heads)
+    if commit_ids is None:
+        commit_ids = list(repo.all_commit_ids())
+        if not commit_ids:
+            # the repo is empty, no need to continue
+            return
+    # commits reachable from the previously refreshed heads already have
+    # this repo in their repo_ids
+    all_commit_ids = commit_ids
     new_commit_ids = unknown_commit_ids(commit_ids)
     if not all_commits:
         # Skip commits that are already in the DB
@@ -61,21 +71,16 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False, commits_
     log.info('Refreshing %d commits on %s', len(commit_ids), repo.full_fs_path)
 
     # Refresh commits
-    seen = set()
-    for i, oid in enumerate(commit_ids):
-        repo.refresh_commit_info(oid, seen, not all_commits)
-        if (i + 1) % 100 == 0:
-            log.info('Refresh commit info %d: %s', (i + 1), oid)
+    repo.refresh_commits_info(commit_ids, not all_commits)
 
     refresh_commit_repos(all_commit_ids, repo)
 
     # Refresh child references
-    for i, oid in enumerate(commit_ids):
-        ci = next(CommitDoc.m.find(dict(_id=oid), validate=False))
-        refresh_children(ci)
-        if (i + 1) % 100 == 0:
-            log.info('Refresh child info %d for parents of %s',
-                     (i + 1), ci._id)
+    refresh_commit_children(commit_ids)
+
+    # Build last commit data for the changed dirs now, instead of on first view
+    if repo._refresh_precompute and asbool(tg.config.get('lcd_precompute', False)):
+        refresh_last_commits(repo, commit_ids)
 
     # Clear any existing caches for branches/tags
     if repo.cached_branches:
@@ -89,6 +94,9 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False, commits_
     # so we want to do it here instead of on the first view.
     repo.get_branches()
     repo.get_tags()
+    if heads is not None:
+        repo.refreshed_heads = heads
+        session(repo).flush()
 
     if commits_are_new:
         for commit in commit_ids:
@@ -127,40 +135,72 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False, commits_
 def refresh_commit_repos(all_commit_ids, repo):
     '''Refresh the list of repositories within which a set of commits are
     contained'''
+    refs = utils.BulkWriter(ArtifactReferenceDoc, QSIZE)
+    links = utils.BulkWriter(ShortlinkDoc, 2 * QSIZE)
+    project_id = repo.app.config.project_id
+    app_config_id = repo.app.config._id
+    commit_cls = bson.Binary(dumps(Commit))
     for oids in utils.chunked_iter(all_commit_ids, QSIZE):
-        for ci in CommitDoc.m.find(dict(
-                _id={'$in': list(oids)},
-                repo_ids={'$ne': repo._id})):
-            oid = ci._id
-            ci.repo_ids.append(repo._id)
+        q = CommitDoc.m.find(
+            dict(_id={'$in': list(oids)}, repo_ids={'$ne': repo._id}),
+            {'_id': 1}, validate=False)
+        new_oids = [ci._id for ci in q]
+        if not new_oids:
+            continue
+        CommitDoc.m.update_partial(
+            dict(_id={'$in': new_oids}),
+            {'$addToSet': dict(repo_ids=repo._id)},
+            multi=True)
+        for oid in new_oids:
             index_id = 'allura.model.repository.Commit#' + oid
-            ref = ArtifactReferenceDoc(dict(
+            refs.replace(dict(_id=index_id), dict(
                 _id=index_id,
                 artifact_reference=dict(
-                    cls=bson.Binary(dumps(Commit)),
-                    project_id=repo.app.config.project_id,
-                    app_config_id=repo.app.config._id,
+                    cls=commit_cls,
+                    project_id=project_id,
+                    app_config_id=app_config_id,
                     artifact_id=oid),
                 references=[]))
-            link0 = ShortlinkDoc(dict(
+            url = repo.url_for_commit(oid)
+            links.insert(dict(
                 _id=bson.ObjectId(),
                 ref_id=index_id,
-                project_id=repo.app.config.project_id,
-                app_config_id=repo.app.config._id,
+                project_id=project_id,
+                app_config_id=app_config_id,
                 link=repo.shorthand_for_commit(oid)[1:-1],
-                url=repo.url_for_commit(oid)))
+                url=url))
             # Always create a link for the full commit ID
-            link1 = ShortlinkDoc(dict(
+            links.insert(dict(
                 _id=bson.ObjectId(),
                 ref_id=index_id,
-                project_id=repo.app.config.project_id,
-                app_config_id=repo.app.config._id,
+                project_id=project_id,
+                app_config_id=app_config_id,
                 link=oid,
-                url=repo.url_for_commit(oid)))
-            ci.m.save(safe=False, validate=False)
-            ref.m.save(safe=False, validate=False)
-            link0.m.save(safe=False, validate=False)
-            link1.m.save(safe=False, validate=False)
+                url=url))
+        refs.execute()
+        links.execute()
+
+
+def refresh_commit_children(commit_ids):
+    '''Refresh the lists of children of the parents of the given commits,
+    one bulk write per QSIZE chunk of commits'''
+    children = utils.BulkWriter(CommitDoc, QSIZE)
+    for i, oids in enumerate(utils.chunked_iter(commit_ids, QSIZE)):
+        oids = list(oids)
+        q = CommitDoc.m.find(
+            dict(_id={'$in': oids}), {'parent_ids': 1}, validate=False)
+        parent_ids = dict((ci._id, ci.get('parent_ids') or []) for ci in q)
+        by_parent = OrderedDict()
+        for oid in oids:
+            for parent_id in parent_ids.get(oid, []):
+                by_parent.setdefault(parent_id, []).append(oid)
+        for parent_id, child_ids in six.iteritems(by_parent):
+            children.update(
+                dict(_id=parent_id),
+                {'$addToSet': dict(child_ids={'$each': child_ids})})
+        children.execute()
+        log.info('Refresh child info %d for parents of %s',
+                 i * QSIZE + len(oids), oids[-1])
 
 
 def refresh_children(ci):
@@ -171,12 +211,68 @@ def refresh_children(ci):
         multi=True)
 
 
+def refresh_last_commits(repo, commit_ids):
+    '''Build and store the LastCommit docs for every directory changed by
+    the given commits.  commit_ids are heads first (as from all_commit_ids);
+    they are processed oldest first so each LCD can start from its parent's.'''
+    model_cache = ModelCache(
+        max_instances={LastCommit: 4000},
+        max_queries={LastCommit: 4000},
+    )
+    lcds = utils.BulkWriter(LastCommitDoc, QSIZE)
+    with h.push_config(c, model_cache=model_cache, lcid_cache={}):
+        for i, oid in enumerate(reversed(commit_ids)):
+            commit = model_cache.get(Commit, dict(_id=oid))
+            if commit is None:
+                continue
+            commit.set_context(repo)
+            refresh_commit_lcds(commit, lcds)
+            if (i + 1) % 100 == 0:
+                log.info('Refresh last commit info %d: %s', (i + 1), oid)
+        lcds.execute()
+
+
+def refresh_commit_lcds(commit, lcds):
+    '''Build the LastCommit docs for the dirs changed by commit, queueing
+    them on the lcds BulkWriter.  Expects c.model_cache and c.lcid_cache to be
+    set up, see refresh_last_commits.'''
+    model_cache = c.model_cache
+    paths = set(os.path.dirname(path) for path in commit.changed_paths if path)
+    paths.add('')
+    for path in sorted(paths):
+        if model_cache.get(LastCommit, dict(path=path, commit_id=commit._id)):
+            continue
+        try:
+            tree = commit.get_path(path, create=False)
+        except KeyError:
+            continue  # dir removed in this commit
+        if tree is None:
+            continue
+        # start from the parent commit's LCD for this path, when it's stored,
+        # instead of asking the SCM for it
+        prev_commit_id = None
+        if commit.parent_ids:
+            prev_commit_id = LastCommit._stored_last_commit_id(
+                commit.parent_ids[0], path, model_cache)
+        if prev_commit_id:
+            c.lcid_cache[path] = prev_commit_id
+        else:
+            c.lcid_cache.pop(path, None)
+        lcd = LastCommit._build(tree)
+        session(lcd).expunge(lcd)
+        lcds.insert(dict(
+            _id=lcd._id,
+            commit_id=lcd.commit_id,
+            path=lcd.path,
+            entries=[dict(name=e.name, commit_id=e.commit_id) for e in lcd.entries]))
+
+
 def unknown_commit_ids(all_commit_ids):
     '''filter out all commit ids that have already been cached'''
     result = []
     for chunk in utils.chunked_iter(all_commit_ids, QSIZE):
         chunk = list(chunk)
-        q = CommitDoc.m.find(dict(_id={'$in': chunk}))
+        q = CommitDoc.m.find(dict(_id={'$in': chunk}), {'_id': 1}, validate=False)
         known_commit_ids = set(ci._id for ci in q)
         result += [oid for oid in chunk if oid not in known_commit_ids]
     return result
@@ -18,6 +18,7 @@
 from __future__ import absolute_import
 import json
 import os
+import errno
 import stat
 import mimetypes
 import logging
@@ -29,6 +30,7 @@
 from time import time
 from collections import defaultdict, OrderedDict
 from six.moves.urllib.parse import urljoin
+import threading
 from threading import Thread
 from six.moves.queue import Queue
 from itertools import chain, islice
@@ -47,6 +49,8 @@
 from ming import Field, collection, Index
 from ming.utils import LazyProperty
 from ming.orm import FieldProperty, session, Mapper, mapper
+from ming.odm.base import ObjectState
+from ming.orm.base import state
 from ming.base import Object
 
 from allura.lib import helpers as h
@@ -127,6 +131,16 @@ def new_commits(self, all_commits=False):  # pragma no cover
         '''
         raise NotImplementedError('new_commits')
 
+    def head_commit_ids(self):
+        '''Return the ids of the commits (or tags) all the refs point to, or
+        None if new_commit_ids isn't supported'''
+        return None
+
+    def new_commit_ids(self, heads, known_heads):
+        '''Return the ids of the commits reachable from heads but not from
+        known_heads, heads first (like all_commit_ids).'''
+        raise NotImplementedError('new_commit_ids')
+
     def commit_parents(self, commit):  # pragma no cover
         '''Return a list of native commits for the parents of the given (native)
         commit'''
@@ -136,6 +150,15 @@ def refresh_commit_info(self, oid, lazy=True):  # pragma no cover
         '''Refresh the data in the commit with id oid'''
         raise NotImplementedError('refresh_commit_info')
 
+    def refresh_commits_info(self, commit_ids, lazy=True):
+        '''Refresh the data in all the given commits (and their trees).
+        Implementations may override this with a faster bulk version.'''
+        seen = set()
+        for i, oid in enumerate(commit_ids):
+            self.refresh_commit_info(oid, seen, lazy)
+            if (i + 1) % 100 == 0:
+                log.info('Refresh commit info %d: %s', (i + 1), oid)
+
     def _setup_hooks(self, source_path=None):  # pragma no cover
         '''Install a hook in the repository that will ping the refresh url for
         the repo.  Optionally provide a path from which to copy existing hooks.'''
@@ -339,6 +362,17 @@ def paged_diffs(self, commit_id, start=0, end=None, onlyChangedFiles=False):
         """
         raise NotImplementedError('paged_diffs')
 
+    def line_counts(self, commit_id):
+        """
+        Return a list of (path, added, removed) tuples giving the number of
+        lines added and removed in each file touched by the commit, relative
+        to its first parent.  Counts are None for binary files.
+
+        Returns None if the SCM can't provide the counts, in which case
+        callers have to diff the blobs themselves.
+        """
+        return None
+
     def merge_request_commits(self, mr):
         """Given MergeRequest :param mr: return list of commits to be merged"""
         raise NotImplementedError('merge_request_commits')
@@ -369,6 +403,8 @@ class __mongometa__:
     default_branch_name = FieldProperty(str)
     cached_branches = FieldProperty([dict(name=str, object_id=str)])
     cached_tags = FieldProperty([dict(name=str, object_id=str)])
+    # head_commit_ids() as of the last refresh, for incremental refreshes
+    refreshed_heads = FieldProperty([str])
 
     def __init__(self, **kw):
         if 'name' in kw and 'tool' in kw:
@@ -434,17 +470,70 @@ def get_tarball_status(self, revision, path=None):
             self.tarball_path, self.tarball_filename(revision, path))
         filename = '%s%s' % (pathname, '.zip')
         if os.path.isfile(filename.encode('utf-8')):
+            # mark as recently used, for scripts/clean_tarballs.py
+            try:
+                os.utime(filename.encode('utf-8'), None)
+            except OSError:
+                pass
             return 'complete'
+        if os.path.isfile(('%s%s' % (pathname, '.lock')).encode('utf-8')):
+            return 'busy'
 
-        # file doesn't exist, check for busy task
+        # file doesn't exist, check for a queued or running task for this repo
         task = MonQTask.query.get(**{
             'task_name': 'allura.tasks.repo_tasks.tarball',
             'args': [revision, path or ''],
             'state': {'$in': ['busy', 'ready']},
+            'context.app_config_id': self.app_config_id,
         })
 
         return task.state if task else None
 
+    def request_tarball(self, revision, path=None):
+        '''
+        Queue creation of a snapshot, unless it already exists or is queued
+        or being created.  Returns the snapshot status.
+        '''
+        path = path or ''
+        status = self.get_tarball_status(revision, path)
+        if status is None:
+            from allura.tasks import repo_tasks
+            repo_tasks.tarball.post(revision, path)
+            status = 'ready'
+        return status
+
+    def _lock_tarball(self, revision, path=None):
+        '''
+        Create the lock file for a snapshot so that only one worker creates it.
+
+        Returns the lock filename, or None if another worker holds the lock.
+        Locks older than scm.repos.tarball.lock_timeout seconds are assumed to
+        be left over from a crashed worker and are taken over.
+        '''
+        if not os.path.exists(self.tarball_path):
+            try:
+                os.makedirs(self.tarball_path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        lockname = os.path.join(self.tarball_path, '%s%s' % (self.tarball_filename(revision, path), '.lock'))
+        timeout = asint(tg.config.get('scm.repos.tarball.lock_timeout', 3600))
+        try:
+            os.close(os.open(lockname.encode('utf-8'), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return lockname
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            if time() - os.path.getmtime(lockname.encode('utf-8')) < timeout:
+                return None
+            log.warn('Taking over stale snapshot lock %s', lockname)
+            os.utime(lockname.encode('utf-8'), None)
+        except OSError:
+            # removed by its owner in the meantime
+            return None
+        return lockname
+
     def __repr__(self):  # pragma no cover
         return '<%s %s>' % (
             self.__class__.__name__,
@@ -463,6 +552,9 @@ def all_commit_ids(self):
     def refresh_commit_info(self, oid, seen, lazy=True):
         return self._impl.refresh_commit_info(oid, seen, lazy)
 
+    def refresh_commits_info(self, commit_ids, lazy=True):
+        return self._impl.refresh_commits_info(commit_ids, lazy)
+
     def open_blob(self, blob):
         return self._impl.open_blob(blob)
 
@@ -533,6 +625,9 @@ def set_default_branch(self, name):
     def paged_diffs(self, commit_id, start=0, end=None,  onlyChangedFiles=False):
         return self._impl.paged_diffs(commit_id, start, end, onlyChangedFiles)
 
+    def line_counts(self, commit_id):
+        return self._impl.line_counts(commit_id)
+
     def init_as_clone(self, source_path, source_name, source_url):
         self.upstream_repo.name = source_name
         self.upstream_repo.url = source_url
@@ -709,9 +804,28 @@ def guess_type(self, name):
                 content_type, encoding = 'application/octet-stream', None
         return content_type, encoding
 
+    def head_commit_ids(self):
+        return self._impl.head_commit_ids()
+
+    def new_commit_ids(self, heads=None):
+        '''Ids of the commits reachable from heads (default: all refs) that
+        weren't reachable from the refs at the last refresh, heads first.
+        Returns None if that can't be worked out without walking the whole
+        history.'''
+        if not self.refreshed_heads:
+            return None
+        if heads is None:
+            heads = self.head_commit_ids()
+        if heads is None:
+            return None
+        return self._impl.new_commit_ids(heads, self.refreshed_heads)
+
     def unknown_commit_ids(self):
         from allura.model.repo_refresh import unknown_commit_ids as unknown_commit_ids_repo
-        return unknown_commit_ids_repo(self.all_commit_ids())
+        commit_ids = self.new_commit_ids()
+        if commit_ids is None:
+            commit_ids = self.all_commit_ids()
+        return unknown_commit_ids_repo(commit_ids)
 
     def refresh(self, all_commits=False, notify=True, new_clone=False, commits_are_new=None):
         '''Find any new commits in the repository and update'''
@@ -747,7 +861,17 @@ def forks(self):
     def tarball(self, revision, path=None):
         if path:
             path = path.strip('/')
-        self._impl.tarball(revision, path)
+        lockname = self._lock_tarball(revision, path)
+        if lockname is None:
+            log.info('Snapshot of %s rev %s path %s is already being created', self, revision, path)
+            return
+        try:
+            self._impl.tarball(revision, path)
+        finally:
+            try:
+                os.remove(lockname.encode('utf-8'))
+            except OSError:
+                pass
 
     def rev_to_commit_id(self, rev):
         raise NotImplementedError('rev_to_commit_id')
@@ -1021,6 +1145,36 @@ def add_meta_post(self, changes):
         name=str,
         commit_id=str)]))
 
+# Computed diffs (summaries and rendered files).  Keys are hashes of ids of
+# immutable commits/blobs, so entries never need invalidating; they expire
+# scm.diff_cache.ttl seconds after being computed (by a TTL index on 'created',
+# created by EnsureIndexCommand as it depends on config)
+DiffCacheDoc = collection(
+    str('repo_diff_cache'), main_doc_session,
+    Field('_id', str),
+    Field('data', S.Anything),
+    Field('created', datetime, if_missing=datetime.utcnow))
+
+
+def cached_diff(key, compute, max_size=None, size=len):
+    '''
+    Return compute(), caching the result in DiffCacheDoc under a hash of key.
+    Results for which size(result) > max_size are returned but not stored.
+    '''
+    if not asbool(tg.config.get('scm.diff_cache', True)):
+        return compute()
+    _id = sha1(six.ensure_binary(repr(key))).hexdigest()
+    doc = DiffCacheDoc.m.get(_id=_id)
+    if doc is not None:
+        return doc.data
+    data = compute()
+    if max_size is None or size(data) <= max_size:
+        DiffCacheDoc.m.update_partial(
+            dict(_id=_id),
+            {'$set': dict(data=data, created=datetime.utcnow())},
+            upsert=True)
+    return data
+
 
 class RepoObject(object):
 
@@ -1201,7 +1355,13 @@ def diffs(self):
         return self.paged_diffs()
 
     def paged_diffs(self, start=0, end=None,  onlyChangedFiles=False):
-        diffs = self.repo.paged_diffs(self._id, start, end, onlyChangedFiles)
+        tool = self.repo.tool.lower()
+        diffs = cached_diff(
+            ('paged_diffs', self._id, start, end, onlyChangedFiles,
+             tg.config.get('scm.commit.%s.detect_copies' % tool)),
+            lambda: self.repo.paged_diffs(self._id, start, end, onlyChangedFiles),
+            max_size=asint(tg.config.get('scm.diff_cache.max_files', 5000)),
+            size=lambda diffs: sum(len(diffs[t]) for t in ('added', 'removed', 'changed', 'copied', 'renamed')))
 
         return Object(
             added=sorted(diffs['added']),
@@ -1566,6 +1726,22 @@ def _last_commit_id(cls, commit, path):
                       path, commit._id)
             return commit._id
 
+    @classmethod
+    def _stored_last_commit_id(cls, commit_id, path, cache):
+        '''Find the last commit to touch path as of commit_id using only the
+        stored LCDs of its parent directories.  Returns None if any of those
+        LCDs hasn't been built yet.'''
+        if path == '':
+            return commit_id
+        parent_path = os.path.dirname(path)
+        parent_commit_id = cls._stored_last_commit_id(commit_id, parent_path, cache)
+        if parent_commit_id is None:
+            return None
+        lcd = cache.get(cls, {'path': parent_path, 'commit_id': parent_commit_id})
+        if lcd is None:
+            return None
+        return lcd.by_name.get(os.path.basename(path))
+
     @classmethod
     def _prev_commit_id(cls, commit, path):
         if not commit.parent_ids or path in commit.added_paths:
@@ -1586,7 +1762,8 @@ def get(cls, tree):
         '''Find or build the LastCommitDoc for the given tree.'''
         cache = getattr(c, 'model_cache', '') or ModelCache()
         path = tree.path().strip('/')
-        last_commit_id = cls._last_commit_id(tree.commit, path)
+        last_commit_id = (cls._stored_last_commit_id(tree.commit._id, path, cache) or
+                          cls._last_commit_id(tree.commit, path))
         lcd = cache.get(cls, {'path': path, 'commit_id': last_commit_id})
         if lcd is None:
             commit = cache.get(Commit, {'_id': last_commit_id})
@@ -1615,8 +1792,9 @@ def _build(cls, tree):
             [node for node in nodes if os.path.join(path, node) in tree.commit.changed_paths])
         unchanged = [os.path.join(path, node) for node in nodes - changed]
         if prev_lcd:
-            # get unchanged entries from previously computed LCD
-            entries = prev_lcd.by_name
+            # get unchanged entries from previously computed LCD; copied, as
+            # the (cached) prev_lcd may be the start of other branches too
+            entries = dict(prev_lcd.by_name)
         elif unchanged:
             # no previously computed LCD, so get unchanged entries from SCM
             # (but only ask for the ones that we know we need)
@@ -1703,18 +1881,24 @@ def _model_query(self, cls):
             raise AttributeError(
                 '%s has neither "query" nor "m" attribute' % cls)
 
+    def _fetch(self, cls, query, _query):
+        shared = SharedModelCache.get_instance()
+        if shared is not None and cls in shared.classes:
+            return shared.get(cls, query, _query)
+        return self._model_query(cls).get(**query)
+
     def get(self, cls, query):
         _query = self._normalize_query(query)
         self._touch(cls, _query)
         if _query not in self._query_cache[cls]:
-            val = self._model_query(cls).get(**query)
+            val = self._fetch(cls, query, _query)
             self.set(cls, _query, val)
             return val
         _id = self._query_cache[cls][_query]
         if _id is None:
             return None
         if _id not in self._instance_cache[cls]:
-            val = self._model_query(cls).get(**query)
+            val = self._fetch(cls, query, _query)
             self.set(cls, _query, val)
             return val
         return self._instance_cache[cls][_id]
@@ -1807,6 +1991,110 @@ def batch_load(self, cls, query, attrs=None):
             self.set(cls, keys, result)
 
 
+class SharedModelCache(object):
+
+    '''
+    Process-wide LRU cache of the documents behind Tree and LastCommit
+    lookups, shared by the ModelCache of every request and thread.
+
+    Those documents don't change once written, so entries are never
+    invalidated.  Commits are left out, as their child_ids (used for the
+    next/prev links of Commit.context) grow as new commits are refreshed.
+    The cache is bounded by the total BSON size of the stored documents, and
+    keeps per-class hit/miss counters, both process-wide and per thread so
+    they can be reported for each request.
+
+    Enabled by setting scm.model_cache.max_bytes.
+    '''
+
+    classes = (Tree, LastCommit)
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._docs = OrderedDict()  # keyed by (cls, query), holds (bson, size)
+        self._lock = threading.Lock()
+        self._totals = defaultdict(lambda: dict(hits=0, misses=0))
+        self._local = threading.local()
+
+    @classmethod
+    def get_instance(cls):
+        max_bytes = asint(tg.config.get('scm.model_cache.max_bytes', 0))
+        if not max_bytes:
+            return None
+        instance = cls._instance
+        if instance is None or instance.max_bytes != max_bytes:
+            with cls._instance_lock:
+                if cls._instance is None or cls._instance.max_bytes != max_bytes:
+                    cls._instance = cls(max_bytes)
+                instance = cls._instance
+        return instance
+
+    def get(self, cls, query, _query):
+        key = (cls, _query)
+        with self._lock:
+            entry = self._docs.pop(key, None)
+            if entry is not None:
+                self._docs[key] = entry
+        self._count(cls, 'hits' if entry is not None else 'misses')
+        if entry is not None:
+            return self._load(cls, bson.BSON(entry[0]).decode())
+        val = cls.query.get(**query)
+        if val is not None:
+            self.set(cls, _query, val)
+        return val
+
+    def set(self, cls, _query, val):
+        data = bson.BSON.encode(state(val).clone())
+        size = len(data)
+        if size > self.max_bytes:
+            return
+        key = (cls, _query)
+        with self._lock:
+            old = self._docs.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._docs[key] = (data, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._docs.popitem(last=False)
+                self.size -= evicted_size
+
+    def _load(self, cls, doc):
+        '''Turn a cached document into an instance in the current thread's session'''
+        cls_mapper = mapper(cls)
+        obj = cls_mapper.session.imap.get(cls, doc['_id'])
+        if obj is None:
+            obj = cls_mapper.create(doc, {})
+            state(obj).status = ObjectState.clean
+            cls_mapper.session.save(obj)
+        return obj
+
+    def _count(self, cls, result):
+        name = cls.__name__
+        with self._lock:
+            self._totals[name][result] += 1
+        counts = getattr(self._local, 'counts', None)
+        if counts is None:
+            counts = self._local.counts = defaultdict(lambda: dict(hits=0, misses=0))
+        counts[name][result] += 1
+
+    def pop_thread_stats(self):
+        '''Return the hit/miss counts for this thread since the last call, and reset them'''
+        counts = getattr(self._local, 'counts', None) or {}
+        self._local.counts = None
+        return {name: dict(v) for name, v in six.iteritems(counts)}
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                size=self.size,
+                entries=len(self._docs),
+                counts={name: dict(v) for name, v in six.iteritems(self._totals)})
+
+
 class GitLikeTree(object):
 
     '''
@@ -19,7 +19,7 @@
 from __future__ import absolute_import
 from datetime import datetime
 from tg import config
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 
 from ming import schema as S
 from ming.orm import Mapper
@@ -408,12 +408,22 @@ def _addCommitData(stats, topics, languages, lines):
         topics = [t for t in project.trove_topic if t]
         languages = [l for l in project.trove_language if l]
 
-        d = newcommit.diffs
-        if len(newcommit.parent_ids) > 0:
-            oldcommit = newcommit.repo.commit(newcommit.parent_ids[0])
-
         totlines = 0
         if asbool(config.get('userstats.count_lines_of_code', True)):
+            counts = newcommit.repo.line_counts(newcommit._id)
+        else:
+            counts = []
+        if counts is not None:
+            # skip files with huge changes (vendored or generated code)
+            max_lines = asint(config.get('userstats.count_lines_of_code.max_file_lines', 10000))
+            for path, added, removed in counts:
+                if added and (not max_lines or added <= max_lines):
+                    totlines += added
+        else:
+            d = newcommit.diffs
+            if len(newcommit.parent_ids) > 0:
+                oldcommit = newcommit.repo.commit(newcommit.parent_ids[0])
+
             for changed in d.changed:
                 newblob = newcommit.tree.get_blob_by_path(changed)
                 oldblob = oldcommit.tree.get_blob_by_path(changed)
@@ -0,0 +1,155 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+import argparse
+import logging
+import os
+import stat
+import time
+
+from tg import config
+from tg import tmpl_context as c
+
+from allura import model as M
+from allura.lib import helpers as h
+from allura.lib.utils import chunked_find
+from allura.scripts import ScriptTask
+
+
+log = logging.getLogger(__name__)
+
+
+def _remove(filename, dry_run):
+    log.info('Removing %s', filename)
+    if not dry_run:
+        try:
+            os.remove(filename)
+        except OSError:
+            log.warn('Could not remove %s', filename, exc_info=True)
+
+
+def clean_tarballs(snapshot_dirs, max_bytes=0, max_age=0, tmp_age=86400, dry_run=False):
+    '''
+    Remove repo snapshots, oldest first, until they take up no more than
+    max_bytes.  Snapshots last used more than max_age seconds ago are removed
+    regardless, as are temp and lock files older than tmp_age seconds (left
+    behind by interrupted snapshot tasks).
+
+    snapshot_dirs is a list of (directory, filename prefix) pairs, one per
+    repo (see :func:`repo_snapshot_dirs`).  Only files directly in those
+    directories and named with the repo's prefix are considered, so other
+    files (and export trees being zipped) are left alone.
+
+    Snapshot mtimes are updated by Repository.get_tarball_status each time
+    the snapshot is asked for, so mtime order is least-recently-used order.
+
+    Returns a (number of snapshots removed, bytes remaining) tuple.
+    '''
+    now = time.time()
+    snapshots = []
+    for dirname, prefix in set(snapshot_dirs):
+        try:
+            filenames = os.listdir(dirname)
+        except OSError:
+            continue  # no snapshots made for this repo
+        for fn in filenames:
+            if not fn.startswith(prefix) or not fn.endswith(('.zip', '.tmp', '.lock')):
+                continue
+            filename = os.path.join(dirname, fn)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue  # removed by a snapshot task in the meantime
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            if fn.endswith('.zip'):
+                snapshots.append((st.st_mtime, st.st_size, filename))
+            elif now - st.st_mtime > tmp_age:
+                _remove(filename, dry_run)
+
+    snapshots.sort()
+    total = sum(size for mtime, size, filename in snapshots)
+    removed = 0
+    for mtime, size, filename in snapshots:
+        expired = max_age and now - mtime > max_age
+        over_quota = max_bytes and total > max_bytes
+        if not (expired or over_quota):
+            break
+        _remove(filename, dry_run)
+        total -= size
+        removed += 1
+    return removed, total
+
+
+def repo_snapshot_dirs():
+    '''
+    Yield the (Repository.tarball_path, snapshot filename prefix) of each repo.
+    '''
+    for chunk in chunked_find(M.Project, {}):
+        for p in chunk:
+            for ac in M.AppConfig.query.find(dict(project_id=p._id)):
+                app = p.app_instance(ac)
+                if getattr(app, 'repo', None) is None:
+                    continue
+                with h.push_config(c, project=p, app=app):
+                    # the base tarball_filename, without any revision (or
+                    # the tool specific parts following it)
+                    prefix = M.Repository.tarball_filename(app.repo, '')
+                    yield app.repo.tarball_path, prefix
+
+
+class CleanTarballs(ScriptTask):
+
+    """
+    Remove repository snapshots (see scm.repos.tarball.* settings) to keep
+    them within a disk quota, least recently used first.
+    """
+
+    @classmethod
+    def execute(cls, options):
+        if not config.get('scm.repos.tarball.root'):
+            return 'scm.repos.tarball.root is not set'
+        removed, total = clean_tarballs(
+            repo_snapshot_dirs(),
+            max_bytes=options.max_size * 1024 * 1024,
+            max_age=options.max_age * 86400,
+            tmp_age=options.tmp_age * 3600,
+            dry_run=options.dry_run)
+        log.info('Removed %s snapshots, %s bytes remaining', removed, total)
+
+    @classmethod
+    def parser(cls):
+        parser = argparse.ArgumentParser(description='Remove least recently used repository snapshots')
+        parser.add_argument('--max-size', type=int, default=0,
+                            help='Remove snapshots until they take up no more than this many MB (default: no limit)')
+        parser.add_argument('--max-age', type=int, default=0,
+                            help='Remove snapshots not used in this many days (default: no limit)')
+        parser.add_argument('--tmp-age', type=int, default=24,
+                            help='Remove temp and lock files older than this many hours (default: %(default)s)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Log what would be removed, without removing anything')
+        return parser
+
+
+def get_parser():
+    return CleanTarballs.parser()
+
+
+if __name__ == '__main__':
+    CleanTarballs.main()
@@ -0,0 +1,193 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+import argparse
+import logging
+from itertools import groupby
+
+from tg import config
+from ming.orm import Mapper, mapper
+from paste.deploy.converters import asint
+
+from allura import model as M
+from allura.lib import utils
+from allura.scripts import ScriptTask
+
+
+log = logging.getLogger(__name__)
+
+
+def compact_snapshots(snapshot_cls, keyframe_interval, dry_run=False, pagesize=1000):
+    '''
+    Re-encode the stored history in `snapshot_cls`'s collection in place,
+    with a full keyframe every `keyframe_interval` versions of an artifact
+    and text deltas in between (see Snapshot.encode_delta).  A
+    keyframe_interval of 0 stores every snapshot in full again.
+
+    Artifacts whose history can't be decoded (a delta whose previous version
+    is missing) are logged and left as they are.
+
+    Must not run while artifacts are being edited, as new snapshots are
+    encoded against the previous ones.
+
+    Returns the number of snapshots rewritten.
+    '''
+    writer = utils.BulkWriter(mapper(snapshot_cls).collection)
+    rewritten = 0
+    for history in _histories(writer.collection, pagesize):
+        try:
+            updates = _compact_history(history, keyframe_interval)
+        except ValueError as e:
+            log.error('Leaving history of %s %s as is: %s',
+                      history[0].get('artifact_class'), history[0].get('artifact_id'), e)
+            continue
+        rewritten += len(updates)
+        if not dry_run:
+            for _id, data, delta in updates:
+                writer.update({'_id': _id}, {'$set': {'data': data, 'delta': delta}})
+    writer.execute()
+    return rewritten
+
+
+def _histories(collection, pagesize):
+    '''
+    Yield the snapshot docs of each artifact in version order, paging through
+    the collection by (artifact_class, artifact_id) so that no cursor is left
+    open (and times out) while the previous artifacts are rewritten.
+    '''
+    fields = {'_id': 1, 'artifact_class': 1, 'artifact_id': 1, 'version': 1, 'data': 1, 'delta': 1}
+    sort = [('artifact_class', 1), ('artifact_id', 1), ('version', 1)]
+    query = {}
+    while True:
+        docs = list(collection.find(query, fields).sort(sort).limit(pagesize))
+        if not docs:
+            return
+        histories = [list(history) for _, history in groupby(docs, _artifact_key)]
+        if len(docs) == pagesize:
+            # the last artifact's history may continue on the next page
+            artifact_class, artifact_id = _artifact_key(histories.pop()[0])
+            histories.append(list(collection.find(
+                {'artifact_class': artifact_class, 'artifact_id': artifact_id}, fields).sort('version', 1)))
+        for history in histories:
+            yield history
+        if len(docs) < pagesize:
+            return
+        artifact_class, artifact_id = _artifact_key(histories[-1][0])
+        query = {'$or': [
+            {'artifact_class': {'$gt': artifact_class}},
+            {'artifact_class': artifact_class, 'artifact_id': {'$gt': artifact_id}},
+        ]}
+
+
+def _artifact_key(doc):
+    return doc.get('artifact_class'), doc.get('artifact_id')
+
+
+def _compact_history(history, keyframe_interval):
+    '''
+    Return (_id, data, delta) for each snapshot doc in `history` (one
+    artifact's, in version order) which needs rewriting.
+    '''
+    updates = []
+    prev = None
+    for doc in history:
+        data = doc.get('data')
+        if data is None:
+            prev = None
+            continue
+        # rebuild any text fields this one stores as deltas (against the previous version)
+        missing = [name for name in (doc.get('delta') or {}).get('fields') or {} if name not in data]
+        if missing and (prev is None or prev['version'] != doc['version'] - 1):
+            raise ValueError('version %s is stored as a delta, but version %s is missing' %
+                             (doc['version'], doc['version'] - 1))
+        if prev is not None:
+            texts = M.Snapshot.full_text_fields([dict(data=prev['data']), doc])
+        else:
+            texts = M.Snapshot.full_text_fields([doc])
+        full_data = dict(data)
+        for name in missing:
+            full_data[name] = texts[name]
+
+        new_data, new_delta = full_data, None
+        if (keyframe_interval and prev is not None and
+                doc['version'] == prev['version'] + 1 and
+                doc['version'] - prev['keyframe'] < keyframe_interval):
+            new_data, new_delta = M.Snapshot.encode_delta(full_data, prev['data'], prev['keyframe'])
+        if new_data != data or new_delta != doc.get('delta'):
+            updates.append((doc['_id'], new_data, new_delta))
+        prev = dict(
+            version=doc['version'],
+            keyframe=new_delta['keyframe'] if new_delta else doc['version'],
+            data=full_data)
+    return updates
+
+
+class CompactSnapshots(ScriptTask):
+
+    """
+    Re-encode the history of versioned artifacts (wiki pages, tickets, etc)
+    with keyframes and text deltas, per artifact.snapshot.keyframe_interval.
+    Must not be run while artifacts are being edited.
+    """
+
+    @classmethod
+    def execute(cls, options):
+        if options.keyframe_interval is None:
+            keyframe_interval = asint(config.get('artifact.snapshot.keyframe_interval', 0))
+        else:
+            keyframe_interval = options.keyframe_interval
+        seen = set()
+        for m in Mapper.all_mappers():
+            snapshot_cls = m.mapped_class
+            cname = m.collection.m.collection_name
+            if cname is None or not issubclass(snapshot_cls, M.Snapshot):
+                continue
+            if options.collection and cname not in options.collection:
+                continue
+            key = (m.collection.m.session, cname)
+            if key in seen:
+                continue
+            seen.add(key)
+            log.info('Compacting %s', cname)
+            rewritten = compact_snapshots(snapshot_cls, keyframe_interval, dry_run=options.dry_run)
+            log.info('Rewrote %s snapshots in %s', rewritten, cname)
+
+    @classmethod
+    def parser(cls):
+        parser = argparse.ArgumentParser(description='Compact the stored history of versioned artifacts.  '
+                                         'Do not run while artifacts are being edited (e.g. take the site '
+                                         'offline first), as new versions are encoded against the history '
+                                         'being rewritten.')
+        parser.add_argument('--keyframe-interval', type=int, default=None,
+                            help='Store a full snapshot every this many versions, and text deltas in between.  '
+                                 '0 stores every snapshot in full.  '
+                                 '(default: artifact.snapshot.keyframe_interval from the .ini file)')
+        parser.add_argument('--collection', action='append', default=[],
+                            help='Only compact this history collection, e.g. page_history (may be repeated)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Count what would be rewritten, without writing anything')
+        return parser
+
+
+def get_parser():
+    return CompactSnapshots.parser()
+
+
+if __name__ == '__main__':
+    CompactSnapshots.main()
@@ -0,0 +1,94 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+import argparse
+import logging
+from datetime import datetime, timedelta
+
+from ming.orm import Mapper, ThreadLocalORMSession
+
+from allura import model as M
+from allura.lib.utils import chunked_find
+from allura.scripts import ScriptTask
+
+
+log = logging.getLogger(__name__)
+
+
+def _stats(obj):
+    return tuple(getattr(obj, name, None) for name in
+                 ('num_replies', 'num_topics', 'num_posts', 'last_post_id'))
+
+
+def reconcile_stats(cls, query=None):
+    '''
+    Recount the stats of all `cls` (a Thread or Discussion class) objects
+    matching `query`.  Returns the number of them that were off.
+    '''
+    fixed = 0
+    for chunk in chunked_find(cls, query):
+        for obj in chunk:
+            before = _stats(obj)
+            obj.update_stats()
+            if _stats(obj) != before:
+                log.info('Fixed stats of %s %s: %s -> %s', cls.__name__, obj._id, before, _stats(obj))
+                fixed += 1
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+    return fixed
+
+
+class ReconcileDiscussionStats(ScriptTask):
+
+    """
+    Recount the post counts and last posts of threads and discussions
+    (forums), which are otherwise updated incrementally as posts are
+    approved, marked as spam or deleted
+    """
+
+    @classmethod
+    def execute(cls, options):
+        thread_query = {}
+        if options.days:
+            thread_query['last_post_date'] = {'$gte': datetime.utcnow() - timedelta(days=options.days)}
+        # threads first, since discussions count the threads that have posts
+        for base_cls, query in ((M.Thread, thread_query), (M.Discussion, {})):
+            seen = set()
+            for m in Mapper.all_mappers():
+                cname = m.collection.m.collection_name
+                if cname is None or cname in seen or not issubclass(m.mapped_class, base_cls):
+                    continue
+                seen.add(cname)
+                fixed = reconcile_stats(m.mapped_class, dict(query))
+                log.info('Fixed stats of %s %s', fixed, cname)
+
+    @classmethod
+    def parser(cls):
+        parser = argparse.ArgumentParser(description='Recount the stats of discussion threads and forums')
+        parser.add_argument('--days', type=int, default=0,
+                            help='Only recount threads with posts in the last this many days (default: all)')
+        return parser
+
+
+def get_parser():
+    return ReconcileDiscussionStats.parser()
+
+
+if __name__ == '__main__':
+    ReconcileDiscussionStats.main()
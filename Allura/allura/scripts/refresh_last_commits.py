@@ -28,7 +28,9 @@
 from ming.orm import ThreadLocalORMSession, session
 
 from allura import model as M
-from allura.lib.utils import chunked_find
+from allura.lib import helpers as h
+from allura.lib.utils import chunked_find, BulkWriter
+from allura.model.repo_refresh import refresh_commit_lcds
 from allura.tasks.repo_tasks import refresh
 from allura.scripts import ScriptTask
 
@@ -75,6 +77,8 @@ def _repo_type_list(s):
                             default=False, help='Log names of projects that would have their ')
         parser.add_argument('--limit', action='store', type=int, dest='limit',
                             default=False, help='Limit of how many commits to process')
+        parser.add_argument('--processes', action='store', type=int, dest='processes',
+                            default=1, help='Refresh this many repos in parallel, each in its own process')
         return parser
 
     @classmethod
@@ -92,47 +96,63 @@ def execute(cls, options):
 
         log.info('Refreshing last commit data')
 
+        repos = []
         for chunk in chunked_find(M.Project, q_project):
             for p in chunk:
                 log.info("Refreshing last commit data for project '%s'." %
                          p.shortname)
                 if options.dry_run:
                     continue
-                c.project = p
                 if options.mount_point:
                     mount_points = [options.mount_point]
                 else:
                     mount_points = [ac.options.mount_point for ac in
                                     M.AppConfig.query.find(dict(project_id=p._id))]
-                for app in (p.app_instance(mp) for mp in mount_points):
-                    c.app = app
-                    if not hasattr(app, 'repo'):
-                        continue
-                    if c.app.repo.tool.lower() not in options.repo_types:
-                        log.info("Skipping %r: wrong type (%s)", c.app.repo,
-                                 c.app.repo.tool.lower())
-                        continue
-
-                    c.app.repo.status = 'analyzing'
-                    session(c.app.repo).flush(c.app.repo)
-                    try:
-                        ci_ids = list(
-                            reversed(list(c.app.repo.all_commit_ids())))
-                        if options.clean:
-                            cls._clean(ci_ids)
-
-                        log.info('Refreshing all last commits in %r',
-                                 c.app.repo)
-                        cls.refresh_repo_lcds(ci_ids, options)
-                        new_commit_ids = app.repo.unknown_commit_ids()
-                        if len(new_commit_ids) > 0:
-                            refresh.post()
-                    except:
-                        log.exception('Error refreshing %r', c.app.repo)
-                        raise
-                    finally:
-                        c.app.repo.status = 'ready'
-                        session(c.app.repo).flush(c.app.repo)
+                repos.extend((p._id, mp) for mp in mount_points)
+
+        if options.processes > 1 and len(repos) > 1:
+            pool = cls.process_pool(min(options.processes, len(repos)))
+            try:
+                pool.map(_refresh_repo, [(project_id, mp, options) for project_id, mp in repos])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for project_id, mp in repos:
+                cls.refresh_repo(project_id, mp, options)
+
+    @classmethod
+    def refresh_repo(cls, project_id, mount_point, options):
+        c.project = M.Project.query.get(_id=project_id)
+        app = c.project.app_instance(mount_point)
+        c.app = app
+        if not hasattr(app, 'repo'):
+            return
+        if c.app.repo.tool.lower() not in options.repo_types:
+            log.info("Skipping %r: wrong type (%s)", c.app.repo,
+                     c.app.repo.tool.lower())
+            return
+
+        c.app.repo.status = 'analyzing'
+        session(c.app.repo).flush(c.app.repo)
+        try:
+            ci_ids = list(
+                reversed(list(c.app.repo.all_commit_ids())))
+            if options.clean:
+                cls._clean(ci_ids)
+
+            log.info('Refreshing all last commits in %r',
+                     c.app.repo)
+            cls.refresh_repo_lcds(ci_ids, options)
+            new_commit_ids = app.repo.unknown_commit_ids()
+            if len(new_commit_ids) > 0:
+                refresh.post()
+        except:
+            log.exception('Error refreshing %r', c.app.repo)
+            raise
+        finally:
+            c.app.repo.status = 'ready'
+            session(c.app.repo).flush(c.app.repo)
             ThreadLocalORMSession.flush_all()
 
     @classmethod
@@ -141,40 +161,25 @@ def refresh_repo_lcds(cls, commit_ids, options):
             max_instances={M.repository.LastCommit: 4000},
             max_queries={M.repository.LastCommit: 4000},
         )
-        c.model_cache = model_cache
+        lcds = BulkWriter(M.repository.LastCommitDoc)
         timings = []
         print('Processing last commits')
-        for i, commit_id in enumerate(commit_ids):
-            commit = M.repository.Commit.query.get(_id=commit_id)
-            if commit is None:
-                print("Commit missing, skipping: %s" % commit_id)
-                continue
-            commit.set_context(c.app.repo)
-            with time(timings):
-                tree = commit.tree
-                cls._get_lcds(tree, model_cache)
-                ThreadLocalORMSession.flush_all()
-            if i % 100 == 0:
-                cls._print_stats(i, timings, 100)
-            if options.limit and i >= options.limit:
-                break
+        with h.push_config(c, model_cache=model_cache, lcid_cache={}):
+            for i, commit_id in enumerate(commit_ids):
+                commit = M.repository.Commit.query.get(_id=commit_id)
+                if commit is None:
+                    print("Commit missing, skipping: %s" % commit_id)
+                    continue
+                commit.set_context(c.app.repo)
+                with time(timings):
+                    refresh_commit_lcds(commit, lcds)
+                if i % 100 == 0:
+                    cls._print_stats(i, timings, 100)
+                if options.limit and i >= options.limit:
+                    break
+            lcds.execute()
         ThreadLocalORMSession.flush_all()
 
-    @classmethod
-    def _get_lcds(cls, tree, cache):
-        M.repository.LastCommit.get(tree)
-        """
-        FIXME: if its needed to recurse into subdirectories, and compute their LCDs as well, something along these
-        lines should be enabled.  This is not working as-is, and is not really necessary as this script doesn't
-        get used any more anyway.
-
-        for subtree in tree.tree_ids:
-            if subtree.name in tree.commit.changed_paths:
-                subtree_doc = cache.get(M.repository.Tree, dict(_id=subtree.id))
-                subtree_doc.set_context(tree)
-                cls._get_lcds(subtree_doc, cache)
-        """
-
     @classmethod
     def _clean(cls, commit_ids):
         # delete LastCommitDocs
@@ -201,6 +206,11 @@ def time(timings):
     timings.append((datetime.utcnow() - s).total_seconds())
 
 
+def _refresh_repo(args):
+    # module-level so multiprocessing can pickle it
+    RefreshLastCommits.refresh_repo(*args)
+
+
 if __name__ == '__main__':
     faulthandler.enable()
     RefreshLastCommits.main()
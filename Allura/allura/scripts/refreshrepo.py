@@ -105,6 +105,8 @@ def execute(cls, options):
                                     dict(commit_id={'$in': ci_ids_chunk}))
 
                         del ci_ids
+                        # the deleted commits must be found again
+                        c.app.repo.refreshed_heads = []
 
                     try:
                         if options.all:
@@ -0,0 +1,228 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+import argparse
+import logging
+import time
+from datetime import datetime
+
+from pymongo.errors import DuplicateKeyError
+from tg import app_globals as g
+
+from allura.scripts import ScriptTask
+from allura import model as M
+from allura.model.index import ReindexCheckpointDoc
+from allura.tasks.index_tasks import index_artifacts
+from allura.lib.solr import make_solr_from_config
+from allura.lib.utils import chunked_find
+from allura.lib.exceptions import CompoundError
+
+
+log = logging.getLogger(__name__)
+
+
+class ReindexArtifacts(ScriptTask):
+
+    """
+    Reindex artifacts into Solr (and update their references) by streaming
+    through all ArtifactReferences.
+
+    The work is split into ``--shards`` ranges of reference ids (of roughly
+    equal size, fixed when the run starts), so shards can be run on separate
+    machines (``--shard``) and/or in parallel processes (``--processes``).
+    Progress of each shard is checkpointed in Mongo under the ``--run`` name,
+    and running the same command again resumes where it left off.
+    """
+
+    @classmethod
+    def execute(cls, options):
+        shards = list(range(options.shards)) if options.shard is None else options.shard
+        for shard in shards:
+            if not 0 <= shard < options.shards:
+                return 'Invalid shard %s, must be less than --shards' % shard
+        project_id = None
+        if options.project:
+            project = M.Project.query.get(shortname=options.project)
+            if not project:
+                return 'Project %s not found' % options.project
+            project_id = project._id
+        if options.restart:
+            ReindexCheckpointDoc.m.remove(dict(run=options.run, shard={'$in': shards}, shards=options.shards))
+            if options.shard is None:
+                ReindexCheckpointDoc.m.remove(dict(_id=cls.bounds_id(options)))
+        bounds = cls.shard_bounds(options, project_id)
+
+        if options.processes > 1 and len(shards) > 1:
+            pool = cls.process_pool(min(options.processes, len(shards)))
+            try:
+                pool.map(_run_shard, [(options, shard, project_id, bounds) for shard in shards])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for shard in shards:
+                cls.run_shard(options, shard, project_id, bounds)
+        log.info('Reindex done')
+
+    @classmethod
+    def checkpoint_id(cls, options, shard):
+        return '%s:%d/%d' % (options.run, shard, options.shards)
+
+    @classmethod
+    def bounds_id(cls, options):
+        return '%s/%d' % (options.run, options.shards)
+
+    @classmethod
+    def shard_bounds(cls, options, project_id=None):
+        '''
+        The reference ids at which shards 1..n start.  Computed by the first
+        process to run and saved, so every machine and resumed run uses the
+        same ranges.
+        '''
+        doc = ReindexCheckpointDoc.m.get(_id=cls.bounds_id(options))
+        if doc:
+            return doc.bounds
+        query = {}
+        if project_id:
+            query['artifact_reference.project_id'] = project_id
+        count = M.ArtifactReference.query.find(query).count()
+        bounds = []
+        if count:
+            for shard in range(1, options.shards):
+                ref = M.ArtifactReference.query.find(query).sort('_id').skip(shard * count // options.shards).first()
+                bounds.append(ref._id)
+        try:
+            ReindexCheckpointDoc.make(dict(
+                _id=cls.bounds_id(options), run=options.run, shards=options.shards, bounds=bounds,
+                mod_date=datetime.utcnow())).m.insert()
+        except DuplicateKeyError:
+            # saved by another machine in the meantime
+            return ReindexCheckpointDoc.m.get(_id=cls.bounds_id(options)).bounds
+        return bounds
+
+    @classmethod
+    def run_shard(cls, options, shard, project_id=None, bounds=()):
+        checkpoint_id = cls.checkpoint_id(options, shard)
+        checkpoint = ReindexCheckpointDoc.m.get(_id=checkpoint_id)
+        if checkpoint and checkpoint.done:
+            log.info('Shard %s already done', checkpoint_id)
+            return
+        count = checkpoint.count if checkpoint else 0
+        query = {}
+        if project_id:
+            query['artifact_reference.project_id'] = project_id
+        if shard > 0 and not bounds:
+            # no refs when the ranges were computed, shard 0 takes any added since
+            log.info('Shard %s is empty', checkpoint_id)
+            cls._save_checkpoint(options, shard, count=count, done=True)
+            return
+        id_range = {}
+        if shard > 0:
+            id_range['$gte'] = bounds[shard - 1]
+        if shard < len(bounds):
+            id_range['$lt'] = bounds[shard]
+        if checkpoint and checkpoint.last_ref_id:
+            log.info('Resuming shard %s after %s (%d docs done)', checkpoint_id, checkpoint.last_ref_id, count)
+            id_range.pop('$gte', None)
+            id_range['$gt'] = checkpoint.last_ref_id
+        if id_range:
+            query['_id'] = id_range
+        solr_hosts = options.solr_hosts or g.solr_server
+        if solr_hosts:
+            solr = make_solr_from_config(solr_hosts, commit=False, commitWithin=options.commit_within)
+        else:
+            solr = g.solr  # MockSOLR
+
+        start = time.time()
+        run_count = 0
+        for refs in chunked_find(M.ArtifactReference, query, pagesize=options.batch_size):
+            ref_ids = [ref._id for ref in refs]
+            last_ref_id = refs[-1]._id
+            if ref_ids and not options.dry_run:
+                try:
+                    # the saved hashes are for the default index, so neither
+                    # skip by them nor replace them when indexing elsewhere
+                    run_count += index_artifacts(ref_ids, solr, update_solr=not options.skip_solr,
+                                                 update_refs=not options.skip_refs,
+                                                 force=options.force or bool(options.solr_hosts),
+                                                 save_hashes=not options.solr_hosts)
+                except CompoundError as err:
+                    log.exception('Error indexing artifacts:\n%r', err)
+                    log.error('%s', err.format_error())
+            M.main_orm_session.flush()
+            M.main_orm_session.clear()
+            M.artifact_orm_session.clear()
+            cls._save_checkpoint(options, shard, last_ref_id=last_ref_id, count=count + run_count)
+            elapsed = time.time() - start
+            log.info('Shard %s: %d docs sent (%.1f docs/sec), at %s',
+                     checkpoint_id, count + run_count, run_count / elapsed if elapsed else 0, last_ref_id)
+        cls._save_checkpoint(options, shard, count=count + run_count, done=True)
+        log.info('Shard %s done: %d docs sent', checkpoint_id, count + run_count)
+
+    @classmethod
+    def _save_checkpoint(cls, options, shard, **fields):
+        fields.update(run=options.run, shard=shard, shards=options.shards, mod_date=datetime.utcnow())
+        ReindexCheckpointDoc.m.update_partial(
+            {'_id': cls.checkpoint_id(options, shard)},
+            {'$set': fields},
+            upsert=True)
+
+    @classmethod
+    def parser(cls):
+        parser = argparse.ArgumentParser(description='Reindex all artifacts into Solr (for searching), resumably '
+                                         'and in parallel')
+        parser.add_argument('--run', default='reindex', help='Name of this reindex run, used to save and resume '
+                            'progress')
+        parser.add_argument('--restart', action='store_true', default=False,
+                            help='Discard saved progress for this run and start from the beginning')
+        parser.add_argument('--shards', type=int, default=1, help='Number of shards to split the work into')
+        parser.add_argument('--shard', type=int, action='append', default=None,
+                            help='Only run this shard (0-based).  May be given multiple times.  Use this to split '
+                            'the work across machines.')
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Number of shards to run in parallel in this machine')
+        parser.add_argument('-p', '--project', dest='project', default=None,
+                            help='Restrict reindex to a particular project (by shortname)')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of docs to send to Solr per update')
+        parser.add_argument('--commit-within', type=int, default=60 * 1000,
+                            help='Ask Solr to commit within this many ms (instead of explicit commits)')
+        parser.add_argument('--solr-hosts', type=lambda s: s.split(','), default=None,
+                            help='Override the solr host(s) to post to.  Comma-separated list of solr server URLs')
+        parser.add_argument('--skip-solr', action='store_true', default=False, help="Don't update Solr")
+        parser.add_argument('--force', action='store_true', default=False,
+                            help='Send all docs to Solr, even ones which have not changed since they were last sent')
+        parser.add_argument('--skip-refs', action='store_true', default=False,
+                            help="Don't update artifact references")
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help="Go through the artifact references but don't index anything")
+        return parser
+
+
+def _run_shard(args):
+    # module-level so multiprocessing can pickle it
+    ReindexArtifacts.run_shard(*args)
+
+
+def get_parser():
+    return ReindexArtifacts.parser()
+
+
+if __name__ == '__main__':
+    ReindexArtifacts.main()
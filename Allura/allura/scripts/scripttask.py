@@ -48,8 +48,10 @@ def execute(cls, options):
 from __future__ import absolute_import
 import argparse
 import logging
+import multiprocessing
 
 import six
+import tg
 
 from allura.lib.decorators import task
 from allura.lib.helpers import shlex_split
@@ -96,3 +98,16 @@ def parser(cls):
     def main(cls):
         options = cls.parser().parse_args()
         cls.execute(options)
+
+    @classmethod
+    def process_pool(cls, processes):
+        """Return a multiprocessing.Pool whose worker processes make their own
+        Mongo connections, instead of sharing the ones they inherit when forked."""
+        return multiprocessing.Pool(processes, initializer=_init_pool_process)
+
+
+def _init_pool_process():
+    import ming
+    from ming.orm import ThreadLocalORMSession
+    ThreadLocalORMSession.close_all()
+    ming.configure(**tg.config)
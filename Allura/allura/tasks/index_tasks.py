@@ -21,13 +21,14 @@
 import logging
 from contextlib import contextmanager
 
+import bson
 from tg import app_globals as g
 from tg import tmpl_context as c
 
 from allura.lib import helpers as h
 from allura.lib.decorators import task
 from allura.lib.exceptions import CompoundError
-from allura.lib.solr import make_solr_from_config
+from allura.lib.solr import make_solr_from_config, BufferedSolr
 import six
 
 
@@ -73,7 +74,7 @@ def del_users(user_solr_ids):
     __del_objects(user_solr_ids)
 
 
-@task
+@task(coalesce='union', ordered_with=['allura.tasks.index_tasks.del_artifacts'])
 def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
     '''
     Add the referenced artifacts to SOLR and shortlinks.
@@ -81,44 +82,85 @@ def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
     :param solr_hosts: a list of solr hosts to use instead of the defaults
     :type solr_hosts: [str]
     '''
+    # solr_hosts is used for reindexing into a new/different index, which
+    # won't have the docs whose hashes are saved for the default index, and
+    # whose hashes mustn't replace them either
+    index_artifacts(ref_ids, __get_solr(solr_hosts), update_solr=update_solr, update_refs=update_refs,
+                    force=bool(solr_hosts), save_hashes=not solr_hosts)
+
+
+def index_artifacts(ref_ids, solr, update_solr=True, update_refs=True, force=False, save_hashes=True):
+    '''
+    Add the referenced artifacts to the given :class:`allura.lib.solr.Solr`
+    and update their references.  This is the body of the
+    :func:`add_artifacts` task, usable directly by bulk reindexing code.
+
+    Artifacts whose index doc hasn't changed since it was last sent to solr
+    are skipped, unless ``force`` is set.  The hashes of the docs sent are
+    only saved if ``save_hashes`` is set, which should only be the case when
+    ``solr`` is the default index.
+
+    Returns the number of docs sent to solr.
+    '''
     from allura import model as M
     from allura.lib.search import find_shortlinks
 
     exceptions = []
     solr_updates = []
+    solr_hashes = {}
+    references = {}
     with _indexing_disabled(M.session.artifact_orm_session._get()):
-        for ref in M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})):
+        refs = M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})).all()
+        artifacts = M.ArtifactReference.artifacts_by_ref(refs)
+        for ref in refs:
             try:
-                artifact = ref.artifact
+                artifact = artifacts.get(ref._id)
                 if artifact is None:
                     continue
                 # c.app is normally set, so keep using it.  During a reindex its not though, so set it from artifact
                 with h.push_config(c, app=getattr(c, 'app', None) or artifact.app):
-                    s = artifact.solarize()
-                    if s is None:
+                    doc = artifact.index()
+                    if doc is None:
                         continue
+                    # Find shortlinks in the raw text, not the escaped html
+                    # created by the `solarize()`.
+                    link_text = doc.get('text') or ''
                     if update_solr:
-                        solr_updates.append(s)
+                        doc_hash = artifact.index_hash(doc)
+                        if force or doc_hash != ref.solr_hash:
+                            solr_updates.append(artifact.solarize(doc))
+                            solr_hashes[ref._id] = doc_hash
                     if update_refs:
                         if isinstance(artifact, M.Snapshot):
                             continue
-                        # Find shortlinks in the raw text, not the escaped html
-                        # created by the `solarize()`.
-                        link_text = artifact.index().get('text') or ''
                         shortlinks = find_shortlinks(link_text)
-                        ref.references = [link.ref_id for link in shortlinks]
+                        new_references = [link.ref_id for link in shortlinks]
+                        if new_references != (ref.references or []):
+                            references[ref._id] = new_references
             except Exception:
                 log.error('Error indexing artifact %s', ref._id)
                 exceptions.append(sys.exc_info())
-        __get_solr(solr_hosts).add(solr_updates)
+        if solr_updates:
+            def store_hashes():
+                M.ArtifactReference.set_solr_hashes(solr_hashes)
+            if not save_hashes:
+                solr.add(solr_updates)
+            elif isinstance(solr, BufferedSolr):
+                # only buffered so far, save the hashes once actually sent
+                solr.add(solr_updates, on_sent=store_hashes)
+            else:
+                solr.add(solr_updates)
+                store_hashes()
+        M.ArtifactReference.set_references(references)
 
     if len(exceptions) == 1:
         six.reraise(exceptions[0][0], exceptions[0][1], exceptions[0][2])
     if exceptions:
         raise CompoundError(*exceptions)
+    return len(solr_updates)
 
 
-@task
+@task(coalesce='union', ordered_with=['allura.tasks.index_tasks.add_artifacts'])
 def del_artifacts(ref_ids):
     from allura import model as M
     if ref_ids:
@@ -129,7 +171,9 @@ def del_artifacts(ref_ids):
 
 @task
 def solr_del_project_artifacts(project_id):
+    from allura import model as M
     g.solr.delete(q='project_id_s:%s' % project_id)
+    M.ArtifactReference.clear_solr_hashes({'artifact_reference.project_id': bson.ObjectId(project_id)})
 
 
 @task
@@ -139,7 +183,12 @@ def commit():
 
 @task
 def solr_del_tool(project_id, mount_point_s):
+    from allura import model as M
     g.solr.delete(q='project_id_s:"%s" AND mount_point_s:"%s"' % (project_id, mount_point_s))
+    project = M.Project.query.get(_id=bson.ObjectId(project_id))
+    app_config = project.app_config(mount_point_s) if project else None
+    if app_config:
+        M.ArtifactReference.clear_solr_hashes({'artifact_reference.app_config_id': app_config._id})
 
 @contextmanager
 def _indexing_disabled(session):
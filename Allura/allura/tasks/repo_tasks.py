@@ -21,7 +21,9 @@
 import logging
 import traceback
 
+import tg
 from tg import tmpl_context as c, app_globals as g
+from paste.deploy.converters import asbool
 from ming.odm import session
 
 from allura.lib.decorators import task
@@ -78,6 +80,8 @@ def refresh(**kwargs):
     refresh_tasks_count = M.MonQTask.query.find(q).count()
     if refresh_tasks_count <= 1:  # only this task
         c.app.repo.refresh()
+        if c.app.forkable and c.app.repo.merge_requests_by_statuses('open').count():
+            can_merge_open_mrs.post()
         # checking if we have new commits arrived
         # during refresh and re-queue task if so
         new_commit_ids = c.app.repo.unknown_commit_ids()
@@ -173,6 +177,24 @@ def can_merge(merge_request_id):
     mr.set_can_merge_cache(result)
 
 
+@task(coalesce='drop')
+def can_merge_open_mrs():
+    """
+    Re-check open merge requests against this repo after a push, so their
+    mergeability is already cached when they're next viewed.
+    """
+    log = logging.getLogger(__name__)
+    if asbool(tg.config.get('scm.merge.{}.disabled'.format(c.app.config.tool_name))):
+        return
+    for mr in c.app.repo.merge_requests_by_statuses('open'):
+        if mr.get_can_merge_cache() is not None:
+            continue
+        try:
+            mr.set_can_merge_cache(c.app.repo.can_merge(mr))
+        except Exception:
+            log.exception('Could not check if %s can be merged', mr.url())
+
+
 @task
 def determine_mr_commits(merge_request_id):
     from allura import model as M
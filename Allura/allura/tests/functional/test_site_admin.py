@@ -150,6 +150,17 @@ def test_task_view(self):
         r = r.follow()
         assert 'ready' in r, r
 
+    def test_task_stats(self):
+        import math
+        M.MonQTaskStats.query.remove({})
+        M.MonQTask.post(math.ceil, (12.5,))
+        M.MonQTask.run_ready()
+        r = self.app.get('/nf/admin/task_manager/stats')
+        assert 'math.ceil' in r, r
+        r = self.app.get('/nf/admin/task_manager/stats_json?hours=1')
+        assert_equal(r.json['stats'][0]['task_name'], 'math.ceil')
+        assert_equal(r.json['stats'][0]['count'], 1)
+
     def test_task_new(self):
         r = self.app.get('/nf/admin/task_manager/new')
         assert 'New Task' in r, r
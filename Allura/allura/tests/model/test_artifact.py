@@ -25,12 +25,13 @@
 import re
 from datetime import datetime
 
+import tg
 from tg import tmpl_context as c
 from nose.tools import assert_raises, assert_equal
 from nose import with_setup
 from mock import patch
 from ming.orm.ormsession import ThreadLocalORMSession
-from ming.orm import Mapper
+from ming.orm import Mapper, mapper
 from bson import ObjectId
 from webob import Request
 
@@ -143,6 +144,24 @@ def test_artifactlink():
     assert q_shortlink.count() == 0
 
 
+@with_setup(setUp, tearDown)
+def test_artifacts_by_ref():
+    pages = [WM.Page(title='TestPage%d' % i) for i in range(3)]
+    ThreadLocalORMSession.flush_all()
+    refs = [M.ArtifactReference.from_artifact(pg) for pg in pages]
+    ThreadLocalORMSession.close_all()
+    refs = M.ArtifactReference.query.find(dict(_id={'$in': [r._id for r in refs]})).all()
+    artifacts = M.ArtifactReference.artifacts_by_ref(refs)
+    assert_equal(sorted(a.title for a in artifacts.values()), ['TestPage0', 'TestPage1', 'TestPage2'])
+    for ref in refs:
+        assert_equal(artifacts[ref._id]._id, ref.artifact._id)
+
+    M.ArtifactReference.set_references({refs[0]._id: [refs[1]._id], refs[1]._id: [], refs[2]._id: []})
+    ThreadLocalORMSession.close_all()
+    assert_equal(M.ArtifactReference.query.get(_id=refs[0]._id).references, [refs[1]._id])
+    assert_equal(M.ArtifactReference.query.get(_id=refs[2]._id).references, [])
+
+
 @with_setup(setUp, tearDown)
 def test_gen_messageid():
     assert re.match(r'[0-9a-zA-Z]*.wiki@test.p.localhost',
@@ -192,6 +211,41 @@ def test_versioning():
     assert pg.history().count() == 3
 
 
+def _raw_history(artifact):
+    return list(mapper(WM.PageHistory).collection.m.find(
+        dict(artifact_id=artifact._id), validate=False).sort('version', 1))
+
+
+@with_setup(setUp, tearDown)
+def test_versioning_delta():
+    texts = []
+    pg = WM.Page(title='TestPage4')
+    with h.push_config(tg.config, **{'artifact.snapshot.keyframe_interval': '3'}):
+        for i in range(5):
+            lines = ['line %d\n' % n for n in range(100)]
+            lines[i * 10] = 'edit %d\n' % i
+            pg.text = ''.join(lines)
+            texts.append(pg.text)
+            pg.commit()
+            ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+
+    raw = _raw_history(pg)
+    assert_equal([ss['version'] for ss in raw], [1, 2, 3, 4, 5])
+    assert_equal([ss.get('delta') and ss['delta']['keyframe'] for ss in raw], [None, 1, 1, None, 4])
+    assert_equal(['text' in ss['data'] for ss in raw], [True, False, False, True, False])
+    assert_equal(raw[1]['data']['title'], 'TestPage4')
+
+    pg = WM.Page.query.get(_id=pg._id)
+    for i, text in enumerate(texts):
+        assert_equal(pg.get_version(i + 1).text, text)
+    ThreadLocalORMSession.close_all()
+    pg = WM.Page.query.get(_id=pg._id)
+    assert_equal([ss.text for ss in pg.history()], list(reversed(texts)))
+    pg.revert(3)
+    assert_equal(pg.text, texts[2])
+
+
 @with_setup(setUp, tearDown)
 def test_messages_unknown_lookup():
     from bson import ObjectId
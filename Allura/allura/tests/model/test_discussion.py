@@ -403,6 +403,19 @@ def test_post_url_paginated():
         assert_equal(_p.url_paginated(), url)
 
 
+@with_setup(setUp, tearDown)
+def test_thread_query_posts_before():
+    d = M.Discussion(shortname='test', name='test')
+    t = M.Thread(discussion_id=d._id, subject='Test Thread')
+    ts = datetime.utcnow() - timedelta(days=1)
+    p0 = t.post('post #0', timestamp=ts)
+    p1 = t.post('post #1', timestamp=ts + timedelta(minutes=1))
+    reply = t.post('reply to post #0', parent_id=p0._id, timestamp=ts + timedelta(minutes=2))
+    assert_equal([p._id for p in t.query_posts(before=p1)], [p0._id, reply._id])
+    assert_equal([p._id for p in t.query_posts(before=reply, style='flat')], [p0._id, p1._id])
+    assert_equal(t.query_posts(before=p0).count(), 0)
+
+
 @with_setup(setUp, tearDown)
 def test_post_url_paginated_with_artifact():
     """Post.url_paginated should return link to attached artifact, if any"""
@@ -535,9 +548,62 @@ def test_spam_num_replies(spam_checker):
     t = M.Thread(discussion_id=d._id, subject='Test Thread', num_replies=2)
     M.Post(discussion_id=d._id, thread_id=t._id, status='ok')
     ThreadLocalORMSession.flush_all()
-    p1 = M.Post(discussion_id=d._id, thread_id=t._id, status='spam')
+    p1 = M.Post(discussion_id=d._id, thread_id=t._id, status='ok')
     p1.spam()
     assert_equal(t.num_replies, 1)
+    # already spam, so not counted again
+    p1.spam()
+    assert_equal(t.num_replies, 1)
+
+
+@with_setup(setUp, tearDown)
+def test_post_stats():
+    d = M.Discussion(shortname='test', name='test')
+    t1 = M.Thread.new(discussion_id=d._id, subject='Test Thread')
+    t2 = M.Thread.new(discussion_id=d._id, subject='Test Thread 2')
+    p1 = t1.post('This is a post')
+    time.sleep(0.01)
+    p2 = t1.post('This is another post')
+    time.sleep(0.01)
+    p3 = t2.post('This is a post in another thread')
+    ThreadLocalORMSession.flush_all()
+    assert_equal((t1.num_replies, t2.num_replies), (2, 1))
+    assert_equal((d.num_topics, d.num_posts), (2, 3))
+    assert_equal(t1.last_post_id, p2._id)
+    assert_equal(d.last_post_id, p3._id)
+
+    p3.spam()
+    assert_equal(t2.num_replies, 0)
+    assert_equal((d.num_topics, d.num_posts), (1, 2))
+    assert_equal(t2.last_post_id, None)
+    assert_equal(d.last_post_id, p2._id)
+
+    p2.delete()
+    assert_equal(t1.num_replies, 1)
+    assert_equal(t1.last_post_id, p1._id)
+    assert_equal(d.last_post_id, p1._id)
+
+    # recounting agrees with the incremental updates
+    for obj in (t1, t2, d):
+        before = (obj.num_replies, obj.num_topics, obj.num_posts, obj.last_post_id)
+        obj.update_stats()
+        assert_equal((obj.num_replies, obj.num_topics, obj.num_posts, obj.last_post_id), before)
+
+
+@with_setup(setUp, tearDown)
+def test_prefetch_last_posts():
+    d = M.Discussion(shortname='test', name='test')
+    t1 = M.Thread.new(discussion_id=d._id, subject='Test Thread')
+    t2 = M.Thread.new(discussion_id=d._id, subject='Test Thread 2')
+    p1 = t1.post('This is a post')
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    threads = M.Thread.query.find(dict(_id={'$in': [t1._id, t2._id]})).sort('subject').all()
+    M.Thread.prefetch_last_posts(threads)
+    with mock.patch.object(M.Post, 'query') as query:
+        assert_equal(threads[0].last_post._id, p1._id)
+        assert not query.get.called
+    assert_equal(threads[1].last_post, None)
 
 
 def test_deleted_thread_index():
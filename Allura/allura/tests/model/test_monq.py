@@ -18,12 +18,18 @@
 from __future__ import unicode_literals
 from __future__ import absolute_import
 import pprint
+import threading
+from datetime import datetime, timedelta
+
+import mock
 from nose.tools import with_setup
 
 from ming.orm import ThreadLocalORMSession
+from tg import config
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura import model as M
+from allura.model.monq_model import LocalTaskNotifier
 
 
 def setUp():
@@ -42,3 +48,117 @@ def test_basic_task():
     assert task
     task()
     assert task.result == 'I[5, 6]', task.result
+
+
+@with_setup(setUp)
+def test_post_notifies_waiting_worker():
+    notifier = LocalTaskNotifier()
+    waiting = threading.Event()
+    cond_wait = notifier._cond.wait
+
+    def wait(timeout):
+        # the waiter still holds the lock here, so a notify() after this
+        # blocks until the wait has started, and can't be missed
+        waiting.set()
+        return cond_wait(timeout)
+    notifier._cond.wait = wait
+    with mock.patch('allura.model.monq_model.task_notifier', return_value=notifier):
+        woken = []
+        waiter = threading.Thread(target=lambda: woken.append(notifier.wait(5)))
+        waiter.start()
+        assert waiting.wait(5)
+        M.MonQTask.post(pprint.pformat, ([5, 6],))
+        waiter.join()
+    assert woken == [True], woken
+
+
+def test_local_notifier_timeout():
+    assert not LocalTaskNotifier().wait(0.01)
+
+
+@with_setup(setUp)
+def test_get_batch():
+    for i in range(3):
+        M.MonQTask.post(pprint.pformat, ([i],))
+    M.MonQTask.post(pprint.pprint, ([3],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    assert M.MonQTask.get_batch(size=5) == []
+    tasks = M.MonQTask.get_batch(process='w1', size=2, only=['pprint.pformat'])
+    assert [t.args for t in tasks] == [[[0]], [[1]]], [t.args for t in tasks]
+    assert all(t.state == 'busy' and t.process == 'w1' and t.time_start for t in tasks)
+    M.MonQTask.release(tasks[1:])
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_batch(process='w2', size=5, only=['pprint.pformat'])
+    assert [t.args for t in tasks] == [[[1]], [[2]]], [t.args for t in tasks]
+
+
+@with_setup(setUp)
+def test_post_coalesce_drop():
+    t1 = M.MonQTask.post(pprint.pformat, ([5, 6],), coalesce='drop')
+    t2 = M.MonQTask.post(pprint.pformat, ([5, 6],), coalesce='drop')
+    t3 = M.MonQTask.post(pprint.pformat, ([7],), coalesce='drop')
+    assert t1._id == t2._id
+    assert t1._id != t3._id
+    assert M.MonQTask.query.find().count() == 2
+
+
+@with_setup(setUp)
+def test_post_coalesce_union():
+    t1 = M.MonQTask.post(pprint.pformat, ([1, 2],), coalesce='union')
+    t2 = M.MonQTask.post(pprint.pformat, ([2, 3],), coalesce='union')
+    assert t1._id == t2._id
+    assert M.MonQTask.query.find().count() == 1
+    ThreadLocalORMSession.close_all()
+    task = M.MonQTask.query.get(_id=t1._id)
+    assert sorted(task.args[0]) == [1, 2, 3], task.args
+
+    # busy tasks are never merged into
+    M.MonQTask.get()
+    M.MonQTask.post(pprint.pformat, ([4],), coalesce='union')
+    assert M.MonQTask.query.find().count() == 2
+
+
+@with_setup(setUp)
+def test_post_coalesce_ordered_with():
+    t1 = M.MonQTask.post(pprint.pformat, ([1],), coalesce='union', ordered_with=['pprint.saferepr'])
+    t2 = M.MonQTask.post(pprint.saferepr, ([1],), coalesce='union', ordered_with=['pprint.pformat'])
+    t3 = M.MonQTask.post(pprint.pformat, ([2],), coalesce='union', ordered_with=['pprint.saferepr'])
+    t4 = M.MonQTask.post(pprint.saferepr, ([2],), coalesce='union', ordered_with=['pprint.pformat'])
+    assert len(set([t1._id, t2._id, t3._id, t4._id])) == 4
+    ThreadLocalORMSession.close_all()
+    task = M.MonQTask.query.get(_id=t1._id)
+    assert task.args[0] == [1], task.args
+
+
+@with_setup(setUp)
+def test_post_coalesce_union_limit():
+    with mock.patch.dict(config, {'monq.coalesce_limit': '3'}):
+        t1 = M.MonQTask.post(pprint.pformat, ([1, 2],), coalesce='union')
+        t2 = M.MonQTask.post(pprint.pformat, ([3, 4],), coalesce='union')
+    assert t1._id != t2._id
+
+
+@with_setup(setUp)
+def test_task_stats():
+    M.MonQTaskStats.query.remove({})
+    for i in range(3):
+        M.MonQTask.post(pprint.pformat, ([i],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    for i in range(3):
+        M.MonQTask.get()()
+    stats = M.MonQTaskStats.summary(datetime.utcnow() - timedelta(hours=1))
+    assert len(stats) == 1, stats
+    assert stats[0]['task_name'] == 'pprint.pformat'
+    assert stats[0]['count'] == 3
+    assert stats[0]['errors'] == 0
+    assert stats[0]['run_p95'] == M.MonQTaskStats.buckets[0]
+
+
+def test_task_stats_percentile():
+    hist = {'0': 50, '3': 45, '10': 5}
+    assert M.MonQTaskStats.percentile(hist, 100, 50) == 0.1
+    assert M.MonQTaskStats.percentile(hist, 100, 95) == 5
+    assert M.MonQTaskStats.percentile(hist, 100, 99) is None
+    assert M.MonQTaskStats.percentile({}, 0, 50) is None
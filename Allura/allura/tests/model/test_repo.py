@@ -25,8 +25,10 @@
 import mock
 from nose.tools import assert_equal
 from tg import tmpl_context as c
+import bson
 from bson import ObjectId
-from ming.orm import session
+from ming.orm import session, ThreadLocalORMSession
+from ming.orm.base import state
 from tg import config
 
 from alluratest.controller import setup_basic_test, setup_global_objects
@@ -681,6 +683,65 @@ def test_pruning_instance_flush(self, session):
         session.return_value.expunge.assert_called_once_with(tree1)
 
 
+class TestSharedModelCache(unittest.TestCase):
+    def setUp(self):
+        setup_basic_test()
+        M.repository.SharedModelCache._instance = None
+
+    def tearDown(self):
+        M.repository.SharedModelCache._instance = None
+
+    def _make_tree(self, _id):
+        tree = M.repository.Tree(_id=_id, tree_ids=[], blob_ids=[dict(name='README', id='blob1')], other_ids=[])
+        session(tree).flush(tree)
+        return tree
+
+    def test_disabled_by_default(self):
+        self.assertEqual(M.repository.SharedModelCache.get_instance(), None)
+
+    def test_get(self):
+        self._make_tree('tree1')
+        ThreadLocalORMSession.close_all()
+        with h.push_config(config, **{'scm.model_cache.max_bytes': '100000'}):
+            shared = M.repository.SharedModelCache.get_instance()
+            tree = M.repository.ModelCache().get(M.repository.Tree, {'_id': 'tree1'})
+            self.assertEqual(tree._id, 'tree1')
+            ThreadLocalORMSession.close_all()
+            with mock.patch.object(M.repository.Tree.query, 'get') as tr_get:
+                tree = M.repository.ModelCache().get(M.repository.Tree, {'_id': 'tree1'})
+            assert not tr_get.called
+            self.assertEqual(tree._id, 'tree1')
+            self.assertEqual(tree.by_name['README']['id'], 'blob1')
+            self.assertEqual(shared.pop_thread_stats(), {'Tree': {'hits': 1, 'misses': 1}})
+            self.assertEqual(shared.pop_thread_stats(), {})
+            self.assertEqual(shared.stats()['counts'], {'Tree': {'hits': 1, 'misses': 1}})
+            self.assertEqual(shared.stats()['entries'], 1)
+
+    def test_commits_not_shared(self):
+        ci = M.repository.Commit(_id='ci1', tree_id='tree1', child_ids=[])
+        session(ci).flush(ci)
+        ThreadLocalORMSession.close_all()
+        with h.push_config(config, **{'scm.model_cache.max_bytes': '100000'}):
+            shared = M.repository.SharedModelCache.get_instance()
+            M.repository.ModelCache().get(M.repository.Commit, {'_id': 'ci1'})
+            M.repository.CommitDoc.m.update_partial({'_id': 'ci1'}, {'$set': {'child_ids': ['ci2']}})
+            ThreadLocalORMSession.close_all()
+            ci = M.repository.ModelCache().get(M.repository.Commit, {'_id': 'ci1'})
+            self.assertEqual(ci.child_ids, ['ci2'])
+            self.assertEqual(shared.stats()['entries'], 0)
+
+    def test_eviction(self):
+        tree1 = self._make_tree('tree1')
+        tree2 = self._make_tree('tree2')
+        size = len(bson.BSON.encode(state(tree1).clone()))
+        shared = M.repository.SharedModelCache(max_bytes=size * 3 // 2)
+        shared.set(M.repository.Tree, (('_id', 'tree1'),), tree1)
+        self.assertEqual(shared.size, size)
+        shared.set(M.repository.Tree, (('_id', 'tree2'),), tree2)
+        self.assertEqual(shared.size, size)
+        self.assertEqual(list(shared._docs.keys()), [(M.repository.Tree, (('_id', 'tree2'),))])
+
+
 class TestMergeRequest(object):
 
     def setUp(self):
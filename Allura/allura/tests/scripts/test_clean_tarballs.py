@@ -0,0 +1,74 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+from __future__ import unicode_literals
+from __future__ import absolute_import
+import os
+import time
+
+from nose.tools import assert_equal
+from testfixtures import TempDirectory
+
+from allura.scripts.clean_tarballs import clean_tarballs
+
+
+class TestCleanTarballs(object):
+
+    def _write(self, tmpdir, name, size, age):
+        tmpdir.write(name, b'x' * size)
+        mtime = time.time() - age
+        os.utime(tmpdir.getpath(name), (mtime, mtime))
+
+    def test_lru(self):
+        with TempDirectory() as tmpdir:
+            self._write(tmpdir, 'git/p/pr/proj/code/proj-code-old.zip', 100, 300)
+            self._write(tmpdir, 'git/p/pr/proj/code/proj-code-newer.zip', 100, 200)
+            self._write(tmpdir, 'svn/o/ot/other/code/other-code-rnewest.zip', 100, 100)
+            dirs = [(tmpdir.getpath('git/p/pr/proj/code'), 'proj-code-'),
+                    (tmpdir.getpath('svn/o/ot/other/code'), 'other-code-')]
+            assert_equal(clean_tarballs(dirs, max_bytes=250), (1, 200))
+            tmpdir.compare(['git/p/pr/proj/code/proj-code-newer.zip',
+                            'svn/o/ot/other/code/other-code-rnewest.zip'], files_only=True)
+
+    def test_max_age_and_tmp_files(self):
+        with TempDirectory() as tmpdir:
+            self._write(tmpdir, 'code/p-code-unused.zip', 100, 3 * 86400)
+            self._write(tmpdir, 'code/p-code-used.zip', 100, 3600)
+            self._write(tmpdir, 'code/p-code-interrupted.tmp', 100, 2 * 86400)
+            self._write(tmpdir, 'code/p-code-interrupted.lock', 0, 2 * 86400)
+            self._write(tmpdir, 'code/p-code-running.tmp', 100, 60)
+            self._write(tmpdir, 'code/p-code-running.lock', 0, 60)
+            assert_equal(clean_tarballs([(tmpdir.getpath('code'), 'p-code-')], max_age=86400), (1, 100))
+            tmpdir.compare(['code/p-code-running.lock', 'code/p-code-running.tmp', 'code/p-code-used.zip'],
+                           files_only=True)
+
+    def test_other_files_untouched(self):
+        with TempDirectory() as tmpdir:
+            self._write(tmpdir, 'code/p-code-r1.zip', 100, 3 * 86400)
+            self._write(tmpdir, 'code/index.zip', 100, 3 * 86400)
+            self._write(tmpdir, 'code/other.lock', 0, 3 * 86400)
+            # export tree being zipped, named like the snapshot
+            self._write(tmpdir, 'code/p-code-r2/file.zip', 100, 3 * 86400)
+            self._write(tmpdir, 'code/p-code-r2/file.tmp', 100, 3 * 86400)
+            assert_equal(clean_tarballs([(tmpdir.getpath('code'), 'p-code-')], max_age=86400), (1, 0))
+            tmpdir.compare(['code/index.zip', 'code/other.lock',
+                            'code/p-code-r2/file.tmp', 'code/p-code-r2/file.zip'], files_only=True)
+
+    def test_dry_run(self):
+        with TempDirectory() as tmpdir:
+            self._write(tmpdir, 'code/p-code-a.zip', 100, 300)
+            assert_equal(clean_tarballs([(tmpdir.getpath('code'), 'p-code-')], max_bytes=50, dry_run=True), (1, 0))
+            tmpdir.compare(['code/p-code-a.zip'], files_only=True)
@@ -0,0 +1,98 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+from nose.tools import assert_equal, assert_in
+from ming.orm import ThreadLocalORMSession, mapper
+from testfixtures import LogCapture
+
+from alluratest.controller import setup_basic_test, setup_global_objects
+from allura.lib import helpers as h
+from allura.scripts.compact_snapshots import compact_snapshots
+from allura.tests import decorators as td
+from forgewiki import model as WM
+
+
+class TestCompactSnapshots(object):
+
+    def setUp(self):
+        setup_basic_test()
+        self.setup_with_tools()
+
+    @td.with_wiki
+    def setup_with_tools(self):
+        setup_global_objects()
+        h.set_context('test', 'wiki', neighborhood='Projects')
+        self.texts = []
+        pg = WM.Page(title='Compact Me')
+        for i in range(4):
+            pg.text = ''.join('line %d\n' % n if n != i else 'edit\n' for n in range(100))
+            self.texts.append(pg.text)
+            pg.commit()
+            ThreadLocalORMSession.flush_all()
+        self.page_id = pg._id
+        ThreadLocalORMSession.close_all()
+
+    def _raw_history(self):
+        return list(mapper(WM.PageHistory).collection.m.find(
+            dict(artifact_id=self.page_id), validate=False).sort('version', 1))
+
+    def _texts(self):
+        ThreadLocalORMSession.close_all()
+        pg = WM.Page.query.get(_id=self.page_id)
+        return [pg.get_version(n).text for n in range(1, 5)]
+
+    def test_compact_and_expand(self):
+        assert_equal(compact_snapshots(WM.PageHistory, 2), 2)
+        raw = self._raw_history()
+        assert_equal(['text' in ss['data'] for ss in raw], [True, False, True, False])
+        assert_equal(self._texts(), self.texts)
+
+        # already compacted
+        assert_equal(compact_snapshots(WM.PageHistory, 2), 0)
+
+        assert_equal(compact_snapshots(WM.PageHistory, 0), 2)
+        raw = self._raw_history()
+        assert_equal(['text' in ss['data'] for ss in raw], [True, True, True, True])
+        assert_equal([ss['delta'] for ss in raw], [None, None, None, None])
+        assert_equal(self._texts(), self.texts)
+
+    def test_dry_run(self):
+        assert_equal(compact_snapshots(WM.PageHistory, 2, dry_run=True), 2)
+        raw = self._raw_history()
+        assert_equal(['text' in ss['data'] for ss in raw], [True, True, True, True])
+
+    def test_paging(self):
+        other = WM.Page(title='Other')
+        other.text = 'other page'
+        other.commit()
+        ThreadLocalORMSession.flush_all()
+        assert_equal(compact_snapshots(WM.PageHistory, 2, pagesize=3), 2)
+        assert_equal(['text' in ss['data'] for ss in self._raw_history()], [True, False, True, False])
+        assert_equal(self._texts(), self.texts)
+
+    def test_missing_version(self):
+        assert_equal(compact_snapshots(WM.PageHistory, 4), 3)
+        mapper(WM.PageHistory).collection.m.remove(dict(artifact_id=self.page_id, version=2))
+        raw = self._raw_history()
+        with LogCapture() as logs:
+            assert_equal(compact_snapshots(WM.PageHistory, 0), 0)
+        assert_in('version 3 is stored as a delta, but version 2 is missing',
+                  '\n'.join(r.getMessage() for r in logs.records))
+        assert_equal(self._raw_history(), raw)
@@ -0,0 +1,60 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+from nose.tools import assert_equal
+from ming.orm import ThreadLocalORMSession
+
+from alluratest.controller import setup_basic_test, setup_global_objects
+from allura import model as M
+from allura.lib import helpers as h
+from allura.scripts.reconcile_discussion_stats import reconcile_stats, ReconcileDiscussionStats
+
+
+class TestReconcileDiscussionStats(object):
+
+    def setUp(self):
+        setup_basic_test()
+        setup_global_objects()
+        h.set_context('test', 'wiki', neighborhood='Projects')
+        d = M.Discussion(shortname='test', name='test')
+        t = M.Thread.new(discussion_id=d._id, subject='Test Thread')
+        self.post = t.post('This is a post')
+        ThreadLocalORMSession.flush_all()
+        self.discussion_id, self.thread_id = d._id, t._id
+        # counters that drifted, e.g. from posts removed without Post.delete
+        M.Thread.query.update({'_id': t._id}, {'$set': {'num_replies': 5, 'last_post_id': None}})
+        M.Discussion.query.update({'_id': d._id}, {'$set': {'num_topics': 0, 'num_posts': 7}})
+        ThreadLocalORMSession.close_all()
+
+    def _stats(self):
+        ThreadLocalORMSession.close_all()
+        t = M.Thread.query.get(_id=self.thread_id)
+        d = M.Discussion.query.get(_id=self.discussion_id)
+        return t.num_replies, t.last_post_id, d.num_topics, d.num_posts
+
+    def test_reconcile_stats(self):
+        assert_equal(reconcile_stats(M.Thread, {'_id': self.thread_id}), 1)
+        assert_equal(reconcile_stats(M.Discussion, {'_id': self.discussion_id}), 1)
+        assert_equal(self._stats(), (1, self.post._id, 1, 1))
+        assert_equal(reconcile_stats(M.Thread, {'_id': self.thread_id}), 0)
+
+    def test_execute(self):
+        ReconcileDiscussionStats.execute(ReconcileDiscussionStats.parser().parse_args([]))
+        assert_equal(self._stats(), (1, self.post._id, 1, 1))
@@ -16,11 +16,14 @@
 #       under the License.
 from __future__ import unicode_literals
 from __future__ import absolute_import
+from mock import patch
 from nose.tools import assert_in, assert_equal
 from testfixtures import LogCapture
 
 from allura.scripts.reindex_projects import ReindexProjects
 from allura.scripts.reindex_users import ReindexUsers
+from allura.scripts.reindex_artifacts import ReindexArtifacts
+from allura.model.index import ReindexCheckpointDoc
 from allura.tests.decorators import assert_logmsg_and_no_warnings_or_errors
 from alluratest.controller import setup_basic_test
 from allura import model as M
@@ -74,3 +77,62 @@ def test_with_tasks(self):
         assert_logmsg_and_no_warnings_or_errors(logs, 'Reindex user test-user-1')
         assert_logmsg_and_no_warnings_or_errors(logs, 'Reindex queued')
         assert_equal(M.MonQTask.query.find({'task_name': 'allura.tasks.index_tasks.add_users'}).count(), 1)
+
+
+class TestReindexArtifacts(object):
+
+    def setUp(self):
+        setup_basic_test()
+        ReindexCheckpointDoc.m.remove({})
+
+    def run_script(self, options):
+        cls = ReindexArtifacts
+        opts = cls.parser().parse_args(options)
+        return cls.execute(opts)
+
+    @patch('allura.scripts.reindex_artifacts.index_artifacts')
+    def test_sharded_and_resumable(self, index_artifacts):
+        index_artifacts.side_effect = lambda ref_ids, *a, **kw: len(ref_ids)
+        all_refs = set(r._id for r in M.ArtifactReference.query.find())
+        with LogCapture() as logs:
+            self.run_script(['--shards', '2', '--shard', '0', '--run', 'test'])
+        assert_logmsg_and_no_warnings_or_errors(logs, 'Reindex done')
+        shard0 = set(i for call in index_artifacts.call_args_list for i in call[0][0])
+        bounds = ReindexCheckpointDoc.m.get(_id='test/2').bounds
+        assert_equal(len(bounds), 1)
+        assert shard0
+        assert all(i < bounds[0] for i in shard0)
+
+        # shard 0 is done, so only shard 1 is indexed now
+        index_artifacts.reset_mock()
+        self.run_script(['--shards', '2', '--run', 'test'])
+        shard1 = set(i for call in index_artifacts.call_args_list for i in call[0][0])
+        assert all(i >= bounds[0] for i in shard1)
+        assert_equal(shard0 | shard1, all_refs)
+        assert not shard0 & shard1
+        checkpoint = ReindexCheckpointDoc.m.get(_id='test:1/2')
+        assert checkpoint.done
+        assert_equal(checkpoint.count, len(shard1))
+
+        # --restart starts over
+        index_artifacts.reset_mock()
+        self.run_script(['--shards', '2', '--run', 'test', '--restart'])
+        assert_equal(set(i for call in index_artifacts.call_args_list for i in call[0][0]), all_refs)
+
+    def test_solr_hosts(self):
+        self.run_script(['--run', 'default'])
+        hashes = dict((r._id, r.solr_hash) for r in M.ArtifactReference.query.find(dict(solr_hash={'$ne': None})))
+        assert hashes
+
+        M.main_orm_session.clear()
+        with patch('allura.scripts.reindex_artifacts.make_solr_from_config') as make_solr:
+            self.run_script(['--run', 'other', '--solr-hosts', 'http://other:8983/solr'])
+        # unchanged since the default index was updated, but sent to the other one anyway
+        sent = set(doc['id'] for call in make_solr.return_value.add.call_args_list for doc in call[0][0])
+        assert_equal(sent, set(hashes))
+        M.main_orm_session.clear()
+        assert_equal(dict((r._id, r.solr_hash) for r in M.ArtifactReference.query.find(dict(solr_hash={'$ne': None}))),
+                     hashes)
+
+    def test_invalid_shard(self):
+        assert_in('Invalid shard', self.run_script(['--shards', '2', '--shard', '2']))
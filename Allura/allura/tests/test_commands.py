@@ -225,6 +225,26 @@ def test_update_indexes_order(self):
             collection_call_order[method_name] = i
         assert collection_call_order['ensure_index'] < collection_call_order['drop_index'], collection.mock_calls
 
+    def test_update_ttl_index(self):
+        cmd = show_models.EnsureIndexCommand('ensure_index')
+        collection = Mock(name='collection')
+        collection.index_information.return_value = {'_id_': {'key': '_id'}}
+        cmd._update_ttl_index(collection, 'created', 3600)
+        collection.ensure_index.assert_called_once_with([('created', 1)], background=True, expireAfterSeconds=3600)
+
+        collection.reset_mock()
+        collection.index_information.return_value = {
+            'created_1': {'key': [('created', 1)], 'expireAfterSeconds': 60}}
+        cmd._update_ttl_index(collection, 'created', 3600)
+        assert not collection.ensure_index.called
+        collection.database.command.assert_called_once_with(
+            'collMod', collection.name, index={'keyPattern': {'created': 1}, 'expireAfterSeconds': 3600})
+
+        collection.reset_mock()
+        cmd._update_ttl_index(collection, 'created', 0)
+        collection.drop_index.assert_called_once_with('created_1')
+        assert not collection.ensure_index.called
+
     def test_update_indexes_unique_changes(self):
         collection = Mock(name='collection')
         # expecting these ensure_index calls, we'll make their return values normal
@@ -281,6 +301,27 @@ def test_list(self):
         assert_equal(exit_code, 0)
 
 
+class TestTaskdSupervisor(object):
+
+    def test_pools(self):
+        supervisor = taskd.TaskdSupervisor(Mock())
+        assert_equal(supervisor.pools({}), [
+            dict(name='default', size=1, only=None, batch_size=1, batch_only=None)])
+        conf = {
+            'taskd.pools': 'mail, default',
+            'taskd.pool.mail.size': '3',
+            'taskd.pool.mail.only': 'allura.tasks.mail_tasks.sendmail',
+            'taskd.pool.default.size': '2',
+            'taskd.pool.default.batch_size': '10',
+            'taskd.pool.default.batch_only': 'allura.tasks.index_tasks.add_artifacts',
+        }
+        assert_equal(supervisor.pools(conf), [
+            dict(name='mail', size=3, only='allura.tasks.mail_tasks.sendmail', batch_size=1, batch_only=None),
+            dict(name='default', size=2, only=None, batch_size=10,
+                 batch_only='allura.tasks.index_tasks.add_artifacts'),
+        ])
+
+
 class TestTaskdCleanupCommand(object):
 
     def setUp(self):
@@ -32,7 +32,7 @@
 from tg import tmpl_context as c, app_globals as g
 
 from datadiff.tools import assert_equal
-from nose.tools import assert_in, assert_less
+from nose.tools import assert_in, assert_less, assert_raises
 from ming.orm import FieldProperty, Mapper
 from ming.orm import ThreadLocalORMSession
 from testfixtures import LogCapture
@@ -44,6 +44,7 @@
 from allura.lib import helpers as h
 from allura.lib import search
 from allura.lib.exceptions import CompoundError
+from allura.lib.solr import BufferedSolr
 from allura.tasks import event_tasks
 from allura.tasks import index_tasks
 from allura.tasks import mail_tasks
@@ -91,6 +92,20 @@ def test_can_merge(self, MR):
         val = mr.app.repo.can_merge.return_value
         mr.set_can_merge_cache.assert_called_once_with(val)
 
+    @mock.patch('allura.tasks.repo_tasks.c')
+    def test_can_merge_open_mrs(self, c):
+        cached = mock.Mock()
+        cached.get_can_merge_cache.return_value = True
+        stale = mock.Mock()
+        stale.get_can_merge_cache.return_value = None
+        c.app.config.tool_name = 'git'
+        c.app.repo.merge_requests_by_statuses.return_value = [cached, stale]
+        repo_tasks.can_merge_open_mrs()
+        c.app.repo.merge_requests_by_statuses.assert_called_once_with('open')
+        c.app.repo.can_merge.assert_called_once_with(stale)
+        stale.set_can_merge_cache.assert_called_once_with(c.app.repo.can_merge.return_value)
+        assert not cached.set_can_merge_cache.called
+
 
 # used in test_post_event_from_within_task below
 @task
@@ -216,6 +231,73 @@ def test_add_artifacts(self):
             assert_equal(find_slinks.call_args_list,
                          [mock.call(a.index().get('text')) for a in artifacts])
 
+    @td.with_wiki
+    @mock.patch('allura.tasks.index_tasks.g.solr')
+    def test_add_artifacts_skips_unchanged(self, solr):
+        artifacts = [_TestArtifact(_shorthand_id='ta_%s' % x) for x in range(3)]
+        M.artifact_orm_session.flush()
+        ref_ids = [M.ArtifactReference.from_artifact(a)._id for a in artifacts]
+        M.artifact_orm_session.flush()
+        index_tasks.add_artifacts(ref_ids)
+        assert_equal(len(solr.add.call_args[0][0]), 3)
+
+        solr.reset_mock()
+        M.main_orm_session.clear()
+        index_tasks.add_artifacts(ref_ids)
+        assert_equal(solr.add.call_count, 0)
+
+        artifacts[0].text = 'changed'
+        M.artifact_orm_session.flush()
+        M.main_orm_session.clear()
+        index_tasks.add_artifacts(ref_ids)
+        assert_equal([d['id'] for d in solr.add.call_args[0][0]], [ref_ids[0]])
+
+        solr.reset_mock()
+        M.main_orm_session.clear()
+        index_tasks.index_artifacts(ref_ids, solr, force=True)
+        assert_equal(len(solr.add.call_args[0][0]), 3)
+
+        solr.reset_mock()
+        M.main_orm_session.clear()
+        hashes = dict((r._id, r.solr_hash) for r in M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})))
+        with mock.patch('allura.tasks.index_tasks.make_solr_from_config') as make_solr:
+            artifacts[1].text = 'changed elsewhere'
+            M.artifact_orm_session.flush()
+            M.main_orm_session.clear()
+            index_tasks.add_artifacts(ref_ids, solr_hosts=['http://other:8983/solr'])
+        assert_equal(len(make_solr.return_value.add.call_args[0][0]), 3)
+        # the default index's hashes are kept
+        M.main_orm_session.clear()
+        assert_equal(dict((r._id, r.solr_hash) for r in M.ArtifactReference.query.find(dict(_id={'$in': ref_ids}))), hashes)
+
+    @td.with_wiki
+    def test_add_artifacts_buffered_hashes(self):
+        solr = mock.Mock()
+        buffered = BufferedSolr(solr, max_docs=100, retries=0)
+        artifacts = [_TestArtifact(_shorthand_id='ta_%s' % x) for x in range(3)]
+        M.artifact_orm_session.flush()
+        ref_ids = [M.ArtifactReference.from_artifact(a)._id for a in artifacts]
+        M.artifact_orm_session.flush()
+        with mock.patch('allura.tasks.index_tasks.g.solr', buffered):
+            index_tasks.add_artifacts(ref_ids)
+            assert_equal(solr.add.call_count, 0)
+            M.main_orm_session.clear()
+            # not sent yet, so not skipped
+            index_tasks.add_artifacts(ref_ids)
+            assert_equal(len(buffered.buffer), 6)
+
+            solr.add.side_effect = ValueError('boom')
+            with assert_raises(ValueError):
+                buffered.flush()
+            assert_equal(M.ArtifactReference.query.find(dict(_id={'$in': ref_ids}, solr_hash={'$ne': None})).count(), 0)
+
+            solr.add.side_effect = None
+            buffered.flush()
+            M.main_orm_session.clear()
+            assert_equal(M.ArtifactReference.query.find(dict(_id={'$in': ref_ids}, solr_hash={'$ne': None})).count(), 3)
+            index_tasks.add_artifacts(ref_ids)
+            assert_equal(buffered.buffer, [])
+
     @td.with_wiki
     @mock.patch('allura.tasks.index_tasks.g.solr')
     def test_del_artifacts(self, solr):
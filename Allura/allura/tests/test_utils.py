@@ -114,6 +114,40 @@ def test_chunked_list(self):
         self.assertEqual([el for sublist in chunks for el in sublist], l)
 
 
+class TestBulkWriter(unittest.TestCase):
+
+    def _writer(self, collection, chunk_size=1000):
+        doc_cls = Mock()
+        doc_cls.m.session.db = {doc_cls.m.collection_name: collection}
+        return utils.BulkWriter(doc_cls, chunk_size)
+
+    def test_bulk(self):
+        collection = Mock()
+        bulk = collection.initialize_unordered_bulk_op.return_value
+        writer = self._writer(collection)
+        writer.insert({'_id': 1})
+        writer.replace({'_id': 2}, {'_id': 2, 'a': 1})
+        writer.update({'_id': 3}, {'$set': {'a': 1}}, multi=True)
+        assert not bulk.execute.called
+        writer.execute()
+        bulk.insert.assert_called_once_with({'_id': 1})
+        bulk.find.return_value.upsert.return_value.replace_one.assert_called_once_with({'_id': 2, 'a': 1})
+        bulk.find.return_value.update.assert_called_once_with({'$set': {'a': 1}})
+        bulk.execute.assert_called_once_with()
+        assert_equal(writer.ops, [])
+
+    def test_fallback_and_chunking(self):
+        collection = Mock(spec=['insert', 'update'])
+        writer = self._writer(collection, chunk_size=2)
+        writer.insert({'_id': 1})
+        assert not collection.insert.called
+        writer.replace({'_id': 2}, {'_id': 2})
+        collection.insert.assert_called_once_with({'_id': 1})
+        collection.update.assert_called_once_with({'_id': 2}, {'_id': 2}, upsert=True)
+        writer.execute()
+        assert_equal(collection.update.call_count, 1)
+
+
 class TestAntispam(unittest.TestCase):
 
     def setUp(self):
@@ -17,16 +17,18 @@
 
 from __future__ import unicode_literals
 from __future__ import absolute_import
+import os
 import unittest
 
 import mock
+from nose.tools import assert_raises
 from datadiff.tools import assert_equal
 from markupsafe import Markup
 
 from allura.lib import helpers as h
 from allura.tests import decorators as td
 from alluratest.controller import setup_basic_test
-from allura.lib.solr import Solr, escape_solr_arg
+from allura.lib.solr import Solr, BufferedSolr, MockSOLR, escape_solr_arg
 from allura.lib.search import search_app, SearchIndexable
 
 
@@ -93,6 +95,13 @@ def test_search(self, pysolr):
         solr.search('bar', kw='kw')
         solr.query_server.search.assert_called_once_with('bar', kw='kw')
 
+    @mock.patch('allura.lib.solr.pysolr')
+    def test_add_error(self, pysolr):
+        solr = Solr(['server1', 'server2'], commit=False)
+        pysolr.Solr().add.side_effect = ValueError('boom')
+        with assert_raises(ValueError):
+            solr.add('foo')
+
     @mock.patch('allura.lib.search.search')
     def test_site_admin_search(self, search):
         from allura.lib.search import site_admin_search
@@ -237,3 +246,108 @@ def test_escape_solr_arg_with_backslash(self):
         text = 'some: weird "text" with \\ backslash'
         escaped_text = escape_solr_arg(text)
         assert_equal(escaped_text, r'some\: weird \"text\" with \\ backslash')
+
+
+class TestBufferedSolr(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_solr = MockSOLR()
+        self.solr = mock.Mock(wraps=self.mock_solr)
+        self.buffered = BufferedSolr(self.solr, max_docs=3, max_age=60, retries=0)
+
+    def _docs(self, *ids):
+        return [dict(id=i, text='') for i in ids]
+
+    def test_flush_by_size(self):
+        self.buffered.add(self._docs('a', 'b'))
+        assert_equal(self.solr.add.call_count, 0)
+        self.buffered.add(self._docs('c'))
+        assert_equal(self.solr.add.call_count, 1)
+        assert_equal(sorted(self.mock_solr.db.keys()), ['a', 'b', 'c'])
+
+    @mock.patch('allura.lib.solr.time')
+    def test_flush_by_age(self, time):
+        time.time.return_value = 100
+        self.buffered.add(self._docs('a'))
+        self.buffered.flush_if_due()
+        assert_equal(self.solr.add.call_count, 0)
+        time.time.return_value = 160
+        self.buffered.flush_if_due()
+        assert_equal(self.solr.add.call_count, 1)
+
+    def test_delete_flushes_first(self):
+        self.buffered.add(self._docs('a'))
+        self.buffered.delete(id='a')
+        assert_equal(self.mock_solr.db, {})
+
+    def test_error_without_spool(self):
+        self.solr.add.side_effect = ValueError('boom')
+        self.buffered.add(self._docs('a'))
+        with assert_raises(ValueError):
+            self.buffered.flush()
+        assert_equal(self.mock_solr.db, {})
+        self.solr.add.side_effect = None
+        self.buffered.flush()
+        assert_equal(list(self.mock_solr.db.keys()), ['a'])
+
+    def test_spool(self):
+        import tempfile
+        import shutil
+        spool_dir = tempfile.mkdtemp()
+        try:
+            self.buffered.spool_dir = spool_dir
+            self.solr.add.side_effect = ValueError('boom')
+            self.buffered.add(self._docs('a'))
+            self.buffered.flush()
+            assert_equal(self.mock_solr.db, {})
+            self.solr.add.side_effect = None
+            self.buffered.add(self._docs('b'))
+            self.buffered.flush()
+            assert_equal(sorted(self.mock_solr.db.keys()), ['a', 'b'])
+            assert_equal(os.listdir(spool_dir), [])
+        finally:
+            shutil.rmtree(spool_dir)
+
+    def test_spool_sent_first(self):
+        import tempfile
+        import shutil
+        spool_dir = tempfile.mkdtemp()
+        try:
+            self.buffered.spool_dir = spool_dir
+            self.solr.add.side_effect = ValueError('boom')
+            self.buffered.add([dict(id='a', text='old')])
+            self.buffered.flush()
+            # spooled docs still failing, newer docs are spooled behind them
+            self.solr.add.side_effect = [ValueError('boom')]
+            self.buffered.add([dict(id='a', text='new')])
+            self.buffered.flush()
+            assert_equal(self.solr.add.call_count, 2)
+            assert_equal(len(os.listdir(spool_dir)), 2)
+            self.solr.add.side_effect = None
+            self.buffered.flush()
+            assert_equal(self.mock_solr.db['a']['text'], 'new')
+            assert_equal(os.listdir(spool_dir), [])
+        finally:
+            shutil.rmtree(spool_dir)
+
+    def test_spool_failed(self):
+        import tempfile
+        import shutil
+        spool_dir = tempfile.mkdtemp()
+        try:
+            self.buffered.spool_dir = spool_dir
+            self.buffered.spool_attempts = 2
+            self.solr.add.side_effect = ValueError('boom')
+            self.buffered.add(self._docs('a'))
+            self.buffered.flush()
+            self.buffered.flush()
+            assert_equal(len(os.listdir(spool_dir)), 1)
+            self.buffered.flush()
+            assert_equal(os.listdir(spool_dir), ['failed'])
+            assert_equal(len(os.listdir(os.path.join(spool_dir, 'failed'))), 1)
+            self.solr.add.side_effect = None
+            self.buffered.add(self._docs('b'))
+            self.buffered.flush()
+            assert_equal(list(self.mock_solr.db.keys()), ['b'])
+        finally:
+            shutil.rmtree(spool_dir)
@@ -116,10 +116,13 @@ def index(self, threads=None, limit=None, page=0, count=0, **kw):
         c.discussion = self.W.discussion
         c.discussion_header = self.W.discussion_header
         c.whole_forum_subscription_form = self.W.subscribe_form
+        count = threads.count()
+        threads = threads.skip(start).limit(int(limit)).all()
+        DM.ForumThread.prefetch_last_posts(threads)
         return dict(
             discussion=self.discussion,
-            count=threads.count(),
-            threads=threads.skip(start).limit(int(limit)).all(),
+            count=count,
+            threads=threads,
             limit=limit,
             page=page)
 
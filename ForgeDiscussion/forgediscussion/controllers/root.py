@@ -86,6 +86,7 @@ def index(self, new_forum=False, **kw):
             app_config_id=c.app.config._id,
             parent_id=None, deleted=False)).all()
         forums = [f for f in forums if h.has_access(f, 'read')()]
+        model.Forum.prefetch_last_posts(forums)
         return dict(forums=forums,
                     announcements=announcements,
                     hide_forum=(not new_forum))
@@ -301,6 +302,8 @@ def index(self, limit=None, page=0, **kw):
             parent_id=None, deleted=False)
         ).sort([('shortname', pymongo.ASCENDING)]).skip(start).limit(limit)
         count = forums.count()
+        forums = forums.all()
+        model.Forum.prefetch_last_posts(forums)
         json = dict(forums=[dict(_id=f._id,
                                  name=f.name,
                                  shortname=f.shortname,
@@ -371,6 +374,8 @@ def index(self, limit=None, page=0, **kw):
                               ('last_post_date', pymongo.DESCENDING)])
         topics = topics.skip(start).limit(limit)
         count = topics.count()
+        topics = topics.all()
+        model.Forum.thread_class().prefetch_last_posts(topics)
         json = {}
         json['forum'] = self.forum.__json__(limit=1)  # small limit since we're going to "del" the threads anyway
         # topics replace threads here
@@ -194,7 +194,6 @@ def post(self, subject, text, message_id=None, parent_id=None, **kw):
         post = super(ForumThread, self).post(text, message_id=message_id, parent_id=parent_id, **kw)
         if not self.first_post_id:
             self.first_post_id = post._id
-            self.num_replies = 1
         return post
 
     def set_forum(self, new_forum):
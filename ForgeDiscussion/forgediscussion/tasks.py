@@ -25,7 +25,7 @@
 log = logging.getLogger(__name__)
 
 
-@task
+@task(coalesce='drop')
 def calc_forum_stats(shortname):
     from forgediscussion import model as DM
     forum = DM.Forum.query.get(
@@ -36,7 +36,7 @@ def calc_forum_stats(shortname):
     forum.update_stats()
 
 
-@task
+@task(coalesce='drop')
 def calc_thread_stats(thread_id):
     from forgediscussion import model as DM
     thread = DM.ForumThread.query.get(_id=thread_id)
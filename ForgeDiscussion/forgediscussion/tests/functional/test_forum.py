@@ -426,6 +426,10 @@ def _check():
             'post-0.checked': 'on',
             'spam': 'Spam Marked'})
         _check()
+        ThreadLocalORMSession.close_all()
+        spam_thread = FM.ForumThread.query.get(subject='Test Zero Posts')
+        assert_equal(spam_thread.num_replies, 0)
+        assert_equal(FM.Forum.query.get(shortname='testforum').num_topics, 0)
 
         # test posts deleted
         _post_pending()
@@ -436,6 +440,10 @@ def _check():
             'post-0.checked': 'on',
             'delete': 'Delete Marked'})
         _check()
+        # the thread of the deleted (only) post is deleted too
+        ThreadLocalORMSession.close_all()
+        threads = FM.ForumThread.query.find(dict(subject='Test Zero Posts')).all()
+        assert_equal([t._id for t in threads], [spam_thread._id])
 
     def test_user_filter(self):
         username = 'test_username1'
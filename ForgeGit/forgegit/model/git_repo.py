@@ -18,12 +18,16 @@
 from __future__ import unicode_literals
 from __future__ import absolute_import
 import os
+import re
+import fcntl
 import shutil
 import string
+import binascii
 import logging
 import tempfile
 from datetime import datetime
 from contextlib import contextmanager
+from threading import Timer
 from time import time
 
 import tg
@@ -39,6 +43,7 @@
 from ming.utils import LazyProperty
 
 from allura.lib import helpers as h
+from allura.lib import utils
 from allura.model.repository import topological_sort, prefix_paths_union
 from allura import model as M
 from io import open
@@ -107,6 +112,12 @@ def can_merge(self, mr):
         """
         Given merge request `mr` determine if it can be merged w/o conflicts.
         """
+        if not self._impl.can_write_merge_tree():
+            return self._can_merge_in_place(mr)
+        with self._impl.merge_scratch(mr) as scratch:
+            return scratch.merge_tree('refs/merge/target', mr.downstream.commit_id) is not None
+
+    def _can_merge_in_place(self, mr):
         g = self._impl._git.git
         # http://stackoverflow.com/a/6283843
         # fetch source branch
@@ -118,8 +129,46 @@ def can_merge(self, mr):
             merge_base, mr.target_branch, mr.downstream.commit_id)
         return '+<<<<<<<' not in merge_tree
 
+    def _merge_message(self, mr):
+        return 'Merge {} branch {} into {}\n\n{}'.format(
+            mr.downstream_repo.url(),
+            mr.source_branch,
+            mr.target_branch,
+            h.absurl(mr.url()))
+
     def merge(self, mr):
-        g = self._impl._git.git
+        if not self._impl.can_write_merge_tree():
+            return self._merge_with_clone(mr)
+        author = h.really_unicode(c.user.display_name or c.user.username)
+        env = {
+            'GIT_AUTHOR_NAME': author,
+            'GIT_AUTHOR_EMAIL': 'allura@localhost',  # a public email alias could be nice here
+            'GIT_COMMITTER_NAME': author,
+            'GIT_COMMITTER_EMAIL': 'allura@localhost',
+        }
+        with self._impl.merge_scratch(mr) as scratch:
+            g = scratch._git.git
+            if scratch.is_ancestor(mr.downstream.commit_id, 'refs/merge/target'):
+                # already merged, nothing to do
+                return
+            if scratch.is_ancestor('refs/merge/target', mr.downstream.commit_id):
+                # fast-forward, like `git merge` would
+                merge_commit = mr.downstream.commit_id
+            else:
+                tree = scratch.merge_tree('refs/merge/target', mr.downstream.commit_id)
+                if tree is None:
+                    raise Exception('Merge conflicts between %s and %s' % (
+                        mr.target_branch, mr.downstream.commit_id))
+                with g.custom_environment(**env):
+                    merge_commit = g.commit_tree(
+                        tree,
+                        '-p', 'refs/merge/target',
+                        '-p', mr.downstream.commit_id,
+                        '-m', self._merge_message(mr))
+            # not forced, so this fails if the target branch moved meanwhile
+            g.push(self.full_fs_path, '%s:refs/heads/%s' % (merge_commit, mr.target_branch))
+
+    def _merge_with_clone(self, mr):
         # can't merge in bare repo, so need to clone
         tmp_path = tempfile.mkdtemp()
         try:
@@ -135,12 +184,7 @@ def merge(self, mr):
             author = h.really_unicode(c.user.display_name or c.user.username)
             tmp_repo.git.config('user.name', author.encode('utf8'))
             tmp_repo.git.config('user.email', 'allura@localhost')  # a public email alias could be nice here
-            msg = 'Merge {} branch {} into {}\n\n{}'.format(
-                mr.downstream_repo.url(),
-                mr.source_branch,
-                mr.target_branch,
-                h.absurl(mr.url()))
-            tmp_repo.git.merge(mr.downstream.commit_id, '-m', msg)
+            tmp_repo.git.merge(mr.downstream.commit_id, '-m', self._merge_message(mr))
             tmp_repo.git.push('origin', mr.target_branch)
         finally:
             shutil.rmtree(tmp_path, ignore_errors=True)
@@ -160,6 +204,8 @@ class GitImplementation(M.RepositoryImplementation):
         'if [ -x $$DIR/post-receive-user ]; then\n'
         '  exec $$DIR/post-receive-user\n'
         'fi')
+    # commits per bulk write when streaming a refresh
+    stream_chunk_size = 500
 
     def __init__(self, repo):
         self._repo = repo
@@ -257,7 +303,25 @@ def all_commit_ids(self):
             seen.add(ci.binsha)
             yield ci.hexsha
 
+    def head_commit_ids(self):
+        if self.is_empty():
+            return []
+        return self._git.git.rev_parse('--all').split()
+
+    def new_commit_ids(self, heads, known_heads):
+        if not heads:
+            return []
+        # known heads may have been deleted (and gc'd) since, so ignore missing
+        output = self._git.git.rev_list(
+            '--topo-order', '--ignore-missing', *(list(heads) + ['--not'] + list(known_heads)))
+        return output.split()
+
     def new_commits(self, all_commits=False):
+        if not all_commits:
+            commit_ids = self._repo.new_commit_ids()
+            if commit_ids is not None:
+                from allura.model.repo_refresh import unknown_commit_ids
+                return list(reversed(unknown_commit_ids(commit_ids)))
         graph = {}
 
         to_visit = [self._git.commit(rev=hd.object_id) for hd in self.heads]
@@ -306,6 +370,135 @@ def refresh_commit_info(self, oid, seen, lazy=True):
         self.refresh_tree_info(ci.tree, seen, lazy)
         return True
 
+    def refresh_commits_info(self, commit_ids, lazy=True):
+        '''Stream commits and trees from git's persistent ``cat-file --batch``
+        process, parse the raw objects directly and bulk write them.  Commits
+        and trees that are already stored are skipped when lazy.'''
+        if not asbool(tg.config.get('scm.git.stream_refresh', False)):
+            return super(GitImplementation, self).refresh_commits_info(commit_ids, lazy)
+        from allura.model.repository import CommitDoc, TreeDoc
+        commit_ids = list(commit_ids)
+        known = self._known_ids(CommitDoc, commit_ids) if lazy else set()
+        seen = set()
+        commits = utils.BulkWriter(CommitDoc)
+        # trees are written children first, so a stored tree always has all
+        # of its subtrees stored too (lazy refreshes rely on that)
+        trees = utils.BulkWriter(TreeDoc, ordered=True)
+        count = 0
+        start = time()
+        for chunk in utils.chunked_iter(commit_ids, self.stream_chunk_size):
+            ci_docs = [self._parse_commit(oid, self._read_object(oid))
+                       for oid in chunk if oid not in known]
+            if not ci_docs:
+                continue
+            tree_docs = self._stream_trees(
+                [ci_doc['tree_id'] for ci_doc in ci_docs], seen, lazy)
+            for tree_doc in tree_docs:
+                trees.replace(dict(_id=tree_doc['_id']), tree_doc)
+            trees.execute()
+            for ci_doc in ci_docs:
+                commits.update(dict(_id=ci_doc.pop('_id')), {'$set': ci_doc}, upsert=True)
+            commits.execute()
+            count += len(ci_docs)
+            log.info('Refresh commit info %d (%d trees): %.1f commits/sec',
+                     count, len(seen), count / max(time() - start, 0.001))
+
+    def _known_ids(self, doc_cls, ids):
+        known = set()
+        for chunk in utils.chunked_iter(ids, 1000):
+            q = doc_cls.m.find(dict(_id={'$in': list(chunk)}), {'_id': 1}, validate=False)
+            known.update(doc._id for doc in q)
+        return known
+
+    def _read_object(self, oid):
+        return self._git.git.get_object_data(oid)[3]
+
+    _person_re = re.compile(br'^(.*?) ?<(.*)> (\d+)(?: [+-]\d{4})?$')
+
+    def _parse_person(self, value):
+        m = self._person_re.match(value)
+        if m is None:
+            return Object(name=h.really_unicode(value), email='', date=datetime.utcfromtimestamp(0))
+        name, email, timestamp = m.groups()
+        return Object(
+            name=h.really_unicode(name),
+            email=h.really_unicode(email),
+            date=datetime.utcfromtimestamp(int(timestamp)))
+
+    def _parse_commit(self, oid, raw):
+        headers, _, message = raw.partition(b'\n\n')
+        doc = dict(_id=oid, parent_ids=[], child_ids=[],
+                   message=h.really_unicode(message))
+        for line in headers.split(b'\n'):
+            if line.startswith(b' '):
+                # continuation of a multi-line header (gpgsig, mergetag)
+                continue
+            key, _, value = line.partition(b' ')
+            if key == b'tree':
+                doc['tree_id'] = value.decode('ascii')
+            elif key == b'parent':
+                doc['parent_ids'].append(value.decode('ascii'))
+            elif key == b'author':
+                doc['authored'] = self._parse_person(value)
+            elif key == b'committer':
+                doc['committed'] = self._parse_person(value)
+        return doc
+
+    def _parse_tree(self, oid, raw):
+        '''Return (TreeDoc fields, subtree ids) for a raw tree object'''
+        doc = dict(_id=oid, tree_ids=[], blob_ids=[], other_ids=[])
+        subtree_ids = []
+        pos = 0
+        while pos < len(raw):
+            space = raw.index(b' ', pos)
+            nul = raw.index(b'\0', space)
+            mode = raw[pos:space]
+            name = h.really_unicode(raw[space + 1:nul])
+            hexsha = binascii.hexlify(raw[nul + 1:nul + 21]).decode('ascii')
+            pos = nul + 21
+            if mode == b'160000':
+                continue  # submodule
+            obj = Object(name=name, id=hexsha)
+            if mode.lstrip(b'0') == b'40000':
+                doc['tree_ids'].append(obj)
+                subtree_ids.append(hexsha)
+            else:
+                doc['blob_ids'].append(obj)
+        return doc, subtree_ids
+
+    def _stream_trees(self, root_ids, seen, lazy=True):
+        '''Read all trees reachable from root_ids that are neither in seen
+        nor (when lazy) already stored, one level at a time.  Returns their
+        docs ordered children first.'''
+        from allura.model.repository import TreeDoc
+        docs = {}
+        pending = root_ids
+        while pending:
+            level = []
+            for oid in pending:
+                if oid not in seen:
+                    seen.add(oid)
+                    level.append(oid)
+            if lazy:
+                known = self._known_ids(TreeDoc, level)
+                level = [oid for oid in level if oid not in known]
+            pending = []
+            for oid in level:
+                docs[oid] = self._parse_tree(oid, self._read_object(oid))
+                pending.extend(docs[oid][1])
+        ordered, visited = [], set()
+        for root_id in root_ids:
+            stack = [(root_id, False)]
+            while stack:
+                oid, children_done = stack.pop()
+                if children_done:
+                    ordered.append(docs[oid][0])
+                elif oid in docs and oid not in visited:
+                    visited.add(oid)
+                    stack.append((oid, True))
+                    stack.extend((sub_id, False) for sub_id in docs[oid][1])
+        return ordered
+
     def refresh_tree_info(self, tree, seen, lazy=True):
         from allura.model.repository import TreeDoc
         if lazy and tree.binsha in seen:
@@ -622,6 +815,66 @@ def set_default_branch(self, name):
         self._repo.default_branch_name = name
         session(self._repo).flush(self._repo)
 
+    def last_commit_ids(self, commit, paths):
+        if not asbool(tg.config.get('scm.git.lcd_single_pass', True)):
+            return super(GitImplementation, self).last_commit_ids(commit, paths)
+        return self._last_commit_ids_single_pass(commit, paths)
+
+    def _last_commit_ids_single_pass(self, commit, paths):
+        '''
+        Resolve all the paths with one ``git log --name-only`` walk from
+        commit, attributing each path to the first commit that touches it and
+        stopping as soon as every path is resolved, or lcd_timeout is hit.
+        '''
+        if not paths:
+            return {}
+        timeout = float(tg.config.get('lcd_timeout', 60))
+        start_time = time()
+        paths = set(paths)
+        result = {}
+
+        def resolve(commit_id, files):
+            changed = prefix_paths_union(paths, files)
+            for path in changed:
+                result[path] = commit_id
+            paths.difference_update(changed)
+
+        proc = timer = None
+        try:
+            proc = self._git.git.log(
+                commit._id, '--', *[p.encode('utf-8') for p in paths],
+                format='%x00%H',
+                name_only=True,
+                as_process=True)
+            timer = Timer(timeout, proc.proc.kill)
+            timer.start()
+            commit_id, files = None, set()
+            for line in proc.stdout:
+                line = six.ensure_text(line).rstrip('\n')
+                if line.startswith('\x00'):
+                    if commit_id:
+                        resolve(commit_id, files)
+                        if not paths:
+                            break
+                    commit_id, files = line[1:], set()
+                elif line:
+                    files.add(line)
+            else:
+                if commit_id:
+                    resolve(commit_id, files)
+            if paths and time() - start_time >= timeout:
+                log.error('last_commit_ids timeout for %s on %s',
+                          commit._id, ', '.join(paths))
+        except Exception as e:
+            log.exception('Error in SCM last_commit_ids: %s', e)
+        finally:
+            if timer:
+                timer.cancel()
+            if proc and proc.proc.poll() is None:
+                proc.proc.kill()
+                proc.proc.wait()
+        return result
+
     def _get_last_commit(self, commit_id, paths):
         # git apparently considers merge commits to have "touched" a path
         # if the path is changed in either branch being merged, even though
@@ -724,6 +977,46 @@ def paged_diffs(self, commit_id, start=0, end=None, onlyChangedFiles=False):
 
         return result
 
+    def line_counts(self, commit_id):
+        cmd_args = ['--no-commit-id', '--numstat', '-r', '-z']
+        if asbool(tg.config.get('scm.commit.git.detect_copies', True)):
+            cmd_args += ['-M', '-C']
+        parents = self._git.commit(commit_id).parents
+        if parents:
+            # diff against the first parent only, even for merges
+            cmd_args += [parents[0].hexsha, commit_id]
+        else:
+            cmd_args += ['--root', commit_id]
+        cmd_output = self._git.git.diff_tree(*cmd_args).split('\x00')
+
+        ''' cmd_output will be like:
+        [
+        '1\\t0\\tfilename',
+        '-\\t-\\tbinary file',
+        '3\\t1\\t',  # <-- renames and copies put the old and new names in the next two fields
+        'po/sr.po',
+        'po/sr_Latn.po',
+        ]
+        '''
+
+        def count(n):
+            return None if n == '-' else int(n)
+
+        counts = []
+        x = 0
+        while x < len(cmd_output):
+            if not cmd_output[x].strip():
+                x += 1
+                continue
+            added, removed, path = cmd_output[x].split('\t', 2)
+            if path:
+                x += 1
+            else:
+                path = cmd_output[x + 2]
+                x += 3
+            counts.append((h.really_unicode(path), count(added), count(removed)))
+        return counts
+
     @contextmanager
     def _shared_clone(self, from_path):
         tmp_path = tempfile.mkdtemp()
@@ -741,6 +1034,78 @@ def merge_base(self, mr):
         g.fetch(mr.app.repo.full_fs_path, mr.target_branch)
         return g.merge_base(mr.downstream.commit_id, 'FETCH_HEAD')
 
+    def can_write_merge_tree(self):
+        """`git merge-tree --write-tree` needs git 2.38 or newer"""
+        return self._git.git.version_info >= (2, 38)
+
+    def is_ancestor(self, ancestor, commit):
+        try:
+            self._git.git.merge_base('--is-ancestor', ancestor, commit)
+        except git.GitCommandError as e:
+            if e.status == 1:
+                return False
+            raise
+        return True
+
+    def merge_tree(self, ours, theirs):
+        """
+        Merge `theirs` into `ours` in memory, without a working tree.
+
+        Returns the id of the resulting tree, or None if there are conflicts.
+        """
+        try:
+            out = self._git.git.merge_tree('--write-tree', ours, theirs)
+        except git.GitCommandError as e:
+            if e.status == 1:  # conflicts
+                return None
+            raise
+        return out.splitlines()[0].strip()
+
+    @contextmanager
+    def merge_scratch(self, mr):
+        """
+        Yield a GitImplementation for this repo's merge scratch repo, with
+        `mr`'s target and source branches fetched as refs/merge/target and
+        refs/merge/source.
+
+        The scratch repo is bare and kept under scm.merge.git.scratch_root
+        between calls, so it only needs updating with a fetch.  It borrows
+        this repo's objects through objects/info/alternates, so only commits
+        from the source branch get copied into it, and never into this repo.
+        Calls for the same repo are serialized with a lock file.
+        """
+        root = tg.config.get('scm.merge.git.scratch_root') or os.path.join(
+            tempfile.gettempdir(), 'allura-merge-scratch')
+        path = os.path.join(root, '%s.git' % self._repo._id)
+        try:
+            os.makedirs(root)
+        except OSError:
+            if not os.path.isdir(root):
+                raise
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                start_time = time()
+                try:
+                    if not os.path.isdir(path):
+                        git.Repo.init(path, bare=True)
+                        alternates = os.path.join(path, 'objects', 'info', 'alternates')
+                        with open(alternates, 'w') as f:
+                            f.write(os.path.join(self._repo.full_fs_path, 'objects') + '\n')
+                    scratch = GitImplementation(Object(full_fs_path=path))
+                    g = scratch._git.git
+                    g.fetch(self._repo.full_fs_path, '+%s:refs/merge/target' % mr.target_branch)
+                    g.fetch(mr.downstream_repo.full_fs_path, '+%s:refs/merge/source' % mr.source_branch)
+                except git.GitCommandError:
+                    # start over with a fresh scratch repo next time,
+                    # e.g. if objects it borrowed were pruned from this repo
+                    shutil.rmtree(path, ignore_errors=True)
+                    raise
+                log.info('Merge request scratch repo fetch timing: %s for %s', time() - start_time, path)
+                yield scratch
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
     def merge_request_commits(self, mr):
         """
         Return list of commits to be merged
@@ -30,6 +30,7 @@
 from nose.tools import assert_equal, assert_in, assert_not_in, assert_not_equal
 import pkg_resources
 from nose.tools import assert_regexp_matches
+import tg
 from tg import tmpl_context as c
 from ming.orm import ThreadLocalORMSession
 from mock import patch, PropertyMock
@@ -321,6 +322,26 @@ def test_diff(self):
         assert 'readme' in resp, resp.showbrowser()
         assert '+++' in resp, resp.showbrowser()
 
+    def test_diff_cached(self):
+        ci = self._get_ci()
+        fn = 'tree/README?diff=df30427c488aeab84b2352bdf88a3b19223f9d7a&diformat=regular'
+        self.app.get(ci + fn)
+        assert_equal(M.repository.DiffCacheDoc.m.find().count(), 1)
+        with patch('allura.controllers.repository.FileBrowser._make_diff') as _make_diff:
+            resp = self.app.get(ci + fn)
+        assert not _make_diff.called
+        assert '+++' in resp, resp.showbrowser()
+
+    def test_diff_too_large(self):
+        ci = self._get_ci()
+        fn = 'tree/README?diff=df30427c488aeab84b2352bdf88a3b19223f9d7a'
+        with h.push_config(tg.config, **{'scm.view.diff.max_lines': '1'}):
+            resp = self.app.get(ci + fn)
+            assert 'Load full diff' in resp, resp.showbrowser()
+            assert '+++' not in resp
+            resp = resp.click('Load full diff')
+            assert '+++' in resp, resp.showbrowser()
+
     def test_diff_view_mode(self):
         ci = self._get_ci()
         fn = 'tree/README?diff=df30427c488aeab84b2352bdf88a3b19223f9d7a'
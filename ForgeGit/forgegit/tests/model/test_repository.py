@@ -31,11 +31,13 @@
 import mock
 from tg import tmpl_context as c, app_globals as g
 import tg
+import git
 from ming.base import Object
 from ming.orm import ThreadLocalORMSession, session
 from nose.tools import assert_equal, assert_in, assert_less
 from testfixtures import TempDirectory
 from datadiff.tools import assert_equals
+from nose import SkipTest
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura.lib import helpers as h
@@ -43,7 +45,7 @@
 from allura.tests import decorators as td
 from allura.tests.model.test_repo import RepoImplTestBase
 from allura import model as M
-from allura.model.repo_refresh import send_notifications
+from allura.model.repo_refresh import send_notifications, refresh_last_commits
 from allura.webhooks import RepoPushWebhookSender
 from forgegit import model as GM
 from forgegit.tests import with_git
@@ -392,6 +394,55 @@ def test_refresh(self):
         assert commit2_loc != -1
         assert_less(commit1_loc, commit2_loc)
 
+    def test_refresh_streaming(self):
+        commit_ids = list(self.repo.all_commit_ids())
+        fields = ('tree_id', 'parent_ids', 'message', 'authored', 'committed')
+        expected_commits = dict(
+            (ci._id, dict((f, ci[f]) for f in fields))
+            for ci in M.repository.CommitDoc.m.find(dict(_id={'$in': commit_ids})))
+        expected_trees = dict(
+            (t._id, (t.tree_ids, t.blob_ids))
+            for t in M.repository.TreeDoc.m.find())
+        M.repository.CommitDoc.m.remove(dict(_id={'$in': commit_ids}))
+        M.repository.TreeDoc.m.remove()
+
+        with mock.patch.dict(tg.config, {'scm.git.stream_refresh': 'true'}):
+            self.repo.refresh_commits_info(commit_ids, lazy=True)
+
+        commits = dict(
+            (ci._id, dict((f, ci[f]) for f in fields))
+            for ci in M.repository.CommitDoc.m.find(dict(_id={'$in': commit_ids})))
+        assert_equals(commits, expected_commits)
+        trees = dict(
+            (t._id, (t.tree_ids, t.blob_ids))
+            for t in M.repository.TreeDoc.m.find())
+        assert_equals(trees, expected_trees)
+
+    def test_new_commit_ids(self):
+        assert self.repo.refreshed_heads
+        assert_equal(self.repo.new_commit_ids(), [])
+        assert_equal(self.repo.unknown_commit_ids(), [])
+        master = '1e146e67985dcd71c74de79613719bef7bddca4a'
+        parent = 'df30427c488aeab84b2352bdf88a3b19223f9d7a'
+        assert_equal(self.repo._impl.new_commit_ids([master], [parent]), [master])
+        # known heads that no longer exist are ignored
+        assert_equal(self.repo._impl.new_commit_ids([master], [parent, '0' * 40]), [master])
+
+    def test_refresh_last_commits(self):
+        master = self.repo.commit('master')
+        M.repository.LastCommitDoc.m.remove()
+        with h.push_config(c, model_cache=M.repository.ModelCache(), lcid_cache={}):
+            lcd = M.repository.LastCommit._build(master.tree)
+            session(lcd).expunge(lcd)
+        expected = lcd.by_name
+
+        commit_ids = list(self.repo.all_commit_ids())
+        refresh_last_commits(self.repo, commit_ids)
+        for commit_id in commit_ids:
+            assert M.repository.LastCommitDoc.m.get(commit_id=commit_id, path=''), commit_id
+        doc = M.repository.LastCommitDoc.m.get(commit_id=master._id, path='')
+        assert_equal(dict((e.name, e.commit_id) for e in doc.entries), expected)
+
     def test_notification_email(self):
         send_notifications(
             self.repo, ['1e146e67985dcd71c74de79613719bef7bddca4a', ])
@@ -580,6 +631,29 @@ def test_tarball_status_task(self):
         task.query.session.flush_all()
         assert_equal(self.repo.get_tarball_status('HEAD'), None)
 
+    def test_request_tarball(self):
+        assert_equal(self.repo.request_tarball('HEAD'), 'ready')
+        assert_equal(self.repo.request_tarball('HEAD', ''), 'ready')
+        assert_equal(M.MonQTask.query.find({'task_name': 'allura.tasks.repo_tasks.tarball'}).count(), 1)
+
+    def test_tarball_lock(self):
+        tmpdir = tg.config['scm.repos.tarball.root']
+        zipname = os.path.join(tmpdir, 'git/t/te/test/testgit.git/test-src-git-HEAD.zip')
+        lockname = os.path.join(tmpdir, 'git/t/te/test/testgit.git/test-src-git-HEAD.lock')
+        if os.path.isfile(zipname):
+            os.remove(zipname)
+        assert_equal(self.repo._lock_tarball('HEAD'), lockname)
+        assert_equal(self.repo.get_tarball_status('HEAD'), 'busy')
+        # another worker is creating it
+        self.repo.tarball('HEAD')
+        assert not os.path.isfile(zipname)
+        # stale lock
+        os.utime(lockname, (0, 0))
+        self.repo.tarball('HEAD')
+        assert os.path.isfile(zipname)
+        assert not os.path.isfile(lockname)
+        assert_equal(self.repo.get_tarball_status('HEAD'), 'complete')
+
     def test_is_empty(self):
         assert not self.repo.is_empty()
         with TempDirectory() as d:
@@ -707,7 +781,7 @@ def test_can_merge(self):
                        source_branch='source-branch',
                        target_branch='target-branch',
                        downstream=mock.Mock(commit_id='cid'))
-        git = mock.Mock()
+        git = mock.Mock(version_info=(2, 37, 0))  # no merge-tree --write-tree
         git.merge_tree.return_value = 'clean merge'
         self.repo._impl._git.git = git
         assert_equal(self.repo.can_merge(mr), True)
@@ -732,7 +806,7 @@ def test_merge(self, shutil, GitImplementation, git, tempfile):
                        target_branch='target-branch',
                        url=lambda: '/merge-request/1/',
                        downstream=mock.Mock(commit_id='cid'))
-        _git = mock.Mock()
+        _git = mock.Mock(version_info=(2, 37, 0))
         self.repo._impl._git.git = _git
         self.repo.merge(mr)
         git.Repo.clone_from.assert_called_once_with(
@@ -762,12 +836,74 @@ def test_merge(self, shutil, GitImplementation, git, tempfile):
     @mock.patch('forgegit.model.git_repo.shutil', autospec=True)
     @mock.patch('forgegit.model.git_repo.git', autospec=True)
     def test_merge_raise_exception(self, git, shutil, tempfile):
-        self.repo._impl._git.git = mock.Mock()
+        self.repo._impl._git.git = mock.Mock(version_info=(2, 37, 0))
         git.Repo.clone_from.side_effect = Exception
         with self.assertRaises(Exception):
             self.repo.merge(mock.Mock())
         assert shutil.rmtree.called
 
+    def test_merge_scratch(self):
+        repo = GM.Repository(
+            name='testmerge.git',
+            fs_path=g.tmpdir + '/',
+            url_path='/test/',
+            tool='git',
+            status='creating')
+        if not repo._impl.can_write_merge_tree():
+            raise SkipTest('needs git 2.38+')
+        repo_path = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testgit.git')
+        dirname = os.path.join(repo.fs_path, repo.name)
+        scratch_root = os.path.join(g.tmpdir, 'merge-scratch')
+        for path in (dirname, scratch_root):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        repo.init()
+        repo._impl.clone_from(repo_path)
+        # a target branch that has diverged from the source branch
+        g_ = repo._impl._git.git
+        base = 'df30427c488aeab84b2352bdf88a3b19223f9d7a'
+        with g_.custom_environment(GIT_AUTHOR_NAME='a', GIT_AUTHOR_EMAIL='a@localhost',
+                                   GIT_COMMITTER_NAME='a', GIT_COMMITTER_EMAIL='a@localhost'):
+            target = g_.commit_tree(base + '^{tree}', '-p', base, '-m', 'Diverge')
+        g_.branch('target-branch', target)
+        mr = mock.Mock(downstream_repo=mock.Mock(
+                           full_fs_path=repo_path,
+                           url=lambda: 'downstream-repo-url'),
+                       source_branch='master',
+                       target_branch='target-branch',
+                       url=lambda: '/merge-request/1/',
+                       downstream=mock.Mock(commit_id='1e146e67985dcd71c74de79613719bef7bddca4a'))
+
+        with h.push_config(tg.config, **{'scm.merge.git.scratch_root': scratch_root}):
+            assert_equal(repo.can_merge(mr), True)
+            scratch = os.path.join(scratch_root, '%s.git' % repo._id)
+            with open(os.path.join(scratch, 'objects/info/alternates')) as f:
+                assert_equal(f.read(), os.path.join(dirname, 'objects') + '\n')
+            # fetched into the scratch repo, not the target repo
+            assert_equal(g_.for_each_ref('refs/merge'), '')
+
+            repo.merge(mr)
+        merged = repo._impl._git.commit('target-branch')
+        assert_equal([p.hexsha for p in merged.parents], [target, mr.downstream.commit_id])
+        assert_equal(merged.author.name, 'Test Admin')
+        assert_equal(merged.message,
+                     'Merge downstream-repo-url branch master into target-branch\n\n'
+                     'http://localhost/merge-request/1/\n')
+        assert os.path.isdir(scratch)  # kept for the next merge request
+
+        with h.push_config(tg.config, **{'scm.merge.git.scratch_root': scratch_root}):
+            # already merged, no empty merge commit
+            repo.merge(mr)
+            assert_equal(repo._impl._git.commit('target-branch').hexsha, merged.hexsha)
+            # errors in the caller (e.g. a rejected push) keep the scratch repo
+            with self.assertRaises(git.GitCommandError):
+                with repo._impl.merge_scratch(mr):
+                    raise git.GitCommandError('push', 1)
+        assert os.path.isdir(scratch)
+        shutil.rmtree(dirname)
+        shutil.rmtree(scratch_root)
+
     @mock.patch.dict('allura.lib.app_globals.config',  {'scm.commit.git.detect_copies': 'false'})
     @td.with_tool('test', 'Git', 'src-weird', 'Git', type='git')
     def test_paged_diffs(self):
@@ -1001,12 +1137,41 @@ def test_last_commit_ids(self):
         })
 
     def test_last_commit_ids_threaded(self):
-        with h.push_config(tg.config, lcd_thread_chunk_size=1):
+        with h.push_config(tg.config, lcd_thread_chunk_size=1, **{'scm.git.lcd_single_pass': 'false'}):
             self.test_last_commit_ids()
 
+    def test_last_commit_ids_single_pass_one_process(self):
+        repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testrename.git')
+        impl = GM.git_repo.GitImplementation(mock.Mock(full_fs_path=repo_dir))
+        with mock.patch.object(impl, '_get_last_commit') as _get_last_commit, \
+                mock.patch.object(impl._git.git, 'log', wraps=impl._git.git.log) as git_log:
+            lcds = impl.last_commit_ids(
+                mock.Mock(_id='13951944969cf45a701bf90f83647b309815e6d5'), ['f2.txt', 'f3.txt', 'missing.txt'])
+        self.assertEqual(lcds, {
+            'f2.txt': '259c77dd6ee0e6091d11e429b56c44ccbf1e64a3',
+            'f3.txt': '653667b582ef2950c1954a0c7e1e8797b19d778a',
+        })
+        assert not _get_last_commit.called
+        self.assertEqual(git_log.call_count, 1)
+
+    def test_line_counts(self):
+        repo_dir = pkg_resources.resource_filename(
+            'forgegit', 'tests/data/testrename.git')
+        impl = GM.git_repo.GitImplementation(mock.Mock(full_fs_path=repo_dir))
+        self.assertEqual(impl.line_counts('13951944969cf45a701bf90f83647b309815e6d5'),
+                         [('f3.txt', 1, 0)])
+        # rename
+        self.assertEqual(impl.line_counts('b120505a61225e6c14bee3e5b5862db81628c35c'),
+                         [('f2.txt', 0, 0)])
+        # root commit
+        self.assertEqual(impl.line_counts('7c09182e61af959e4f1fb0e354bab49f14ef810d'),
+                         [('f.txt', 1, 0)])
+
     @mock.patch('forgegit.model.git_repo.GitImplementation._git', new_callable=mock.PropertyMock)
     def test_last_commit_ids_threaded_error(self, _git):
-        with h.push_config(tg.config, lcd_thread_chunk_size=1, lcd_timeout=2):
+        with h.push_config(tg.config, lcd_thread_chunk_size=1, lcd_timeout=2,
+                           **{'scm.git.lcd_single_pass': 'false'}):
             repo_dir = pkg_resources.resource_filename(
                 'forgegit', 'tests/data/testrename.git')
             repo = mock.Mock(full_fs_path=repo_dir)
@@ -1157,6 +1322,24 @@ def test_renamed_file(self):
         self.assertEqual(rename_commit['size'], 19)
         self.assertEqual(commits[2]['size'], 19)
 
+    def test_refresh_last_commits_branches(self):
+        # 259c77d and 653667b both start from b120505's LCD; building one
+        # must not change what the other starts from
+        M.repository.LastCommitDoc.m.remove()
+        commit_ids = list(self.repo.all_commit_ids())
+        expected = {}
+        for commit_id in commit_ids:
+            with h.push_config(c, model_cache=M.repository.ModelCache(), lcid_cache={}):
+                commit = self.repo.commit(commit_id)
+                lcd = M.repository.LastCommit._build(commit.tree)
+                session(lcd).expunge(lcd)
+            expected[commit_id] = lcd.by_name
+
+        refresh_last_commits(self.repo, commit_ids)
+        for commit_id in commit_ids:
+            doc = M.repository.LastCommitDoc.m.get(commit_id=commit_id, path='')
+            assert_equal(dict((e.name, e.commit_id) for e in doc.entries), expected[commit_id])
+
     def test_merge_commit(self):
         merge_sha = '13951944969cf45a701bf90f83647b309815e6d5'
         commit = next(self.repo.log(revs=merge_sha, id_only=False))
@@ -25,6 +25,8 @@
 import subprocess
 import time
 import operator as op
+import threading
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen, PIPE
 from hashlib import sha1
 from io import BytesIO
@@ -39,11 +41,12 @@
 from tg import tmpl_context as c, app_globals as g
 
 from ming.base import Object
-from ming.orm import Mapper, FieldProperty
+from ming.orm import Mapper, FieldProperty, ThreadLocalORMSession
 from ming.utils import LazyProperty
 
 from allura import model as M
 from allura.lib import helpers as h
+from allura.lib import utils
 from allura.model.auth import User
 from allura.model.repository import zipdir
 from allura.model import repository as RM
@@ -370,6 +373,20 @@ def refresh_commit_info(self, oid, seen_object_ids, lazy=True):
             log.info('ClientError processing %r %r, treating as empty',
                      oid, self._repo, exc_info=True)
             log_entry = Object(date='', message='', changed_paths=[])
+        args = self._commit_args(revno, log_entry)
+        if ci_doc:
+            ci_doc.update(**args)
+            ci_doc.m.save()
+        else:
+            ci_doc = CommitDoc(dict(args, _id=oid))
+            try:
+                ci_doc.m.insert(safe=True)
+            except DuplicateKeyError:
+                if lazy:
+                    return False
+        return True
+
+    def _commit_args(self, revno, log_entry):
         log_date = None
         if hasattr(log_entry, 'date'):
             log_date = datetime.utcfromtimestamp(log_entry.date)
@@ -386,17 +403,117 @@ def refresh_commit_info(self, oid, seen_object_ids, lazy=True):
             child_ids=[])
         if revno > 1:
             args['parent_ids'] = [self._oid(revno - 1)]
-        if ci_doc:
-            ci_doc.update(**args)
-            ci_doc.m.save()
-        else:
-            ci_doc = CommitDoc(dict(args, _id=oid))
+        return args
+
+    def refresh_commits_info(self, commit_ids, lazy=True):
+        '''
+        Read the log of whole ranges of revisions with one ``svn log`` call
+        each (``scm.svn.log_chunk_size`` revisions at a time) and bulk write
+        the commits.
+
+        If ``scm.svn.refresh_tree_workers`` is set, the root trees of the
+        refreshed commits are then computed by that many threads, each with
+        its own pysvn client.
+        '''
+        if not asbool(tg.config.get('scm.svn.batch_refresh', False)):
+            return super(SVNImplementation, self).refresh_commits_info(commit_ids, lazy)
+        from allura.model.repository import CommitDoc
+        commit_ids = list(commit_ids)
+        known = set()
+        if lazy:
+            for chunk in utils.chunked_iter(commit_ids, 1000):
+                q = CommitDoc.m.find(dict(_id={'$in': list(chunk)}), {'_id': 1}, validate=False)
+                known.update(doc._id for doc in q)
+        revnos = sorted(self._revno(oid) for oid in commit_ids if oid not in known)
+        chunk_size = asint(tg.config.get('scm.svn.log_chunk_size', 1000))
+        commits = utils.BulkWriter(CommitDoc)
+        count = 0
+        start_time = time.time()
+        for start, end in self._revision_ranges(revnos, chunk_size):
+            log_entries = self._log_range(start, end)
+            for revno in range(start, end + 1):
+                log_entry = log_entries.get(revno, Object())
+                commits.update(
+                    dict(_id=self._oid(revno)),
+                    {'$set': self._commit_args(revno, log_entry)},
+                    upsert=True)
+            commits.execute()
+            count += end - start + 1
+            log.info('Refresh commit info %d: %.1f commits/sec',
+                     count, count / max(time.time() - start_time, 0.001))
+        workers = asint(tg.config.get('scm.svn.refresh_tree_workers', 0))
+        if workers and revnos:
+            self._compute_root_trees([self._oid(revno) for revno in revnos], workers)
+
+    def _revision_ranges(self, revnos, max_size):
+        '''Split sorted revnos into (start, end) ranges of consecutive revisions'''
+        start = end = None
+        for revno in revnos:
+            if start is not None and revno == end + 1 and revno - start < max_size:
+                end = revno
+                continue
+            if start is not None:
+                yield start, end
+            start = end = revno
+        if start is not None:
+            yield start, end
+
+    def _log_range(self, start, end, changed_paths=False):
+        '''
+        Return {revno: log entry} for revisions start to end, read with one
+        call.  If that fails, they are read one at a time, so one bad revision
+        doesn't lose the others.
+        '''
+        try:
+            log_entries = self._svn.log(
+                self._url,
+                revision_start=pysvn.Revision(pysvn.opt_revision_kind.number, start),
+                revision_end=pysvn.Revision(pysvn.opt_revision_kind.number, end),
+                discover_changed_paths=changed_paths)
+        except pysvn.ClientError:
+            if start == end:
+                log.info('ClientError reading log r%s of %r, treating as empty',
+                         start, self._repo, exc_info=True)
+                return {}
+            log.info('ClientError reading log r%s:%s of %r, reading one revision at a time',
+                     start, end, self._repo, exc_info=True)
+            log_entries = {}
+            for revno in range(start, end + 1):
+                log_entries.update(self._log_range(revno, revno, changed_paths))
+            return log_entries
+        return {entry.revision.number: entry for entry in log_entries}
+
+    def _compute_root_trees(self, commit_ids, workers):
+        '''
+        Compute the root tree of each commit in a pool of threads, and store
+        the tree ids on the commits.  pysvn clients can't be shared between
+        threads, so each thread uses its own SVNImplementation.
+        '''
+        from allura.model.repository import CommitDoc
+        local = threading.local()
+
+        def compute(oid):
+            impl = getattr(local, 'impl', None)
+            if impl is None:
+                impl = local.impl = SVNImplementation(self._repo)
             try:
-                ci_doc.m.insert(safe=True)
-            except DuplicateKeyError:
-                if lazy:
-                    return False
-        return True
+                return oid, impl.compute_tree_new(Object(_id=oid))
+            except Exception:
+                log.exception('Error computing root tree of %s in %r', oid, self._repo)
+                return oid, None
+            finally:
+                ThreadLocalORMSession.close_all()
+
+        commits = utils.BulkWriter(CommitDoc)
+        pool = ThreadPool(workers)
+        try:
+            for oid, tree_id in pool.imap_unordered(compute, commit_ids):
+                if tree_id:
+                    commits.update(dict(_id=oid), {'$set': dict(tree_id=tree_id)})
+        finally:
+            pool.close()
+            pool.join()
+        commits.execute()
 
     def compute_tree_new(self, commit, tree_path='/'):
         # always leading slash, never trailing
@@ -808,4 +925,38 @@ def paged_diffs(self, commit_id, start=0, end=None, onlyChangedFiles=False):
 
         return result
 
+    def line_counts(self, commit_id):
+        revno = self._revno(commit_id)
+        tmp_path = tempfile.mkdtemp(prefix='allura-svn-diff-',
+                                    dir=tg.config.get('scm.svn.tmpdir', g.tmpdir))
+        try:
+            diff = self._svn.diff(
+                tmp_path,
+                self._url,
+                revision1=pysvn.Revision(pysvn.opt_revision_kind.number, revno - 1),
+                url_or_path2=self._url,
+                revision2=self._revision(commit_id))
+        except pysvn.ClientError:
+            log.info('Error getting diff of %s on %s',
+                     commit_id, self._url, exc_info=True)
+            return []
+        finally:
+            rmtree(tmp_path, ignore_errors=True)
+        counts = []
+        in_hunk = False
+        for line in h.really_unicode(diff).splitlines():
+            if line.startswith('Index: '):
+                # binary files have no hunks, so their counts stay at 0
+                counts.append([line[len('Index: '):], 0, 0])
+                in_hunk = False
+            elif line.startswith('Property changes on: '):
+                in_hunk = False
+            elif line.startswith('@@'):
+                in_hunk = True
+            elif in_hunk and line.startswith('+'):
+                counts[-1][1] += 1
+            elif in_hunk and line.startswith('-'):
+                counts[-1][2] += 1
+        return [tuple(count) for count in counts]
+
 Mapper.compile_all()
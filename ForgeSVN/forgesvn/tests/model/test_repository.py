@@ -31,6 +31,7 @@
 
 from tg import tmpl_context as c, app_globals as g
 import mock
+import pysvn
 from nose.tools import assert_equal, assert_in
 from datadiff.tools import assert_equals
 import tg
@@ -378,6 +379,45 @@ def test_paged_diffs(self):
         empty = M.repository.Commit(_id=fake_id, repo=self.repo).paged_diffs()
         self.assertEqual(sorted(actual.keys()), sorted(empty.keys()))
 
+    def test_refresh_batch(self):
+        commit_ids = list(self.repo.all_commit_ids())
+        query = {'_id': {'$in': commit_ids}}
+        expected = {ci._id: ci for ci in M.repository.CommitDoc.m.find(query)}
+        M.repository.CommitDoc.m.remove(query)
+        with h.push_config(tg.config, **{'scm.svn.batch_refresh': 'true',
+                                         'scm.svn.log_chunk_size': '2',
+                                         'scm.svn.refresh_tree_workers': '2'}), \
+                mock.patch.object(self.repo._impl, 'refresh_commit_info') as refresh_commit_info, \
+                mock.patch.object(self.repo._impl._svn, 'log', wraps=self.repo._impl._svn.log) as svn_log:
+            self.repo.refresh_commits_info(commit_ids)
+        assert not refresh_commit_info.called
+        self.assertEqual(svn_log.call_count, (len(commit_ids) + 1) // 2)
+        for ci in M.repository.CommitDoc.m.find(query):
+            for field in ('message', 'parent_ids', 'authored', 'committed'):
+                self.assertEqual(ci[field], expected[ci._id][field])
+            self.assertEqual(ci.tree_id, self.repo._impl._tree_oid(ci._id, '/'))
+        self.assertEqual(M.repository.CommitDoc.m.find(query).count(), len(commit_ids))
+
+    def test_log_range_error(self):
+        svn_log = self.repo._impl._svn.log
+
+        def log(url, revision_start, revision_end, **kw):
+            if revision_start.number <= 2 <= revision_end.number:
+                if revision_start.number == revision_end.number:
+                    raise pysvn.ClientError('bad revision')
+                raise pysvn.ClientError('bad range')
+            return svn_log(url, revision_start=revision_start, revision_end=revision_end, **kw)
+        with mock.patch.object(self.repo._impl._svn, 'log', side_effect=log):
+            entries = self.repo._impl._log_range(1, 3)
+        self.assertEqual(sorted(entries.keys()), [1, 3])
+        self.assertEqual(entries[3].revision.number, 3)
+
+    def test_line_counts(self):
+        counts = self.repo.line_counts(self.repo._impl._oid(3))
+        self.assertEqual([path for path, added, removed in counts], ['README'])
+        path, added, removed = counts[0]
+        assert added > 0
+
     def test_diff_create_file(self):
         entry = self.repo.commit(next(self.repo.log(1, id_only=True, limit=1)))
         self.assertEqual(
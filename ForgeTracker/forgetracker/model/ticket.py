@@ -34,6 +34,7 @@
 import jinja2
 
 from ming import schema
+from ming.base import Object
 from ming.utils import LazyProperty
 from ming.orm import Mapper, session
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty
@@ -44,6 +45,7 @@
 
 from allura.model import (
     ACE,
+    ACL,
     DENY_ALL,
 
     AppConfig,
@@ -61,6 +63,7 @@
     VotableArtifact,
 
     artifact_orm_session,
+    project_doc_session,
     project_orm_session,
     AlluraUserProperty,
     Shortlink
@@ -118,6 +121,8 @@ class __mongometa__:
     # [dict(name=str,hits=int,closed=int)])
     _milestone_counts = FieldProperty(schema.Deprecated)
     _milestone_counts_expire = FieldProperty(schema.Deprecated)  # datetime)
+    # counts of public tickets by milestone, see milestone_counts
+    _milestone_counts_cache = FieldProperty(None, if_missing=None)
     show_in_search = FieldProperty({str: bool}, if_missing={'ticket_num': True,
                                                             'summary': True,
                                                             '_milestone': True,
@@ -223,22 +228,109 @@ def milestone_count(self, name):
         d = dict(name=name, hits=0, closed=0)
         if not (fld_name and m_name):
             return d
-        mongo_query = {
-            'custom_fields.%s' % fld_name: m_name,
-            'app_config_id': self.app_config_id,
-            'deleted': False
-        }
-        d['hits'] = Ticket.query.find(dict(mongo_query, acl=[])).count()
-        d['closed'] = Ticket.query.find(dict(mongo_query, acl=[],
-                                             status={'$in': list(self.set_of_closed_status_names)})).count()
-
-        secured_tickets = Ticket.query.find(dict(mongo_query, acl={"$ne": []}))
-        if secured_tickets.count():
-            tickets = [t for t in secured_tickets if security.has_access(t, 'read')]
-            d['hits'] += len(tickets)
-            d['closed'] += sum(1 for t in tickets if t.status in self.set_of_closed_status_names)
+        d['hits'], d['closed'] = self.milestone_counts().get((fld_name, m_name), (0, 0))
         return d
 
+    def milestone_counts(self):
+        """
+        Return {(field name, milestone name): (hits, closed)} for all the
+        milestone fields, counting only tickets the current user can read.
+
+        Public tickets are counted once and the counts are cached until a
+        ticket is saved (which updates its mod_date) or deleted.  Private
+        tickets are checked against the user's roles on every call, but
+        computed at most once per request and user.
+        """
+        memo = self.__dict__.setdefault('_milestone_counts_memo', {})
+        if c.user._id not in memo:
+            memo[c.user._id] = self._count_milestones()
+        return memo[c.user._id]
+
+    def _count_milestones(self):
+        fields = sorted(fld.name for fld in self.milestone_fields)
+        closed_names = self.set_of_closed_status_names
+        tickets = project_doc_session.db[Ticket.__mongometa__.name]
+        query = dict(app_config_id=self.app_config_id, deleted=False)
+        projection = dict(status=True)
+        projection.update(('custom_fields.%s' % f, True) for f in fields)
+
+        def count(counts, ticket):
+            closed = ticket.get('status') in closed_names
+            custom_fields = ticket.get('custom_fields') or {}
+            for f in fields:
+                m_name = custom_fields.get(f)
+                if m_name:
+                    hits_closed = counts.setdefault((f, m_name), [0, 0])
+                    hits_closed[0] += 1
+                    hits_closed[1] += closed
+
+        last_saved = tickets.find(query, dict(mod_date=True)).sort('mod_date', pymongo.DESCENDING).limit(1)
+        key = dict(fields=fields,
+                   closed_status_names=sorted(closed_names),
+                   count=Ticket.query.find(query).count(),
+                   mod_date=next((t.get('mod_date') for t in last_saved), None))
+        cache = self._milestone_counts_cache
+        if cache and cache.get('key') == key:
+            counts = dict(((f, m_name), [hits, closed]) for f, m_name, hits, closed in cache['counts'])
+        else:
+            counts = {}
+            for ticket in tickets.find(dict(query, acl=[]), projection):
+                count(counts, ticket)
+            # milestone names may contain dots, so they can't be keys in mongo;
+            # $set rather than flush, so this never overwrites last_ticket_num
+            Globals.query.update({'_id': self._id}, {'$set': {'_milestone_counts_cache': dict(
+                key=key,
+                counts=[[f, m_name, hits, closed] for (f, m_name), (hits, closed) in counts.items()])}})
+
+        can_read = self._private_ticket_reader()
+        projection['acl'] = True
+        for ticket in tickets.find(dict(query, acl={'$ne': []}), projection):
+            readable = can_read(ticket['acl'])
+            if readable is None:
+                readable = security.has_access(Ticket.query.get(_id=ticket['_id']), 'read')()
+            if readable:
+                count(counts, ticket)
+        return dict((k, tuple(v)) for k, v in counts.items())
+
+    def _private_ticket_reader(self):
+        """
+        Return a function which tells from a ticket's acl whether the current
+        user can read it, by the same rules as security.has_access, but using
+        only the user's roles so that no tickets need loading.  It returns
+        None when the answer depends on the tracker's acl, which is the case
+        only for acls not ending in DENY_ALL, unlike those of private tickets.
+        """
+        project = self.app_config.project.root_project
+        user_roles = security.Credentials.get().user_roles(user_id=c.user._id, project_id=project._id)
+        reaching_ids = user_roles.reaching_ids
+        if c.user != User.anonymous():
+            own_ids = [r['_id'] for r in user_roles]
+        else:
+            own_ids = []
+        is_admin = []
+
+        def can_read(acl):
+            acl = [Object(ace) for ace in acl]
+            for rid in own_ids:
+                if ACL.contains(ACE.deny(rid, 'read'), acl):
+                    return False
+            chainable = False
+            for rid in reaching_ids:
+                for ace in acl:
+                    if ACE.match(ace, rid, 'read'):
+                        if ace.access == ACE.ALLOW:
+                            return True
+                        break
+                else:
+                    chainable = True
+            if chainable:
+                return None
+            if not is_admin:
+                is_admin.append(bool(security.has_access(project.neighborhood, 'admin')() or
+                                     security.has_access(project, 'admin')()))
+            return is_admin[0]
+        return can_read
+
     def invalidate_bin_counts(self):
         '''Force expiry of bin counts and queue them to be updated.'''
         # To prevent multiple calls to this method from piling on redundant
@@ -634,6 +726,7 @@ class __mongometa__:
         indexes = [
             'ticket_num',
             ('app_config_id', 'custom_fields._milestone'),
+            ('app_config_id', 'mod_date'),
             'import_id',
         ]
         unique_indexes = [
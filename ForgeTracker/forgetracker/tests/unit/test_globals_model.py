@@ -25,8 +25,9 @@
 from ming.orm.ormsession import ThreadLocalORMSession
 
 import forgetracker
-from forgetracker.model import Globals
+from forgetracker.model import Globals, Ticket
 from forgetracker.tests.unit import TrackerTestWithModel
+from allura import model as M
 from allura.lib import helpers as h
 
 
@@ -137,6 +138,41 @@ def test_update_bin_counts(self, mock_dt, mock_search, mock_bin):
         assert_equal(gbl._bin_counts_expire, now + timedelta(minutes=60))
         assert_equal(gbl._bin_counts_invalidated, None)
 
+    def test_milestone_counts(self):
+        Ticket(ticket_num=1, summary='a', status='open', custom_fields=dict(_milestone='1.0'))
+        Ticket(ticket_num=2, summary='b', status='closed', custom_fields=dict(_milestone='1.0'))
+        t = Ticket(ticket_num=3, summary='c', status='open', custom_fields=dict(_milestone='2.0'))
+        t.private = True
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+
+        def gbl():
+            return Globals.query.get(app_config_id=c.app.config._id)
+
+        counts = dict(name='_milestone:1.0', hits=2, closed=1)
+        assert_equal(gbl().milestone_count('_milestone:1.0'), counts)
+        # c.user (a project admin) can read the private ticket, anonymous can't
+        assert_equal(gbl().milestone_count('_milestone:2.0')['hits'], 1)
+        with h.push_config(c, user=M.User.anonymous()):
+            assert_equal(gbl().milestone_count('_milestone:2.0')['hits'], 0)
+
+        # public counts are cached, so they come from the cache next time
+        ThreadLocalORMSession.close_all()
+        cache = gbl()._milestone_counts_cache
+        assert_equal(cache['counts'], [['_milestone', '1.0', 2, 1]])
+        Globals.query.update({'_id': gbl()._id}, {'$set': {
+            '_milestone_counts_cache.counts': [['_milestone', '1.0', 5, 0]]}})
+        ThreadLocalORMSession.close_all()
+        assert_equal(gbl().milestone_count('_milestone:1.0')['hits'], 5)
+
+        # until a ticket is saved
+        ThreadLocalORMSession.close_all()
+        t = Ticket.query.get(ticket_num=1)
+        t.status = 'closed'
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        assert_equal(gbl().milestone_count('_milestone:1.0'), dict(counts, closed=2))
+
     def test_append_new_labels(self):
         gbl = Globals()
         assert_equal(gbl.append_new_labels([], ['tag1']), ['tag1'])
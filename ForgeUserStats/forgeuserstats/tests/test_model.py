@@ -461,6 +461,7 @@ def test_count_loc(self, unified_diff):
                 added=[mock.MagicMock()],
             ),
         )
+        newcommit.repo.line_counts.return_value = None
         unified_diff.return_value = ['+++', '---', '+line']
         newcommit.tree.get_blob_by_path.return_value = mock.MagicMock()
         newcommit.tree.get_blob_by_path.return_value.__iter__.return_value = [
@@ -483,3 +484,22 @@ def test_count_loc(self, unified_diff):
         self.assertEqual(stats.general[0].commits[0],
                          {'lines': 3, 'number': 2, 'language': None})
         assert not unified_diff.called
+
+    def test_count_loc_line_counts(self):
+        stats = USM.UserStats()
+        newcommit = mock.Mock()
+        newcommit.repo.line_counts.return_value = [
+            ('a.py', 3, 1),
+            ('image.png', None, None),
+            ('generated.js', 20000, 0),
+        ]
+        project = mock.Mock(trove_topic=[], trove_language=[])
+        stats.addCommit(newcommit, datetime.utcnow(), project)
+        self.assertEqual(stats.general[0].commits[0],
+                         {'lines': 3, 'number': 1, 'language': None})
+        newcommit.repo.line_counts.assert_called_once_with(newcommit._id)
+        assert not newcommit.repo.commit.called
+        with h.push_config(config, **{'userstats.count_lines_of_code.max_file_lines': '0'}):
+            stats.addCommit(newcommit, datetime.utcnow(), project)
+        self.assertEqual(stats.general[0].commits[0],
+                         {'lines': 20006, 'number': 2, 'language': None})
@@ -18,6 +18,7 @@
 from __future__ import unicode_literals
 from __future__ import absolute_import
 from datetime import datetime
+from collections import Counter
 import difflib
 import os
 
@@ -40,6 +41,7 @@
     User,
     BaseAttachment,
     Notification,
+    project_doc_session,
     project_orm_session,
     Shortlink,
 )
@@ -109,11 +111,21 @@ class __mongometa__:
         name = str('page')
         history_class = PageHistory
         unique_indexes = [('app_config_id', 'title')]
+        indexes = [
+            ('app_config_id', 'last_edit_date'),
+            ('app_config_id', 'labels'),
+        ]
 
     title = FieldProperty(str)
     text = FieldProperty(schema.String, if_missing='')
     text_cache = FieldProperty(MarkdownCache)
     viewable_by = FieldProperty(schema.Deprecated)
+    # copied from the latest snapshot, so listings don't need to query history
+    last_edit_date = FieldProperty(datetime, if_missing=None)
+    last_edit_by = FieldProperty(dict(
+        id=schema.ObjectId,
+        username=str,
+        display_name=str))
     type_s = 'Wiki'
 
     @property
@@ -152,6 +164,11 @@ def __json__(self, posts_limit=None, is_export=False):
     def commit(self, subscribe=False):
         if subscribe:
             self.subscribe()
+        self.last_edit_date = datetime.utcnow()
+        self.last_edit_by = dict(
+            id=context.user._id,
+            username=context.user.username,
+            display_name=context.user.get_pref('display_name'))
         ss = VersionedArtifact.commit(self)
         session(self).flush()
         if self.version > 1:
@@ -233,6 +250,16 @@ def upsert(cls, title, version=None):
                 {'artifact_id': pg._id, 'version': int(version)}).one()
             return ss
 
+    @classmethod
+    def label_counts(cls, criteria):
+        """
+        Count the pages matching `criteria` that have each label, reading
+        just the labels instead of loading whole pages
+        """
+        pages = project_doc_session.db[cls.__mongometa__.name].find(
+            dict(criteria, labels={'$ne': []}), {'_id': False, 'labels': True})
+        return Counter(label for page in pages for label in page.get('labels') or [])
+
     @classmethod
     def find_page(cls, title):
         """Find page with `title`"""
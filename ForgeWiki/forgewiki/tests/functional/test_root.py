@@ -840,6 +840,20 @@ def test_user_browse_page(self):
         r = self.app.get('/wiki/browse_pages/')
         assert '<td>Test Admin (test-admin)</td>' in r
 
+    def test_browse_pages_recent(self):
+        for title in ('aaa', 'bbb', 'aaa'):
+            self.app.post('/wiki/%s/update' % title, params={
+                'title': title,
+                'text': title,
+                'labels': '',
+                })
+        r = self.app.get('/wiki/browse_pages/?sort=recent&limit=1')
+        assert '>aaa</a>' in r
+        assert '>bbb</a>' not in r
+        r = self.app.get('/wiki/browse_pages/?sort=recent&limit=1&page=1')
+        assert '>bbb</a>' in r
+        assert '>aaa</a>' not in r
+
     def test_subscribe(self):
         user = M.User.query.get(username='test-user')
         # user is not subscribed
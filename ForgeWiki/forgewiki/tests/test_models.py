@@ -97,3 +97,26 @@ def test_authors(self):
         assert len(authors) == 1
         assert user not in authors
         assert admin in authors
+
+    @td.with_wiki
+    def test_last_edit(self):
+        user = M.User.by_username('test-user')
+        page = Page.upsert('test-page')
+        page.commit()
+        with h.push_config(c, user=user):
+            page.text = 'user'
+            page.commit()
+        ss = page.history().first()
+        assert page.last_edit_date <= ss.timestamp
+        assert page.last_edit_by.id == user._id
+        assert page.last_edit_by.username == 'test-user'
+        assert page.last_edit_by.display_name == 'Test User'
+
+    @td.with_wiki
+    def test_label_counts(self):
+        for title, labels in [('a', ['x', 'y']), ('b', ['y']), ('c', [])]:
+            page = Page.upsert(title)
+            page.labels = labels
+            page.commit()
+        counts = Page.label_counts(dict(app_config_id=c.app.config._id, deleted=False))
+        assert counts == {'x': 1, 'y': 2}, counts
@@ -30,6 +30,7 @@
 from tg import tmpl_context as c, app_globals as g
 from tg import request
 from formencode import validators
+import pymongo
 from webob import exc
 from ming.orm import session
 
@@ -433,9 +434,7 @@ def browse_pages(self, sort='alpha', show_deleted=False, page=0, limit=None, **k
         c.page_list = W.page_list
         c.page_size = W.page_size
         limit, pagenum, start = g.handle_paging(limit, page, default=25)
-        count = 0
         pages = []
-        uv_pages = []
         criteria = dict(app_config_id=c.app.config._id)
         can_delete = has_access(c.app, 'delete')()
         show_deleted = show_deleted and can_delete
@@ -444,24 +443,25 @@ def browse_pages(self, sort='alpha', show_deleted=False, page=0, limit=None, **k
         q = WM.Page.query.find(criteria)
         if sort == 'alpha':
             q = q.sort('title')
+        elif sort == 'recent':
+            # pages never edited since last_edit_date was added sort last,
+            # as pages without history used to
+            q = q.sort([('last_edit_date', pymongo.DESCENDING), ('title', pymongo.ASCENDING)])
         count = q.count()
         q = q.skip(start).limit(int(limit))
         for page in q:
-            recent_edit = page.history().first()
             p = dict(title=page.title, url=page.url(), deleted=page.deleted)
-            if recent_edit:
-                p['updated'] = recent_edit.timestamp
-                p['user_label'] = recent_edit.author.display_name
-                p['user_name'] = recent_edit.author.username
-                pages.append(p)
+            if page.last_edit_date:
+                p['updated'] = page.last_edit_date
+                p['user_label'] = page.last_edit_by.display_name
+                p['user_name'] = page.last_edit_by.username
             else:
-                if sort == 'recent':
-                    uv_pages.append(p)
-                else:
-                    pages.append(p)
-        if sort == 'recent':
-            pages.sort(reverse=True, key=lambda x: (x['updated']))
-            pages = pages + uv_pages
+                recent_edit = page.history().first()
+                if recent_edit:
+                    p['updated'] = recent_edit.timestamp
+                    p['user_label'] = recent_edit.author.display_name
+                    p['user_name'] = recent_edit.author.username
+            pages.append(p)
         return dict(
             pages=pages, can_delete=can_delete, show_deleted=show_deleted,
             limit=limit, count=count, page=pagenum)
@@ -476,24 +476,21 @@ def browse_tags(self, sort='alpha', page=0, limit=None, **kw):
         c.page_list = W.page_list
         c.page_size = W.page_size
         limit, pagenum, start = g.handle_paging(limit, page, default=25)
-        count = 0
-        page_tags = {}
-        q = WM.Page.query.find(dict(app_config_id=c.app.config._id,
-                                    deleted=False,
-                                    labels={'$ne': []}))
+        criteria = dict(app_config_id=c.app.config._id, deleted=False)
+        name_labels = sorted(WM.Page.label_counts(criteria))
+        count = len(name_labels)
+        name_labels = name_labels[start:start + limit]
+        page_tags = {label: [] for label in name_labels}
+        q = WM.Page.query.find(dict(criteria, labels={'$in': name_labels})).sort('title')
         for page in q:
-            if page.labels:
-                for label in page.labels:
-                    if label not in page_tags:
-                        page_tags[label] = []
+            for label in page.labels:
+                if label in page_tags:
                     page_tags[label].append(page)
-        count = len(page_tags)
-        name_labels = sorted(page_tags)
         return dict(labels=page_tags,
                     limit=limit,
                     count=count,
                     page=pagenum,
-                    name_labels=name_labels[start:start + limit])
+                    name_labels=name_labels)
 
     @with_trailing_slash
     @expose('jinja:forgewiki:templates/wiki/create_page.html')
@@ -0,0 +1,49 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+import logging
+
+from ming.orm import ThreadLocalORMSession
+
+from allura.lib import utils
+from forgewiki import model as WM
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    # copy the latest snapshot's timestamp and author onto pages last edited
+    # before Page.commit started setting them
+    for chunk in utils.chunked_find(WM.Page, {'last_edit_date': None}):
+        for page in chunk:
+            ss = page.history().first()
+            if not ss:
+                continue
+            page.last_edit_date = ss.timestamp
+            page.last_edit_by = dict(
+                id=ss.author.id,
+                username=ss.author.username,
+                display_name=ss.author.display_name)
+        log.info('Processed %d pages', len(chunk))
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+
+
+if __name__ == '__main__':
+    main()
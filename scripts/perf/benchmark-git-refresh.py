@@ -0,0 +1,80 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Measure commits/sec of the commit & tree ingestion step of a git repo refresh,
+with the classic GitPython walk and with scm.git.stream_refresh.
+
+Both runs do a non-lazy refresh (existing docs are rewritten with the same
+data), so this is safe to run against a repo that is already refreshed.
+
+Run with: paster script development.ini ../scripts/perf/benchmark-git-refresh.py -- -p test -m code --limit 5000
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import argparse
+from itertools import islice
+from time import time
+
+import mock
+import tg
+from ming.orm import ThreadLocalORMSession
+
+from allura import model as M
+from allura.lib import helpers as h
+
+
+def timed(name, repo, commit_ids, stream):
+    with mock.patch.dict(tg.config, {'scm.git.stream_refresh': str(stream)}):
+        start = time()
+        repo.refresh_commits_info(commit_ids, lazy=False)
+        elapsed = time() - start
+    ThreadLocalORMSession.close_all()
+    print('%-8s %6d commits in %7.2fs: %8.1f commits/sec' % (
+        name, len(commit_ids), elapsed, len(commit_ids) / elapsed))
+
+
+def main(opts):
+    project = M.Project.query.get(shortname=opts.project, neighborhood_id=M.Neighborhood.query.get(
+        name=opts.neighborhood)._id)
+    app = project.app_instance(opts.mount_point)
+    h.set_context(project._id, app_config_id=app.config._id)
+    repo = app.repo
+    commit_ids = list(islice(repo.all_commit_ids(), opts.limit))
+    if not opts.skip_classic:
+        timed('classic', repo, commit_ids, False)
+    timed('stream', repo, commit_ids, True)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--neighborhood', default='Projects',
+                        help='Neighborhood name (default: %(default)s)')
+    parser.add_argument('-p', '--project', required=True, help='Project shortname')
+    parser.add_argument('-m', '--mount-point', default='code', help='Git tool mount point (default: %(default)s)')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='Only refresh the most recent LIMIT commits')
+    parser.add_argument('--skip-classic', action='store_true',
+                        help="Don't time the GitPython implementation")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
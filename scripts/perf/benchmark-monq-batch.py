@@ -0,0 +1,92 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Compare task throughput when claiming MonQ tasks one at a time versus in
+batches.  Posts tiny no-op tasks and runs them in-process, so the numbers
+mostly reflect queue round-trips.
+
+Run with: paster script development.ini ../scripts/perf/benchmark-monq-batch.py -- --tasks 5000 --batch-size 20
+
+Note: this removes all tasks named pprint.pformat from the task queue.
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import argparse
+import pprint
+from time import time
+
+from ming.orm import ThreadLocalORMSession
+
+from allura import model as M
+from six.moves import range
+
+TASK_NAME = 'pprint.pformat'
+
+
+def post_tasks(count):
+    M.MonQTask.query.remove(dict(task_name=TASK_NAME))
+    for i in range(count):
+        M.MonQTask.post(pprint.pformat, ([i],), flush_immediately=False)
+        if i % 1000 == 0:
+            ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+
+
+def run_single(count):
+    for i in range(count):
+        task = M.MonQTask.get(process='benchmark', only=[TASK_NAME])
+        task(restore_context=False)
+        ThreadLocalORMSession.close_all()
+
+
+def run_batched(count, batch_size):
+    done = 0
+    while done < count:
+        tasks = M.MonQTask.get_batch(process='benchmark', size=batch_size, only=[TASK_NAME])
+        if not tasks:
+            break
+        for task in tasks:
+            task(restore_context=False)
+        done += len(tasks)
+        ThreadLocalORMSession.close_all()
+
+
+def timed(label, count, func, *args):
+    post_tasks(count)
+    start = time()
+    func(count, *args)
+    elapsed = time() - start
+    print('%-20s %d tasks in %.2fs: %.1f tasks/sec' % (label, count, elapsed, count / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', type=int, default=2000, help='number of tasks to run per mode')
+    parser.add_argument('--batch-size', type=int, default=20, help='number of tasks to claim per batch')
+    options = parser.parse_args()
+
+    timed('single', options.tasks, run_single)
+    timed('batch of %d' % options.batch_size, options.tasks, run_batched, options.batch_size)
+    M.MonQTask.query.remove(dict(task_name=TASK_NAME))
+
+
+if __name__ == '__main__':
+    main()
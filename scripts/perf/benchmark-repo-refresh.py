@@ -0,0 +1,151 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+"""
+Measure commits/sec for the mongo-write phases of a repo refresh
+(refresh_commit_repos and the child-reference pass), comparing the bulk
+implementation with the old one-write-per-doc approach.  Uses a synthetic
+linear history, so no scm access is involved.
+
+Run with: paster script development.ini ../scripts/perf/benchmark-repo-refresh.py -- --commits 5000
+
+Note: this removes the synthetic commits, references and shortlinks it creates.
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import argparse
+import hashlib
+from time import time
+
+import bson
+from six.moves.cPickle import dumps
+
+from allura import model as M
+from allura.lib.utils import BulkWriter
+from allura.model import repo_refresh
+from allura.model.repository import CommitDoc
+from allura.model.index import ArtifactReferenceDoc, ShortlinkDoc
+from six.moves import range
+
+ID_PREFIX = 'allura.model.repository.Commit#'
+
+
+class FakeConfig(object):
+    project_id = bson.ObjectId()
+    _id = bson.ObjectId()
+
+
+class FakeApp(object):
+    config = FakeConfig()
+
+
+class FakeRepo(object):
+    _id = bson.ObjectId()
+    app = FakeApp()
+
+    def url_for_commit(self, oid):
+        return '/p/benchmark/code/ci/%s/' % oid
+
+    def shorthand_for_commit(self, oid):
+        return '[%s]' % oid[:6]
+
+
+def make_commits(count, run):
+    oids = [hashlib.sha1(('%s:%d' % (run, i)).encode('utf-8')).hexdigest()
+            for i in range(count)]
+    writer = BulkWriter(CommitDoc)
+    for i, oid in enumerate(oids):
+        writer.insert(dict(
+            _id=oid,
+            parent_ids=[oids[i - 1]] if i else [],
+            child_ids=[],
+            repo_ids=[]))
+    writer.execute()
+    return oids
+
+
+def cleanup(oids):
+    CommitDoc.m.remove(dict(_id={'$in': oids}))
+    index_ids = [ID_PREFIX + oid for oid in oids]
+    ArtifactReferenceDoc.m.remove(dict(_id={'$in': index_ids}))
+    ShortlinkDoc.m.remove(dict(ref_id={'$in': index_ids}))
+
+
+def legacy_refresh(oids, repo):
+    for ci in CommitDoc.m.find(dict(_id={'$in': oids}, repo_ids={'$ne': repo._id})):
+        oid = ci._id
+        ci.repo_ids.append(repo._id)
+        index_id = ID_PREFIX + oid
+        ref = ArtifactReferenceDoc(dict(
+            _id=index_id,
+            artifact_reference=dict(
+                cls=bson.Binary(dumps(M.repository.Commit)),
+                project_id=repo.app.config.project_id,
+                app_config_id=repo.app.config._id,
+                artifact_id=oid),
+            references=[]))
+        for link in (repo.shorthand_for_commit(oid)[1:-1], oid):
+            ShortlinkDoc(dict(
+                _id=bson.ObjectId(),
+                ref_id=index_id,
+                project_id=repo.app.config.project_id,
+                app_config_id=repo.app.config._id,
+                link=link,
+                url=repo.url_for_commit(oid))).m.save(safe=False, validate=False)
+        ci.m.save(safe=False, validate=False)
+        ref.m.save(safe=False, validate=False)
+    for oid in oids:
+        ci = next(CommitDoc.m.find(dict(_id=oid), validate=False))
+        repo_refresh.refresh_children(ci)
+
+
+def bulk_refresh(oids, repo):
+    repo_refresh.refresh_commit_repos(oids, repo)
+    repo_refresh.refresh_commit_children(oids)
+
+
+def timed(name, func, count):
+    oids = make_commits(count, name)
+    try:
+        start = time()
+        func(oids, FakeRepo())
+        elapsed = time() - start
+    finally:
+        cleanup(oids)
+    print('%-8s %6d commits in %6.2fs: %8.1f commits/sec' % (name, count, elapsed, count / elapsed))
+
+
+def main(opts):
+    if not opts.skip_legacy:
+        timed('legacy', legacy_refresh, opts.commits)
+    timed('bulk', bulk_refresh, opts.commits)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--commits', type=int, default=2000,
+                        help='Number of synthetic commits to refresh')
+    parser.add_argument('--skip-legacy', action='store_true',
+                        help="Don't time the one-write-per-doc implementation")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_options())
@@ -27,7 +27,9 @@
 from contextlib import contextmanager
 from pprint import pprint
 
+import tg
 from mock import Mock
+from allura.lib import helpers as h
 from forgegit.model.git_repo import GitImplementation
 
 
@@ -46,10 +48,16 @@ def main(repo_dir, sub_dir='', commit=None):
     paths = glob(os.path.join(repo_dir, sub_dir, '*'))
     paths = [path.replace(repo_dir + '/', '', 1) for path in paths]
     print("Timing LCDs for %s at %s" % (paths, commit._id))
-    with benchmark() as timer:
-        result = git.last_commit_ids(commit, paths)
-    pprint(result)
-    print("Took %f seconds" % timer['result'])
+    results = {}
+    for name, single_pass in [('threaded', 'false'), ('single pass', 'true')]:
+        with h.push_config(tg.config, **{'scm.git.lcd_single_pass': single_pass}):
+            with benchmark() as timer:
+                results[name] = git.last_commit_ids(commit, paths)
+        print("%s: took %f seconds" % (name, timer['result']))
+    pprint(results['single pass'])
+    if results['threaded'] != results['single pass']:
+        print("Results differ! threaded:")
+        pprint(results['threaded'])
 
 if __name__ == '__main__':
     main(*sys.argv[1:])